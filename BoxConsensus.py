@@ -0,0 +1,450 @@
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# Consensus of the telegram boxes (task T2) that classifiers mark on a page.
+#
+# Two boxes are taken to be the same telegram if the area of their
+# intersection is more than overlapThreshold of the area of their union (the
+# IoU). The IoU of every pair of boxes of a subject is computed at once and
+# the boxes are clustered as the connected components of the graph of
+# matching pairs, so the clusters do not depend on the order of the boxes.
+# The components are found for every subject at once by propagating the
+# smallest box number along the matching pairs.
+#
+# The boxes of a cluster are averaged as BoxMatcher.mean does: the mean
+# centre of the boxes with their mean width and height. The clusters of a
+# subject are numbered (bestBoxIndex) in the order of their first box when
+# the boxes are sorted by y, height, x and width.
+#
+# BoxMatcher and clusterBoxesSweep are the original algorithm of the box
+# notebook, which compares every box with the previous box in that order
+# only.
+#
+# The aggregated boxes are stored in the SubjectBoxes table with the
+# collection, ledger and page of their subject, and the telegram numbers of
+# every subject in the SubjectTelegrams table (see storeBoxConsensus).
+# Subjects are identified by their zooniverse id.
+
+defaultOverlapThreshold = 0.7
+
+boxColumns = ['subjectKey', 'boxX', 'boxY', 'boxW', 'boxH']
+aggregatedBoxColumns = ['bestBoxIndex', 'meanX', 'meanY', 'meanWidth',
+                        'meanHeight', 'numBoxesMarked']
+
+boxSqliteSchema = [
+    '''CREATE TABLE IF NOT EXISTS SubjectBoxes (
+    id INTEGER NOT NULL PRIMARY KEY,
+    zooniverseId INT NOT NULL,
+    bestBoxIndex INT NOT NULL,
+    collection VARCHAR(50) NOT NULL DEFAULT 'Unspecified',
+    ledger INT NOT NULL,
+    page INT NOT NULL,
+    meanX REAL NOT NULL,
+    meanY REAL NOT NULL,
+    meanWidth REAL NOT NULL,
+    meanHeight REAL NOT NULL,
+    numBoxesMarked INT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS SubjectTelegrams (
+    id INTEGER NOT NULL PRIMARY KEY,
+    zooniverseId INT NOT NULL,
+    collection VARCHAR(50) NOT NULL DEFAULT 'Unspecified',
+    ledger INT NOT NULL,
+    page INT NOT NULL,
+    telegramId INT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS SubjectBoxesZooniverseId ON SubjectBoxes (zooniverseId)',
+    'CREATE INDEX IF NOT EXISTS SubjectTelegramsZooniverseId ON SubjectTelegrams (zooniverseId)'
+]
+
+
+class TelegramBox():
+
+    def __init__(self, x, y, width, height, data):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.data = data
+
+    def __str__(self):
+        return 'TelegramBox(x={}, y={}, width={}, height={}, subject={})'.format(
+            self.x, self.y, self.width, self.height, self.data)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class BoxMatcher():
+
+    def __init__(self, _overlapThreshold=defaultOverlapThreshold):
+        self.overlapThreshold = _overlapThreshold
+        self.box = None
+
+    def compare(self, otherBox):
+        if self.box is None:
+            self.setBox(otherBox)
+            return True
+        # define "identity" as a degree of area overlap
+        selfArea = self.box.width * self.box.height
+        otherArea = otherBox.width * otherBox.height
+        dx = min(self.box.x + self.box.width,
+                 otherBox.x + otherBox.width) - max(self.box.x, otherBox.x)
+        dy = min(self.box.y + self.box.height,
+                 otherBox.y + otherBox.height) - max(self.box.y, otherBox.y)
+        if dx < 0 or dy < 0:
+            return False
+        areaOfOverlap = dx * dy
+        unionOfAreas = selfArea + otherArea - areaOfOverlap
+        overlapFraction = areaOfOverlap / unionOfAreas
+        return overlapFraction > self.overlapThreshold
+
+    def setBox(self, newBox):
+        self.box = newBox
+
+    @staticmethod
+    def mean(boxes):
+
+        meanCoMX = meanCoMY = meanWidth = meanHeight = 0.0
+        for box in boxes:
+            boxCoM = (box.x + 0.5 * box.width, box.y + 0.5 * box.height)
+            meanCoMX += boxCoM[0]
+            meanCoMY += boxCoM[1]
+            meanWidth += box.width
+            meanHeight += box.height
+
+        meanBox = TelegramBox(
+            meanCoMX / float(len(boxes)) - 0.5 * meanWidth / float(len(boxes)),
+            meanCoMY / float(len(boxes)) -
+            0.5 * meanHeight / float(len(boxes)),
+            meanWidth / float(len(boxes)), meanHeight / float(len(boxes)), {
+                'nBoxes': len(boxes)
+            })
+        return meanBox
+
+
+def makeBoxesFrame(boxRecords):
+    # boxRecords are (subjectKey, x, y, width, height) tuples
+    boxesFrame = pd.DataFrame.from_records(boxRecords, columns=boxColumns)
+    return boxesFrame.astype({
+        'subjectKey': np.int64,
+        'boxX': np.float64,
+        'boxY': np.float64,
+        'boxW': np.float64,
+        'boxH': np.float64
+    })
+
+
+def sortBoxes(boxesFrame):
+    # the rows in the order of (subject, y, height, x, width)
+    return np.lexsort((boxesFrame['boxW'].values, boxesFrame['boxX'].values,
+                       boxesFrame['boxH'].values, boxesFrame['boxY'].values,
+                       boxesFrame['subjectKey'].values))
+
+
+def getSubjectPairs(subjectKeys):
+    '''Every pair (i, j) with i < j of rows of the same subject.
+
+    The rows must be sorted by subject.
+    '''
+    numRows = len(subjectKeys)
+    if numRows == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    subjectStarts = np.flatnonzero(
+        np.concatenate([[True], subjectKeys[1:] != subjectKeys[:-1]]))
+    subjectSizes = np.diff(np.append(subjectStarts, numRows))
+    # the number of rows that follow every row in its subject
+    rowStarts = np.repeat(subjectStarts, subjectSizes)
+    numFollowing = rowStarts + np.repeat(subjectSizes,
+                                         subjectSizes) - np.arange(numRows) - 1
+    firstRows = np.repeat(np.arange(numRows), numFollowing)
+    pairOffsets = np.arange(len(firstRows)) - np.repeat(
+        np.cumsum(numFollowing) - numFollowing, numFollowing)
+    return firstRows, firstRows + 1 + pairOffsets
+
+
+def computeIoU(x, y, width, height, firstRows, secondRows):
+    dx = np.minimum(x[firstRows] + width[firstRows],
+                    x[secondRows] + width[secondRows]) - np.maximum(
+                        x[firstRows], x[secondRows])
+    dy = np.minimum(y[firstRows] + height[firstRows],
+                    y[secondRows] + height[secondRows]) - np.maximum(
+                        y[firstRows], y[secondRows])
+    areas = width * height
+    areasOfOverlap = np.where((dx >= 0) & (dy >= 0), dx * dy, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return areasOfOverlap / (areas[firstRows] + areas[secondRows] -
+                                 areasOfOverlap)
+
+
+def findComponents(numRows, firstRows, secondRows):
+    # the smallest row of the connected component of every row
+    labels = np.arange(numRows)
+    while True:
+        newLabels = labels.copy()
+        np.minimum.at(newLabels, firstRows, labels[secondRows])
+        np.minimum.at(newLabels, secondRows, labels[firstRows])
+        # follow the labels to the smallest row found so far
+        newLabels = newLabels[newLabels]
+        if np.array_equal(newLabels, labels):
+            return labels
+        labels = newLabels
+
+
+def clusterBoxes(boxesFrame, overlapThreshold=defaultOverlapThreshold):
+    '''Cluster the boxes (a frame with boxColumns) of every subject.
+
+    Returns the cluster number (bestBoxIndex) of every row.
+    '''
+    sortedRows = sortBoxes(boxesFrame)
+    subjectKeys = boxesFrame['subjectKey'].values[sortedRows]
+    x, y, width, height = [
+        boxesFrame[column].to_numpy(dtype=np.float64)[sortedRows]
+        for column in ['boxX', 'boxY', 'boxW', 'boxH']
+    ]
+    firstRows, secondRows = getSubjectPairs(subjectKeys)
+    matching = computeIoU(x, y, width, height, firstRows,
+                          secondRows) > overlapThreshold
+    labels = findComponents(len(sortedRows), firstRows[matching],
+                            secondRows[matching])
+
+    # number the clusters of every subject in the order of their first box
+    isFirstBox = labels == np.arange(len(labels))
+    clusterNumbers = np.cumsum(isFirstBox) - 1
+    subjectStarts = np.concatenate(
+        [[True], subjectKeys[1:] != subjectKeys[:-1]]) if len(
+            subjectKeys) > 0 else np.zeros(0, dtype=bool)
+    firstClusterNumbers = np.maximum.accumulate(
+        np.where(subjectStarts, clusterNumbers, 0))
+    bestBoxIndices = np.empty(len(sortedRows), dtype=np.int64)
+    bestBoxIndices[sortedRows] = (clusterNumbers -
+                                  firstClusterNumbers)[labels]
+    return bestBoxIndices
+
+
+def averageBoxes(boxesFrame, bestBoxIndices):
+    '''The mean box of every cluster, as a frame indexed by subject with the
+    columns of the SubjectBoxes table.'''
+    subjectKeys = boxesFrame['subjectKey'].to_numpy(dtype=np.int64)
+    clusters, clusterRows = np.unique(np.stack([subjectKeys, bestBoxIndices]),
+                                      axis=1, return_inverse=True)
+    clusterRows = clusterRows.reshape(-1)
+    numBoxes = np.bincount(clusterRows, minlength=clusters.shape[1])
+
+    def clusterMean(values):
+        return np.bincount(clusterRows, weights=values,
+                           minlength=clusters.shape[1]) / numBoxes
+
+    x, y, width, height = [
+        boxesFrame[column].to_numpy(dtype=np.float64)
+        for column in ['boxX', 'boxY', 'boxW', 'boxH']
+    ]
+    meanWidth = clusterMean(width)
+    meanHeight = clusterMean(height)
+    return pd.DataFrame(
+        {
+            'bestBoxIndex': clusters[1],
+            'meanX': clusterMean(x + 0.5 * width) - 0.5 * meanWidth,
+            'meanY': clusterMean(y + 0.5 * height) - 0.5 * meanHeight,
+            'meanWidth': meanWidth,
+            'meanHeight': meanHeight,
+            'numBoxesMarked': numBoxes
+        },
+        index=pd.Index(clusters[0], name='subject_id'))
+
+
+def aggregateBoxes(boxesFrame, overlapThreshold=defaultOverlapThreshold):
+    if len(boxesFrame) == 0:
+        return averageBoxes(boxesFrame, np.zeros(0, dtype=np.int64))
+    return averageBoxes(boxesFrame,
+                        clusterBoxes(boxesFrame, overlapThreshold))
+
+
+def encodeAggregatedBoxes(aggregatedBoxes):
+    # columns for the stage cache
+    columns = {'index': np.asarray(aggregatedBoxes.index, dtype=np.int64)}
+    for column in aggregatedBoxColumns:
+        columns[column] = aggregatedBoxes[column].to_numpy()
+    return columns
+
+
+def decodeAggregatedBoxes(columns):
+    return pd.DataFrame(
+        {column: np.asarray(columns[column])
+         for column in aggregatedBoxColumns},
+        index=pd.Index(np.asarray(columns['index']), name='subject_id'))
+
+
+def storeBoxConsensus(connection, aggregatedBoxes, pageFrame, subjectKeys):
+    '''Replace the SubjectBoxes and SubjectTelegrams tables.
+
+    pageFrame holds the page fields of the subjects (see
+    SubjectIndex.getPageFrame); the telegrams of the subjectKeys are stored.
+    As in the box notebook, boxes of subjects without subject data are not
+    stored.
+    '''
+    cursor = connection.cursor()
+    cursor.execute('DROP TABLE IF EXISTS SubjectBoxes')
+    cursor.execute('DROP TABLE IF EXISTS SubjectTelegrams')
+    for statement in boxSqliteSchema:
+        cursor.execute(statement)
+
+    subjectBoxes = pd.merge(aggregatedBoxes, pageFrame, how='inner',
+                            left_index=True, right_index=True)
+    cursor.executemany(
+        'INSERT INTO SubjectBoxes (zooniverseId, bestBoxIndex, collection, '
+        'ledger, page, meanX, meanY, meanWidth, meanHeight, numBoxesMarked) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        zip(np.asarray(subjectBoxes.index).tolist(),
+            *[subjectBoxes[column].tolist() for column in [
+                'bestBoxIndex', 'collection', 'ledger', 'page', 'meanX',
+                'meanY', 'meanWidth', 'meanHeight', 'numBoxesMarked'
+            ]]))
+
+    subjectPages = pageFrame[np.isin(pageFrame.index, list(subjectKeys))]
+    cursor.executemany(
+        'INSERT INTO SubjectTelegrams (zooniverseId, collection, ledger, '
+        'page, telegramId) VALUES (?, ?, ?, ?, ?)',
+        [(zooniverseId, collection, ledger, page, telegramNumber)
+         for zooniverseId, collection, ledger, page, telegramNumbers in zip(
+             np.asarray(subjectPages.index).tolist(),
+             subjectPages['collection'].tolist(),
+             subjectPages['ledger'].tolist(), subjectPages['page'].tolist(),
+             subjectPages['telegramNumbers'])
+         for telegramNumber in telegramNumbers])
+    connection.commit()
+    return len(subjectBoxes)
+
+
+def clusterBoxesSweep(boxesFrame, overlapThreshold=defaultOverlapThreshold):
+    # The box notebook: every box (in sorted order) starts a new cluster
+    # unless it matches the previous box. The matcher is not reset between
+    # subjects.
+    sortedRows = sortBoxes(boxesFrame)
+    bestBoxIndices = np.zeros(len(boxesFrame), dtype=np.int64)
+    subjectKey = None
+    groupIndex = None
+    boxMatcher = BoxMatcher(overlapThreshold)
+    boxes = [
+        TelegramBox(*box) for box in boxesFrame[
+            ['boxX', 'boxY', 'boxW', 'boxH', 'subjectKey']].itertuples(
+                index=False)
+    ]
+    for row in sortedRows.tolist():
+        box = boxes[row]
+        if subjectKey != box.data:
+            subjectKey = box.data
+            groupIndex = 0
+        if not boxMatcher.compare(box):
+            groupIndex += 1
+        bestBoxIndices[row] = groupIndex
+        boxMatcher.setBox(box)
+    return bestBoxIndices
+
+
+def comparePairs(subjectKeys, bestBoxIndices, trueBoxIndices):
+    # pairwise precision and recall of the clusters of every subject
+    def numPairs(*keys):
+        counts = np.unique(np.stack(keys), axis=1, return_counts=True)[1]
+        return np.sum(counts * (counts - 1) // 2)
+
+    numClusterPairs = numPairs(subjectKeys, bestBoxIndices)
+    numTruePairs = numPairs(subjectKeys, trueBoxIndices)
+    numSharedPairs = numPairs(subjectKeys, bestBoxIndices, trueBoxIndices)
+    return (numSharedPairs / max(numClusterPairs, 1),
+            numSharedPairs / max(numTruePairs, 1))
+
+
+def makeSyntheticBoxes(numSubjects, telegramsPerSubject=4,
+                       classifiersPerSubject=8, markRate=0.9, jitter=8.0,
+                       spuriousRate=0.05, seed=0):
+    # Telegrams stacked down the page, marked with jitter by every classifier
+    # (classifiers miss some telegrams and mark some spurious boxes). Returns
+    # the boxes and the telegram that every box marks (-1 if spurious).
+    rng = np.random.RandomState(seed)
+    subjectKeys = []
+    trueBoxes = []
+    boxes = []
+    for subject in range(1959000, 1959000 + numSubjects):
+        telegramHeights = rng.uniform(150, 450, telegramsPerSubject)
+        telegramTops = 50 + np.cumsum(telegramHeights) - telegramHeights + (
+            20 * np.arange(telegramsPerSubject))
+        telegramLefts = rng.uniform(20, 120, telegramsPerSubject)
+        telegramWidths = rng.uniform(800, 1100, telegramsPerSubject)
+        for classifier in range(classifiersPerSubject):
+            for telegram in np.flatnonzero(
+                    rng.rand(telegramsPerSubject) < markRate).tolist():
+                subjectKeys.append(subject)
+                trueBoxes.append(telegram)
+                boxes.append((telegramLefts[telegram],
+                              telegramTops[telegram],
+                              telegramWidths[telegram],
+                              telegramHeights[telegram]) +
+                             rng.normal(0, jitter, 4))
+            if rng.rand() < spuriousRate:
+                subjectKeys.append(subject)
+                trueBoxes.append(-1 - len(trueBoxes))
+                boxes.append((rng.uniform(0, 800), rng.uniform(0, 1500),
+                              rng.uniform(50, 400), rng.uniform(50, 300)))
+    boxes = np.array(boxes).reshape(-1, 4)
+    boxesFrame = pd.DataFrame({
+        'subjectKey': np.array(subjectKeys, dtype=np.int64),
+        'boxX': boxes[:, 0],
+        'boxY': boxes[:, 1],
+        'boxW': boxes[:, 2],
+        'boxH': boxes[:, 3]
+    })
+    return boxesFrame, np.array(trueBoxes, dtype=np.int64)
+
+
+def benchmark(numSubjects=5000, overlapThreshold=defaultOverlapThreshold):
+    boxesFrame, trueBoxIndices = makeSyntheticBoxes(numSubjects)
+    subjectKeys = boxesFrame['subjectKey'].values
+    numTrueBoxes = len(np.unique(np.stack([subjectKeys, trueBoxIndices]),
+                                 axis=1)[0])
+
+    for label, clusterFunction in [('BoxMatcher sweep', clusterBoxesSweep),
+                                   ('IoU components', clusterBoxes)]:
+        startTime = time.perf_counter()
+        bestBoxIndices = clusterFunction(boxesFrame, overlapThreshold)
+        clusterTime = time.perf_counter() - startTime
+        startTime = time.perf_counter()
+        aggregatedBoxes = averageBoxes(boxesFrame, bestBoxIndices)
+        averageTime = time.perf_counter() - startTime
+        precision, recall = comparePairs(subjectKeys, bestBoxIndices,
+                                         trueBoxIndices)
+        print('{:<17} clustered {} boxes in {:.3f} s, averaged in {:.3f} s: {} boxes ({} marked), pair precision {:.4f}, recall {:.4f}'.format(
+            label + ':', len(boxesFrame), clusterTime, averageTime,
+            len(aggregatedBoxes), numTrueBoxes, precision, recall))
+
+    # the array mean must agree with BoxMatcher.mean
+    numMismatches = 0
+    for (subject, bestBoxIndex), cluster in boxesFrame.groupby(
+            [subjectKeys, bestBoxIndices]):
+        if subject > subjectKeys[0] + 100:
+            break
+        meanBox = BoxMatcher.mean([
+            TelegramBox(*box, subject) for box in cluster[
+                ['boxX', 'boxY', 'boxW', 'boxH']].itertuples(index=False)
+        ])
+        aggregatedBox = aggregatedBoxes.loc[subject]
+        aggregatedBox = aggregatedBox[aggregatedBox['bestBoxIndex'] ==
+                                      bestBoxIndex].iloc[0]
+        if not np.allclose([meanBox.x, meanBox.y, meanBox.width,
+                            meanBox.height, meanBox.data['nBoxes']],
+                           aggregatedBox[['meanX', 'meanY', 'meanWidth',
+                                          'meanHeight',
+                                          'numBoxesMarked']].values.astype(
+                                              np.float64)):
+            numMismatches += 1
+    print('Mismatched means: {}'.format(numMismatches))
+    return numMismatches
+
+
+if __name__ == '__main__':
+    sys.exit(1 if benchmark(*[float(argument) if '.' in argument else
+                              int(argument)
+                              for argument in sys.argv[1:]]) > 0 else 0)
@@ -0,0 +1,284 @@
+import csv
+import json
+import re as regex
+import sys
+import time
+from collections import OrderedDict
+
+import dateutil.parser
+
+from TextLine import TextLine
+from TelegramLines import TelegramLines
+from TimestampFilter import TimestampFilter
+
+# Use a faster JSON backend when one is installed. orjson produces the same
+# Python objects as the standard library for the JSON in classification
+# exports.
+try:
+    import orjson
+    fastJsonBackend = 'orjson'
+    fastJsonLoads = orjson.loads
+except ImportError:
+    fastJsonBackend = 'json'
+    fastJsonLoads = json.loads
+
+# Decodes only the parts of a classification export row that are needed to
+# extract the transcribed lines of a telegram:
+#
+#  - columns are addressed by position, so rows can be read with csv.reader
+#    rather than csv.DictReader,
+#  - subject_data is never decoded,
+#  - started_at is extracted from the raw metadata string, which is only
+#    decoded in full if that fails, and converted to epoch milliseconds by a
+#    TimestampFilter, which also rejects records from before the live date,
+#  - records whose T1 answer cannot be a telegram (there is a T1 task, but
+#    "Telegram... appears nowhere in the annotations) are rejected before the
+#    annotations are decoded, and the T1 answer is checked before any lines
+#    are built otherwise.
+#
+# With extractBoxes, the telegram boxes that were marked (task T2) are
+# extracted from the same decoded annotations by decodeRecord. As in the box
+# consensus notebook, the boxes of every record from after the live date are
+# kept, whatever its T1 answer, so a record that is rejected early is only
+# decoded if its annotations contain a T2 task.
+#
+# The time spent in every stage is accumulated so that the decoding cost of
+# an export can be reported.
+
+
+class ClassificationRowDecoder():
+
+    startedAtPattern = regex.compile(r'"started_at"\s*:\s*"([^"\\]*)"')
+    t1TaskPattern = regex.compile(r'"task"\s*:\s*"T1"')
+
+    def __init__(self, header, _liveDate=None, _useFastJson=True,
+                 _extractBoxes=False):
+        self.timestampFilter = TimestampFilter(_liveDate)
+        self.extractBoxes = _extractBoxes
+        self.loadJson = fastJsonLoads if _useFastJson else json.loads
+        self.metadataColumn = header.index(
+            'metadata') if 'metadata' in header else None
+        self.annotationsColumn = header.index('annotations')
+        self.subjectColumn = header.index('subject_ids')
+        self.classificationIdColumn = header.index(
+            'classification_id') if 'classification_id' in header else None
+        self.resetStageTimes()
+
+    def resetStageTimes(self):
+        self.stageTimes = OrderedDict([('metadata', 0.0), ('date', 0.0),
+                                       ('annotations', 0.0), ('lines', 0.0),
+                                       ('boxes', 0.0)])
+        self.stageCounts = OrderedDict([('rows', 0), ('rejectedDate', 0),
+                                        ('rejectedEarly', 0),
+                                        ('rejectedTask', 0), ('telegrams', 0),
+                                        ('boxes', 0)])
+
+    def getSubjectKey(self, row):
+        return int(row[self.subjectColumn])
+
+    def getClassificationId(self, row):
+        return int(row[self.classificationIdColumn])
+
+    def getStartedAt(self, row):
+        metadata = row[self.metadataColumn]
+        startedAtMatch = self.startedAtPattern.search(metadata)
+        if startedAtMatch is not None:
+            return startedAtMatch.group(1)
+        return self.loadJson(metadata)['started_at']
+
+    def decode(self, row):
+        return self.decodeRecord(row)[0]
+
+    def extractRecordBoxes(self, parsedAnnotations):
+        startTime = time.perf_counter()
+        boxes = []
+        for task in parsedAnnotations:
+            # Check for recorded box data
+            if task['task'] == "T2" and task['value']:
+                for box in task['value']:
+                    boxes.append((box['x'], box['y'], box['width'],
+                                  box['height']))
+        self.stageCounts['boxes'] += len(boxes)
+        self.stageTimes['boxes'] += time.perf_counter() - startTime
+        return boxes
+
+    def decodeRecord(self, row):
+        '''The transcribed lines of a telegram record (None for any other
+        record) and, with extractBoxes, the boxes of the record (None if it
+        is from before the live date).'''
+        stageTimes = self.stageTimes
+        self.stageCounts['rows'] += 1
+
+        # check the date that the classification was made
+        startedAt = -1
+        if self.metadataColumn is not None:
+            startTime = time.perf_counter()
+            startedAtString = self.getStartedAt(row)
+            dateTime = time.perf_counter()
+            stageTimes['metadata'] += dateTime - startTime
+            startedAt = self.timestampFilter.accept(startedAtString)
+            stageTimes['date'] += time.perf_counter() - dateTime
+            # skip "testing" data before the site went live
+            if startedAt is None:
+                self.stageCounts['rejectedDate'] += 1
+                return None, None
+
+        startTime = time.perf_counter()
+        annotations = row[self.annotationsColumn]
+        extractBoxes = self.extractBoxes
+        if '"Telegram' not in annotations and self.t1TaskPattern.search(
+                annotations) is not None:
+            self.stageCounts['rejectedEarly'] += 1
+            if not extractBoxes or '"T2"' not in annotations:
+                stageTimes['annotations'] += time.perf_counter() - startTime
+                return None, [] if extractBoxes else None
+            parsedAnnotations = self.loadJson(annotations)
+            stageTimes['annotations'] += time.perf_counter() - startTime
+            return None, self.extractRecordBoxes(parsedAnnotations)
+
+        parsedAnnotations = self.loadJson(annotations)
+        boxes = None
+        # Check if the current record is for a telegram (tasks may be stored
+        # out of order, so check all of them before processing any lines)
+        for task in parsedAnnotations:
+            if task['task'] == "T1" and (
+                    task['value'] is None
+                    or not task['value'].startswith("Telegram")):
+                stageTimes['annotations'] += time.perf_counter() - startTime
+                self.stageCounts['rejectedTask'] += 1
+                if extractBoxes:
+                    boxes = self.extractRecordBoxes(parsedAnnotations)
+                return None, boxes
+        linesTime = time.perf_counter()
+        stageTimes['annotations'] += linesTime - startTime
+
+        # initialize container for transcribed lines
+        transcribedLines = TelegramLines(startedAt)
+        for task in parsedAnnotations:
+            # Process transcriptions of text lines
+            if task['task'].startswith("T12") and len(task['value']) > 0:
+                # process the lines that were transcribed for this task
+                for taskValueItem in task['value']:
+                    transcribedLines.addLineCoords(
+                        taskValueItem['x1'], taskValueItem['y1'],
+                        taskValueItem['x2'], taskValueItem['y2'],
+                        taskValueItem['details'][0]['value'])
+        stageTimes['lines'] += time.perf_counter() - linesTime
+        self.stageCounts['telegrams'] += 1
+        if extractBoxes:
+            boxes = self.extractRecordBoxes(parsedAnnotations)
+        return transcribedLines, boxes
+
+    def formatStageTimes(self, title='Row decoding'):
+        totalTime = sum(self.stageTimes.values())
+        reportLines = ['{} ({} JSON backend): {:.3f} s'.format(
+            title, fastJsonBackend if self.loadJson is fastJsonLoads else 'json',
+            totalTime)]
+        for stage, stageTime in self.stageTimes.items():
+            reportLines.append('  {:<12} {:8.3f} s'.format(stage, stageTime))
+        reportLines.append('  ' + ', '.join(
+            '{}={}'.format(name, count)
+            for name, count in self.stageCounts.items()) +
+            ', dateFallbacks={}'.format(self.timestampFilter.numFallbacks))
+        return '\n'.join(reportLines)
+
+
+def benchmark(sampleDataFileName, liveDate):
+    # Full decoding of every row as performed before the fast path existed
+    fullStageTimes = OrderedDict([('csv', 0.0), ('metadata', 0.0),
+                                  ('date', 0.0), ('annotations', 0.0),
+                                  ('subject_data', 0.0), ('lines', 0.0)])
+    with open(sampleDataFileName) as csvfile:
+        startTime = time.perf_counter()
+        for record in csv.DictReader(csvfile):
+            stageTime = time.perf_counter()
+            fullStageTimes['csv'] += stageTime - startTime
+            parsedMetadata = json.loads(record['metadata'])
+            startTime = time.perf_counter()
+            fullStageTimes['metadata'] += startTime - stageTime
+            isTestingData = dateutil.parser.parse(
+                parsedMetadata['started_at']) < liveDate
+            stageTime = time.perf_counter()
+            fullStageTimes['date'] += stageTime - startTime
+            if isTestingData:
+                startTime = time.perf_counter()
+                continue
+            parsedAnnotations = json.loads(record['annotations'])
+            startTime = time.perf_counter()
+            fullStageTimes['annotations'] += startTime - stageTime
+            json.loads(record['subject_data'])
+            stageTime = time.perf_counter()
+            fullStageTimes['subject_data'] += stageTime - startTime
+            transcribedLines = TelegramLines()
+            for task in parsedAnnotations:
+                if task['task'] == "T1" and (
+                        task['value'] is None
+                        or not task['value'].startswith("Telegram")):
+                    break
+                if task['task'].startswith("T12") and len(task['value']) > 0:
+                    for taskValueItem in task['value']:
+                        transcribedLines.addLine(TextLine(
+                            taskValueItem['x1'], taskValueItem['y1'],
+                            taskValueItem['x2'], taskValueItem['y2'],
+                            taskValueItem['details'][0]['value']))
+            startTime = time.perf_counter()
+            fullStageTimes['lines'] += startTime - stageTime
+    print('Full decoding: {:.3f} s'.format(sum(fullStageTimes.values())))
+    for stage, stageTime in fullStageTimes.items():
+        print('  {:<12} {:8.3f} s'.format(stage, stageTime))
+
+    with open(sampleDataFileName) as csvfile:
+        parsedCsv = csv.reader(csvfile)
+        rowDecoder = ClassificationRowDecoder(next(parsedCsv), liveDate)
+        csvTime = 0.0
+        startTime = time.perf_counter()
+        for row in parsedCsv:
+            csvTime += time.perf_counter() - startTime
+            rowDecoder.decode(row)
+            startTime = time.perf_counter()
+    print('Fast path decoding: csv {:.3f} s'.format(csvTime))
+    print(rowDecoder.formatStageTimes())
+
+    # the lines and the boxes of the export in separate passes (the box pass
+    # as in the box notebook) or in a single pass
+    startTime = time.perf_counter()
+    separateBoxes = []
+    timestampFilter = TimestampFilter(liveDate)
+    with open(sampleDataFileName) as csvfile:
+        parsedCsv = csv.reader(csvfile)
+        rowDecoder = ClassificationRowDecoder(next(parsedCsv), liveDate)
+        for row in parsedCsv:
+            rowDecoder.decode(row)
+    with open(sampleDataFileName) as csvfile:
+        for record in csv.DictReader(csvfile):
+            if 'metadata' in record and timestampFilter.accept(json.loads(
+                    record['metadata'])['started_at']) is None:
+                continue
+            for task in json.loads(record['annotations']):
+                if task['task'] == "T2" and task['value']:
+                    for box in task['value']:
+                        separateBoxes.append(
+                            (int(record['subject_ids']), box['x'], box['y'],
+                             box['width'], box['height']))
+    separateTime = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    singlePassBoxes = []
+    with open(sampleDataFileName) as csvfile:
+        parsedCsv = csv.reader(csvfile)
+        rowDecoder = ClassificationRowDecoder(next(parsedCsv), liveDate,
+                                              _extractBoxes=True)
+        for row in parsedCsv:
+            transcribedLines, boxes = rowDecoder.decodeRecord(row)
+            if boxes:
+                subjectKey = rowDecoder.getSubjectKey(row)
+                singlePassBoxes.extend((subjectKey, ) + box for box in boxes)
+    singlePassTime = time.perf_counter() - startTime
+    print('Lines and boxes: separate passes {:.3f} s, single pass {:.3f} s, {} boxes ({})'.format(
+        separateTime, singlePassTime, len(singlePassBoxes),
+        'identical' if singlePassBoxes == separateBoxes else 'MISMATCHED'))
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1], dateutil.parser.parse(
+        sys.argv[2] if len(sys.argv) > 2 else "2016-06-20T00:00:00.00Z"))
@@ -0,0 +1,324 @@
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from StageCache import saveColumns, decodeStrings
+
+# Use Parquet files when pyarrow is installed and requested, memory mappable
+# NumPy arrays otherwise.
+try:
+    import pyarrow
+    import pyarrow.parquet
+    parquetAvailable = True
+except ImportError:
+    parquetAvailable = False
+
+# Columnar export of the consensus results. Unlike the linewise and
+# subjectwise text files, which only keep the consensus text, the export
+# keeps everything that sentence aggregation computes, as separate tables
+# that are linked by row numbers:
+#
+#   subjects:       subjectKey, huntingtonId, url, reliability (mean line
+#                   reliability), lineStart, numLines
+#   lines:          subjectKey, bestLineIndex, x1, y1, x2, y2, reliability,
+#                   consensus (the unfiltered consensus text), positionStart,
+#                   numPositions, transcriptionStart, numTranscriptions
+#   transcriptions: line, transcriptionIndex, numLines (of the transcription)
+#   positions:      line, position, reliability, wordStart, numWords
+#   words:          line, position, rank, word, spanStart, spanEnd, sentence
+#                   (the word alternatives of every position, most frequent
+#                   first)
+#   sentences:      line, text, metaTagStart, numMetaTags (the transcribed
+#                   sentences that the words were taken from)
+#   metaTags:       sentence, tag, start, end (word intervals of the sentence)
+#
+# The tables are built directly from the encoded line groups of the stage
+# cache (see StageCache.encodeLineGroups), so no StatefulWord objects are
+# needed. Every table is a directory of columns in the StageCache format
+# (.npy files, strings as UTF-8 data with offsets) or a single Parquet file.
+# loadTable reads only the requested columns and memory maps the arrays.
+#
+# Increment columnarExportVersion whenever the layout of a table changes.
+
+columnarExportVersion = 1
+tableNames = ['subjects', 'lines', 'transcriptions', 'positions', 'words',
+              'sentences', 'metaTags']
+
+
+def buildConsensusTables(lineGroupColumns, subjectsFrame=None):
+    if lineGroupColumns is None or len(lineGroupColumns['index']) == 0:
+        return buildEmptyTables()
+    numLines = len(lineGroupColumns['index'])
+    lineIds = np.arange(numLines, dtype=np.int64)
+
+    # subjects are the runs of consecutive lines with the same subject key
+    subjectKeys = lineGroupColumns['index']
+    subjectStarts = np.flatnonzero(np.concatenate(
+        [[True], subjectKeys[1:] != subjectKeys[:-1]]))
+    subjectLengths = np.diff(np.append(subjectStarts, numLines))
+    lineReliabilities = lineGroupColumns['reliability']
+    subjectReliabilities = np.array([
+        np.sum(lineReliabilities[lineStart:lineStart + lineCount]) /
+        float(lineCount)
+        for lineStart, lineCount in zip(subjectStarts.tolist(),
+                                        subjectLengths.tolist())
+    ])
+    subjectData = pd.DataFrame(index=subjectKeys[subjectStarts],
+                               columns=['huntington_id', 'url'], dtype=object)
+    if subjectsFrame is not None:
+        subjectData = subjectsFrame.reindex(subjectKeys[subjectStarts])
+    subjects = OrderedDict([
+        ('subjectKey', subjectKeys[subjectStarts]),
+        ('huntingtonId', [huntingtonId if isinstance(huntingtonId, str) else ''
+                          for huntingtonId in subjectData['huntington_id']]),
+        ('url', [url if isinstance(url, str) else ''
+                 for url in subjectData['url']]),
+        ('reliability', subjectReliabilities),
+        ('lineStart', subjectStarts.astype(np.int64)),
+        ('numLines', subjectLengths.astype(np.int64))
+    ])
+
+    # word positions and their alternatives
+    numPositions = lineGroupColumns['numPositions']
+    slotSizes = lineGroupColumns['slotSizes']
+    numSlots = len(slotSizes)
+    slotLines = np.repeat(lineIds, numPositions)
+    positionStarts = np.cumsum(numPositions) - numPositions
+    slotPositions = np.arange(numSlots, dtype=np.int64) - np.repeat(
+        positionStarts, numPositions)
+    wordStarts = np.cumsum(slotSizes) - slotSizes
+    numWords = int(slotSizes.sum())
+    wordRanks = np.arange(numWords, dtype=np.int64) - np.repeat(
+        wordStarts, slotSizes)
+    positions = OrderedDict([
+        ('line', slotLines),
+        ('position', slotPositions),
+        ('reliability', lineGroupColumns['wordReliabilities']),
+        ('wordStart', wordStarts.astype(np.int64)),
+        ('numWords', slotSizes.astype(np.int64))
+    ])
+
+    # the most frequent word of every occupied position forms the consensus
+    words = lineGroupColumns['words']
+    slotWords = [words[wordStart] if slotSize > 0 else None
+                 for wordStart, slotSize in zip(wordStarts.tolist(),
+                                                slotSizes.tolist())]
+    consensus = [
+        ' '.join([word for word in slotWords[positionStart:positionStart +
+                                             lineNumPositions]
+                  if word is not None])
+        for positionStart, lineNumPositions in zip(positionStarts.tolist(),
+                                                   numPositions.tolist())
+    ]
+    transcriptionLengths = lineGroupColumns['transcriptionIndexLengths']
+    lines = OrderedDict([
+        ('subjectKey', subjectKeys),
+        ('bestLineIndex', lineGroupColumns['bestLineIndex']),
+        ('x1', lineGroupColumns['x1']),
+        ('y1', lineGroupColumns['y1']),
+        ('x2', lineGroupColumns['x2']),
+        ('y2', lineGroupColumns['y2']),
+        ('reliability', lineReliabilities),
+        ('consensus', consensus),
+        ('positionStart', positionStarts.astype(np.int64)),
+        ('numPositions', numPositions.astype(np.int64)),
+        ('transcriptionStart',
+         (np.cumsum(transcriptionLengths) - transcriptionLengths).astype(
+             np.int64)),
+        ('numTranscriptions', transcriptionLengths.astype(np.int64))
+    ])
+    transcriptions = OrderedDict([
+        ('line', np.repeat(lineIds, transcriptionLengths)),
+        ('transcriptionIndex', lineGroupColumns['transcriptionIndex']),
+        ('numLines', lineGroupColumns['numLines'])
+    ])
+
+    # the sentences (and their metatags) that contributed words, numbered in
+    # order of their first word
+    sentenceIds = lineGroupColumns['sentenceIds']
+    usedSentenceIds, firstWords, wordSentences = np.unique(
+        sentenceIds, return_index=True, return_inverse=True)
+    sentenceOrder = np.argsort(firstWords, kind='stable')
+    sentenceNumbers = np.empty(len(sentenceOrder), dtype=np.int64)
+    sentenceNumbers[sentenceOrder] = np.arange(len(sentenceOrder))
+    wordLines = np.repeat(slotLines, slotSizes)
+    spans = lineGroupColumns['spans'].reshape(-1, 2)
+    wordsTable = OrderedDict([
+        ('line', wordLines),
+        ('position', np.repeat(slotPositions, slotSizes)),
+        ('rank', wordRanks),
+        ('word', list(words)),
+        ('spanStart', spans[:, 0].astype(np.int64)),
+        ('spanEnd', spans[:, 1].astype(np.int64)),
+        ('sentence', sentenceNumbers[wordSentences.reshape(-1)])
+    ])
+
+    sentenceFirstWords = firstWords[sentenceOrder]
+    metaTagSentences = []
+    metaTagTags = []
+    metaTagStarts = []
+    metaTagEnds = []
+    sentenceMetaTagCounts = []
+    tagStates = lineGroupColumns['tagStates']
+    parsedTagStates = {}
+    for sentenceNumber, tagStateId in enumerate(
+            lineGroupColumns['tagStateIds'][sentenceFirstWords].tolist()):
+        tagState = parsedTagStates.get(tagStateId)
+        if tagState is None:
+            tagState = parsedTagStates[tagStateId] = json.loads(
+                tagStates[tagStateId])
+        numMetaTags = 0
+        for tag, intervals in tagState.items():
+            for start, end in intervals:
+                metaTagSentences.append(sentenceNumber)
+                metaTagTags.append(tag)
+                metaTagStarts.append(start)
+                metaTagEnds.append(end)
+                numMetaTags += 1
+        sentenceMetaTagCounts.append(numMetaTags)
+    sentenceMetaTagCounts = np.array(sentenceMetaTagCounts, dtype=np.int64)
+    sentenceTexts = lineGroupColumns['sentences']
+    sentences = OrderedDict([
+        ('line', wordLines[sentenceFirstWords]),
+        ('text', [sentenceTexts[sentenceId]
+                  for sentenceId in usedSentenceIds[sentenceOrder].tolist()]),
+        ('metaTagStart', np.cumsum(sentenceMetaTagCounts) -
+         sentenceMetaTagCounts),
+        ('numMetaTags', sentenceMetaTagCounts)
+    ])
+    metaTags = OrderedDict([
+        ('sentence', np.array(metaTagSentences, dtype=np.int64)),
+        ('tag', metaTagTags),
+        ('start', np.array(metaTagStarts, dtype=np.int64)),
+        ('end', np.array(metaTagEnds, dtype=np.int64))
+    ])
+
+    return OrderedDict([('subjects', subjects), ('lines', lines),
+                        ('transcriptions', transcriptions),
+                        ('positions', positions), ('words', wordsTable),
+                        ('sentences', sentences), ('metaTags', metaTags)])
+
+
+def buildEmptyTables():
+    tableColumns = OrderedDict([
+        ('subjects', [('subjectKey', np.int64), ('huntingtonId', str),
+                      ('url', str), ('reliability', np.float64),
+                      ('lineStart', np.int64), ('numLines', np.int64)]),
+        ('lines', [('subjectKey', np.int64), ('bestLineIndex', np.int64),
+                   ('x1', np.float64), ('y1', np.float64),
+                   ('x2', np.float64), ('y2', np.float64),
+                   ('reliability', np.float64), ('consensus', str),
+                   ('positionStart', np.int64), ('numPositions', np.int64),
+                   ('transcriptionStart', np.int64),
+                   ('numTranscriptions', np.int64)]),
+        ('transcriptions', [('line', np.int64),
+                            ('transcriptionIndex', np.int64),
+                            ('numLines', np.int64)]),
+        ('positions', [('line', np.int64), ('position', np.int64),
+                       ('reliability', np.float64), ('wordStart', np.int64),
+                       ('numWords', np.int64)]),
+        ('words', [('line', np.int64), ('position', np.int64),
+                   ('rank', np.int64), ('word', str),
+                   ('spanStart', np.int64), ('spanEnd', np.int64),
+                   ('sentence', np.int64)]),
+        ('sentences', [('line', np.int64), ('text', str),
+                       ('metaTagStart', np.int64),
+                       ('numMetaTags', np.int64)]),
+        ('metaTags', [('sentence', np.int64), ('tag', str),
+                      ('start', np.int64), ('end', np.int64)])
+    ])
+    return OrderedDict(
+        (tableName, OrderedDict(
+            (column, [] if columnType is str else np.zeros(0, dtype=columnType))
+            for column, columnType in columns))
+        for tableName, columns in tableColumns.items())
+
+
+def saveConsensusTables(tables, exportDirectory, exportFormat='npy'):
+    # the export is written to a temporary directory that replaces any
+    # previous export once it is complete
+    if exportFormat == 'parquet' and not parquetAvailable:
+        raise ImportError('pyarrow is required for the parquet export format')
+    parentDirectory = os.path.dirname(os.path.abspath(exportDirectory))
+    os.makedirs(parentDirectory, exist_ok=True)
+    temporaryDirectory = tempfile.mkdtemp(dir=parentDirectory,
+                                          prefix='.columnarExport-')
+    try:
+        for tableName, columns in tables.items():
+            if exportFormat == 'parquet':
+                pyarrow.parquet.write_table(
+                    pyarrow.table(OrderedDict(
+                        (name, pyarrow.array(values, type=pyarrow.string())
+                         if isinstance(values, list) else values)
+                        for name, values in columns.items())),
+                    os.path.join(temporaryDirectory, tableName + '.parquet'))
+            else:
+                tableDirectory = os.path.join(temporaryDirectory, tableName)
+                os.mkdir(tableDirectory)
+                saveColumns(tableDirectory, columns,
+                            numRows=len(next(iter(columns.values()))))
+        with open(os.path.join(temporaryDirectory, 'meta.json'),
+                  'w') as metadataFile:
+            json.dump({
+                'version': columnarExportVersion,
+                'format': exportFormat,
+                'tables': OrderedDict(
+                    (tableName, len(next(iter(columns.values()))))
+                    for tableName, columns in tables.items())
+            }, metadataFile)
+        if os.path.isdir(exportDirectory):
+            shutil.rmtree(exportDirectory)
+        os.rename(temporaryDirectory, exportDirectory)
+    except BaseException:
+        shutil.rmtree(temporaryDirectory, ignore_errors=True)
+        raise
+
+
+def exportConsensusTables(lineGroupColumns, subjectsFrame, exportDirectory,
+                          exportFormat='npy'):
+    tables = buildConsensusTables(lineGroupColumns, subjectsFrame)
+    saveConsensusTables(tables, exportDirectory, exportFormat)
+    return tables
+
+
+def loadExportMetadata(exportDirectory):
+    with open(os.path.join(exportDirectory, 'meta.json')) as metadataFile:
+        return json.load(metadataFile)
+
+
+def loadTable(exportDirectory, tableName, columns=None, mmapMode='r'):
+    # Read the requested columns of a table (all by default). Numeric npy
+    # columns are memory mapped unless mmapMode is None, string columns are
+    # decoded to lists of strings.
+    exportMetadata = loadExportMetadata(exportDirectory)
+    if exportMetadata['format'] == 'parquet':
+        table = pyarrow.parquet.read_table(
+            os.path.join(exportDirectory, tableName + '.parquet'),
+            columns=columns, memory_map=True)
+        return OrderedDict(
+            (name, table.column(name).to_pylist()
+             if pyarrow.types.is_string(table.schema.field(name).type) else
+             table.column(name).to_numpy())
+            for name in table.column_names)
+
+    tableDirectory = os.path.join(exportDirectory, tableName)
+    with open(os.path.join(tableDirectory, 'meta.json')) as metadataFile:
+        columnKinds = json.load(metadataFile)['columns']
+    loadedColumns = OrderedDict()
+    for name in (columnKinds if columns is None else columns):
+        if columnKinds[name] == 'strings':
+            loadedColumns[name] = decodeStrings(
+                np.load(os.path.join(tableDirectory, name + '.data.npy'),
+                        mmap_mode=mmapMode),
+                np.load(os.path.join(tableDirectory, name + '.offsets.npy'),
+                        mmap_mode=mmapMode))
+        else:
+            loadedColumns[name] = np.load(
+                os.path.join(tableDirectory, name + '.npy'),
+                mmap_mode=mmapMode)
+    return loadedColumns
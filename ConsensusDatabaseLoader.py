@@ -0,0 +1,443 @@
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# Loads the merged line grouped consensus (see DcwAggregation.mergeSubjectData)
+# into the Subjects, SubjectLines, LineWords and MetaTags tables that are read
+# by serveConsensus.php.
+#
+# The WordTags table holds the metatags of every transcription of a line,
+# keyed by subject, line and transcription index, so the tags of a subject
+# are a single indexed read (MetaTags has neither a subject nor a line
+# column). Its encoded tags (see encodeWordTags) hold the state of every
+# tagged word span, i.e. the tag that MetaTagHandler::getWordTag would find
+# for the word, and the tag spans themselves.
+#
+# The rows are the same as those of the original MySQL storage step, which
+# inserted one row at a time and read cursor.lastrowid to link every line to
+# its subject and every word to its line. Here the ids are assigned by the
+# client, continuing from the largest id already in each table, so the rows
+# of every table can be buffered and inserted with executemany in batches of
+# batchSize rows. The transaction is committed whenever commitRows rows have
+# been inserted since the last commit.
+#
+# The loader works with any DB-API connection. For SQLite (a local stand-in
+# for MySQL) use openSqliteDatabase, which creates the tables; for
+# mysql.connector pass _placeholder='%s', in which case executemany sends
+# every batch as a single multi-row INSERT.
+
+tableColumns = OrderedDict([
+    ('Subjects', ('id', 'zooniverseId', 'huntingtonId', 'url',
+                  'subjectReliability')),
+    ('SubjectLines', ('id', 'subjectId', 'bestLineIndex', 'meanX1', 'meanX2',
+                      'meanY1', 'meanY2', 'lineReliability')),
+    ('LineWords', ('id', 'lineId', 'wordText', 'position', 'rank',
+                   'transcriptionIndex', 'spanStart', 'spanEnd',
+                   'wordReliability')),
+    ('MetaTags', ('id', 'bestLineIndex', 'transcriptionIndex', 'state',
+                  'start', 'end')),
+    ('WordTags', ('id', 'subjectId', 'lineId', 'transcriptionIndex',
+                  'wordTags'))
+])
+metaTagStateCodes = OrderedDict([('unclear', 'u'), ('insertion', 'i'),
+                                 ('deletion', 'd')])
+metaTagStates = {code: state for state, code in metaTagStateCodes.items()}
+
+# The MySQL schema with the types that SQLite understands. The indices on
+# the foreign keys serve the joins of serveConsensus.php and the deletion of
+# replaced subjects.
+sqliteSchema = [
+    '''CREATE TABLE IF NOT EXISTS Subjects (
+    id INTEGER NOT NULL PRIMARY KEY,
+    zooniverseId INT NOT NULL,
+    huntingtonId CHAR(20) NOT NULL,
+    url VARCHAR(500) NOT NULL,
+    subjectReliability REAL NOT NULL DEFAULT 0.0
+    )''',
+    '''CREATE TABLE IF NOT EXISTS SubjectLines (
+    id INTEGER NOT NULL PRIMARY KEY,
+    subjectId INT NOT NULL,
+    bestLineIndex INT NOT NULL,
+    meanX1 REAL NOT NULL,
+    meanX2 REAL NOT NULL,
+    meanY1 REAL NOT NULL,
+    meanY2 REAL NOT NULL,
+    lineReliability REAL NOT NULL DEFAULT 0.0
+    )''',
+    '''CREATE TABLE IF NOT EXISTS LineWords (
+    id INTEGER NOT NULL PRIMARY KEY,
+    lineId INT NOT NULL,
+    wordText VARCHAR(100),
+    position INT NOT NULL,
+    rank INT NOT NULL,
+    transcriptionIndex INT NOT NULL,
+    spanStart INT NOT NULL,
+    spanEnd INT NOT NULL,
+    wordReliability REAL NOT NULL DEFAULT 0.0
+    )''',
+    '''CREATE TABLE IF NOT EXISTS MetaTags (
+    id INTEGER NOT NULL PRIMARY KEY,
+    bestLineIndex INT NOT NULL,
+    transcriptionIndex INT NOT NULL,
+    state TEXT NOT NULL CHECK (state IN ('unclear', 'insertion', 'deletion')),
+    start INT NOT NULL,
+    end INT NOT NULL,
+    UNIQUE (bestLineIndex, transcriptionIndex, state, start)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS WordTags (
+    id INTEGER NOT NULL PRIMARY KEY,
+    subjectId INT NOT NULL,
+    lineId INT NOT NULL,
+    transcriptionIndex INT NOT NULL,
+    wordTags TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS SubjectLinesSubjectId ON SubjectLines (subjectId)',
+    'CREATE INDEX IF NOT EXISTS LineWordsLineId ON LineWords (lineId)',
+    'CREATE INDEX IF NOT EXISTS SubjectsZooniverseId ON Subjects (zooniverseId)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS WordTagsKey ON WordTags (subjectId, lineId, transcriptionIndex)'
+]
+
+
+def encodeWordTags(wordSpanStates, tagSpans):
+    '''Encode the tags of a transcription of a line.
+
+    wordSpanStates maps the (start, end) span of every tagged word to its
+    state and tagSpans holds the (start, end, state) of every tag, in the
+    order of the MetaTags rows, e.g. '0-5u,6-9u;0-9u'.
+    '''
+    return '{};{}'.format(
+        ','.join('{}-{}{}'.format(start, end, metaTagStateCodes[state])
+                 for (start, end), state in wordSpanStates.items()),
+        ','.join('{}-{}{}'.format(start, end, metaTagStateCodes[state])
+                 for start, end, state in tagSpans))
+
+
+def decodeWordTags(encodedWordTags):
+    # the word span states and the tag spans of encodeWordTags
+    def decodeSpans(encodedSpans):
+        spans = []
+        for encodedSpan in encodedSpans.split(','):
+            if len(encodedSpan) > 0:
+                start, end = encodedSpan[:-1].split('-')
+                spans.append((int(start), int(end),
+                              metaTagStates[encodedSpan[-1]]))
+        return spans
+
+    encodedWordSpans, encodedTagSpans = encodedWordTags.split(';')
+    return ({(start, end): state
+             for start, end, state in decodeSpans(encodedWordSpans)},
+            decodeSpans(encodedTagSpans))
+
+
+def findWordTag(tagSpans, start, end):
+    # MetaTagHandler::getWordTag: the state of the first tag that contains
+    # the word span
+    for tagStart, tagEnd, state in tagSpans:
+        if tagStart <= start and tagEnd >= end:
+            return state
+    return False
+
+
+def openSqliteDatabase(databaseFileName, recreate=False):
+    if recreate and os.path.exists(databaseFileName):
+        os.remove(databaseFileName)
+    connection = sqlite3.connect(databaseFileName)
+    for statement in sqliteSchema:
+        connection.execute(statement)
+    connection.commit()
+    return connection
+
+
+class ConsensusDatabaseLoader():
+
+    def __init__(self, _connection, _batchSize=10000, _commitRows=200000,
+                 _placeholder='?'):
+        self.connection = _connection
+        self.cursor = _connection.cursor()
+        self.batchSize = _batchSize
+        self.commitRows = _commitRows
+        self.placeholder = _placeholder
+        self.insertQueries = {
+            table: 'INSERT INTO {} ({}) VALUES ({})'.format(
+                table, ', '.join(columns),
+                ', '.join([_placeholder] * len(columns)))
+            for table, columns in tableColumns.items()
+        }
+        self.nextIds = {}
+        for table in tableColumns:
+            self.cursor.execute('SELECT MAX(id) FROM {}'.format(table))
+            maxId = self.cursor.fetchone()[0]
+            self.nextIds[table] = 1 if maxId is None else int(maxId) + 1
+        self.pendingRows = {table: [] for table in tableColumns}
+        self.numUncommittedRows = 0
+        # the ids of the Subjects rows that are kept for replaced subjects
+        self.keptSubjectIds = {}
+        self.resetStatistics()
+
+    def resetStatistics(self):
+        self.rowCounts = OrderedDict((table, 0) for table in tableColumns)
+        self.insertTimes = OrderedDict((table, 0.0) for table in tableColumns)
+        self.buildTime = 0.0
+        self.commitTime = 0.0
+        self.numSkippedSubjects = 0
+        self.numUpdatedSubjects = 0
+
+    def addRow(self, table, row):
+        # returns the id assigned to the row
+        rowId = self.nextIds[table]
+        self.nextIds[table] = rowId + 1
+        pendingRows = self.pendingRows[table]
+        pendingRows.append((rowId, ) + row)
+        if len(pendingRows) >= self.batchSize:
+            self.flush(table)
+        return rowId
+
+    def flush(self, table):
+        pendingRows = self.pendingRows[table]
+        if len(pendingRows) == 0:
+            return
+        startTime = time.perf_counter()
+        self.cursor.executemany(self.insertQueries[table], pendingRows)
+        self.insertTimes[table] += time.perf_counter() - startTime
+        self.rowCounts[table] += len(pendingRows)
+        self.numUncommittedRows += len(pendingRows)
+        self.pendingRows[table] = []
+        if self.numUncommittedRows >= self.commitRows:
+            self.commit()
+
+    def commit(self):
+        startTime = time.perf_counter()
+        self.connection.commit()
+        self.commitTime += time.perf_counter() - startTime
+        self.numUncommittedRows = 0
+
+    def finish(self):
+        for table in tableColumns:
+            self.flush(table)
+        self.commit()
+
+    def deleteSubjects(self, zooniverseIds, keepSubjects=False):
+        # remove every row that was loaded for the given subjects, e.g. before
+        # loading their updated consensus. With keepSubjects, the Subjects
+        # rows are kept, and updated in place when the subjects are loaded
+        # again, so a replaced subject keeps its id (which links to it from
+        # the viewer and keys its SubjectDocuments row); see
+        # deleteKeptSubjects for the subjects that are not loaded again.
+        placeholder = self.placeholder
+        for zooniverseId in zooniverseIds:
+            parameters = (int(zooniverseId), )
+            self.cursor.execute(
+                'SELECT DISTINCT SubjectLines.bestLineIndex, LineWords.transcriptionIndex '
+                'FROM Subjects JOIN SubjectLines ON SubjectLines.subjectId = Subjects.id '
+                'JOIN LineWords ON LineWords.lineId = SubjectLines.id '
+                'WHERE Subjects.zooniverseId = {0}'.format(placeholder),
+                parameters)
+            self.cursor.executemany(
+                'DELETE FROM MetaTags WHERE bestLineIndex = {0} AND '
+                'transcriptionIndex = {0}'.format(placeholder),
+                self.cursor.fetchall())
+            self.cursor.execute(
+                'DELETE FROM WordTags WHERE subjectId IN (SELECT id FROM '
+                'Subjects WHERE zooniverseId = {0})'.format(placeholder),
+                parameters)
+            self.cursor.execute(
+                'DELETE FROM LineWords WHERE lineId IN (SELECT SubjectLines.id '
+                'FROM Subjects JOIN SubjectLines ON SubjectLines.subjectId = Subjects.id '
+                'WHERE Subjects.zooniverseId = {0})'.format(placeholder),
+                parameters)
+            self.cursor.execute(
+                'DELETE FROM SubjectLines WHERE subjectId IN (SELECT id FROM '
+                'Subjects WHERE zooniverseId = {0})'.format(placeholder),
+                parameters)
+            if keepSubjects:
+                self.cursor.execute(
+                    'SELECT id FROM Subjects WHERE zooniverseId = {0} '
+                    'ORDER BY id'.format(placeholder), parameters)
+                subjectIds = [row[0] for row in self.cursor.fetchall()]
+                if len(subjectIds) == 0:
+                    continue
+                self.keptSubjectIds[int(zooniverseId)] = subjectIds[0]
+                # there is only one row per subject, unless an older loader
+                # wrote duplicates
+                self.cursor.executemany(
+                    'DELETE FROM Subjects WHERE id = {0}'.format(placeholder),
+                    [(subjectId, ) for subjectId in subjectIds[1:]])
+            else:
+                self.cursor.execute(
+                    'DELETE FROM Subjects WHERE zooniverseId = {0}'.format(
+                        placeholder), parameters)
+
+    def deleteKeptSubjects(self):
+        # the kept Subjects rows of the replaced subjects that were not loaded
+        # again (e.g. since their subject data are missing)
+        self.cursor.executemany(
+            'DELETE FROM Subjects WHERE id = {0}'.format(self.placeholder),
+            [(subjectId, ) for subjectId in self.keptSubjectIds.values()])
+        self.keptSubjectIds = {}
+
+    def updateSubject(self, subjectId, subjectRow):
+        startTime = time.perf_counter()
+        self.cursor.execute(
+            'UPDATE Subjects SET zooniverseId = {0}, huntingtonId = {0}, '
+            'url = {0}, subjectReliability = {0} WHERE id = {0}'.format(
+                self.placeholder), subjectRow + (subjectId, ))
+        self.insertTimes['Subjects'] += time.perf_counter() - startTime
+        self.numUpdatedSubjects += 1
+        return subjectId
+
+    def loadConsensus(self, lineGroupedTranscriptionLineDetails,
+                      replaceSubjects=False):
+        startTime = time.perf_counter()
+        previousDatabaseTime = sum(self.insertTimes.values()) + self.commitTime
+        frame = lineGroupedTranscriptionLineDetails
+        if len(frame) == 0:
+            return self.rowCounts
+        subjectKeys = [int(subjectKey) for subjectKey in frame.index]
+        if replaceSubjects:
+            self.deleteSubjects(sorted(set(subjectKeys)), keepSubjects=True)
+
+        # the subject reliability is the mean reliability of its lines
+        lineReliabilities = [lineWords['reliability']
+                             for lineWords in frame['words']]
+        subjectLineReliabilities = {}
+        for subjectKey, lineReliability in zip(subjectKeys, lineReliabilities):
+            subjectLineReliabilities.setdefault(subjectKey,
+                                                []).append(lineReliability)
+        subjectReliabilities = {
+            subjectKey: np.sum(reliabilities) / float(len(reliabilities))
+            for subjectKey, reliabilities in subjectLineReliabilities.items()
+        }
+
+        addRow = self.addRow
+        keptSubjectIds = self.keptSubjectIds
+        currentSubject = None
+        subjectId = None
+        # Keep a record of the saved metatags
+        savedMetaData = {}
+        for subjectKey, huntingtonId, url, bestLineIndex, x1, x2, y1, y2, lineWords, transcriptionIndices in zip(
+                subjectKeys, frame['huntington_id'].tolist(),
+                frame['url'].tolist(), frame['bestLineIndex'].tolist(),
+                frame['x1'].tolist(), frame['x2'].tolist(),
+                frame['y1'].tolist(), frame['y2'].tolist(), frame['words'],
+                frame['transcriptionIndex']):
+            if subjectKey != currentSubject:
+                # If the subject has changed, insert a new subject entry (or
+                # update the kept entry of a replaced subject)
+                currentSubject = subjectKey
+                if pd.isnull(huntingtonId) or pd.isnull(url):
+                    print('Subject data not found for: ', subjectKey)
+                    self.numSkippedSubjects += 1
+                    subjectId = None
+                elif subjectKey in keptSubjectIds:
+                    subjectId = self.updateSubject(
+                        keptSubjectIds.pop(subjectKey),
+                        (subjectKey, huntingtonId, url,
+                         float(subjectReliabilities[subjectKey])))
+                else:
+                    subjectId = addRow(
+                        'Subjects', (subjectKey, huntingtonId, url,
+                                     float(subjectReliabilities[subjectKey])))
+            if subjectId is None:
+                continue
+
+            # Insert the aggregated line data
+            bestLineIndex = int(bestLineIndex)
+            lineId = addRow('SubjectLines',
+                            (subjectId, bestLineIndex, x1, x2, y1, y2,
+                             float(lineWords['reliability'])))
+
+            # the word spans of every transcription of the line
+            lineWordSpans = OrderedDict()
+            # Loop over word positions in the aggregated line
+            for wordPosition, wordList in enumerate(lineWords['words']):
+                # Loop over words at each position. As in the original
+                # storage step, the transcription index of a word is that of
+                # the transcription with the same rank in the line group and
+                # word reliabilities are not stored.
+                for wordRank, word in enumerate(wordList):
+                    wordTranscriptionIndex = int(transcriptionIndices[wordRank])
+                    addRow('LineWords',
+                           (lineId, word.word[0:99], wordPosition, wordRank,
+                            wordTranscriptionIndex, word.span[0],
+                            word.span[1], 0.0))
+                    lineWordSpans.setdefault(wordTranscriptionIndex,
+                                             []).append(word.span)
+                    # only insert data for each set of metatags once
+                    if len(word.tagStates) > 0 and (
+                            wordTranscriptionIndex,
+                            bestLineIndex) not in savedMetaData:
+                        tagSpans = savedMetaData[(wordTranscriptionIndex,
+                                                  bestLineIndex)] = []
+                        for tag, spans in word.tagStates.items():
+                            for span in spans:
+                                addRow('MetaTags',
+                                       (bestLineIndex, wordTranscriptionIndex,
+                                        tag, span[0], span[1]))
+                                tagSpans.append((span[0], span[1], tag))
+
+            # the tags of the words of every tagged transcription
+            for wordTranscriptionIndex, wordSpans in lineWordSpans.items():
+                tagSpans = savedMetaData.get(
+                    (wordTranscriptionIndex, bestLineIndex))
+                if tagSpans is None:
+                    continue
+                wordSpanStates = OrderedDict()
+                for wordSpan in wordSpans:
+                    wordTag = findWordTag(tagSpans, wordSpan[0], wordSpan[1])
+                    if wordTag is not False:
+                        wordSpanStates.setdefault(
+                            (wordSpan[0], wordSpan[1]), wordTag)
+                addRow('WordTags',
+                       (subjectId, lineId, wordTranscriptionIndex,
+                        encodeWordTags(wordSpanStates, tagSpans)))
+
+        if replaceSubjects:
+            self.deleteKeptSubjects()
+        self.finish()
+        self.buildTime += time.perf_counter() - startTime - (
+            sum(self.insertTimes.values()) + self.commitTime -
+            previousDatabaseTime)
+        return self.rowCounts
+
+    def formatStatistics(self, title='Database load'):
+        totalTime = self.buildTime + sum(
+            self.insertTimes.values()) + self.commitTime
+        reportLines = ['{}: {} rows in {:.3f} s (batches of {}, commit every {} rows)'.format(
+            title, sum(self.rowCounts.values()), totalTime, self.batchSize,
+            self.commitRows)]
+        for table, rowCount in self.rowCounts.items():
+            insertTime = self.insertTimes[table]
+            reportLines.append('  {:<13} {:9d} rows {:8.3f} s {:12.0f} rows/s'.format(
+                table, rowCount, insertTime,
+                rowCount / insertTime if insertTime > 0 else 0.0))
+        reportLines.append('  {:<13} {:>14} {:8.3f} s'.format('build rows', '',
+                                                             self.buildTime))
+        reportLines.append('  {:<13} {:>14} {:8.3f} s'.format('commit', '',
+                                                             self.commitTime))
+        if self.numUpdatedSubjects > 0:
+            reportLines.append('  updated {} replaced subjects in place'.format(
+                self.numUpdatedSubjects))
+        if self.numSkippedSubjects > 0:
+            reportLines.append('  skipped {} subjects without subject data'.format(
+                self.numSkippedSubjects))
+        return '\n'.join(reportLines)
+
+
+def loadConsensusDatabase(lineGroupedTranscriptionLineDetails,
+                          databaseFileName, replaceSubjects=False,
+                          batchSize=10000, commitRows=200000):
+    connection = openSqliteDatabase(databaseFileName,
+                                    recreate=not replaceSubjects)
+    try:
+        databaseLoader = ConsensusDatabaseLoader(connection, batchSize,
+                                                 commitRows)
+        databaseLoader.loadConsensus(lineGroupedTranscriptionLineDetails,
+                                     replaceSubjects)
+        print(databaseLoader.formatStatistics())
+    finally:
+        connection.close()
+    return databaseLoader.rowCounts
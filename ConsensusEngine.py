@@ -0,0 +1,174 @@
+import numpy as np
+
+from MetaTagState import MetaTagState
+from MetaTagTokenizer import MetaTagTokenizer
+from StatefulWord import StatefulWord
+
+# Columnar equivalent of DcwAggregation.aggregateSentences applied to every
+# line group of an export at once.
+#
+# The transcribed sentences are tokenized once (building the StatefulWord of
+# every word as before) into flat arrays of (line group, word position,
+# word id), where words are dictionary encoded to integer ids. Every
+# (line group, word position) pair is a "slot", numbered consecutively
+# within each line group. The consensus is then computed for all slots at
+# once:
+#
+#   - the number of occurrences of every word in its slot comes from a
+#     single np.unique over (slot, word id) keys,
+#   - the word options of a slot are ordered by decreasing occurrence count
+#     and then by transcription order (the order produced by the stable
+#     sort in aggregateSentences), so the first option is the modal word
+#     with ties broken by first occurrence,
+#   - word reliabilities follow computeConsensusWordReliability: -0.25 for
+#     fewer than two options, -0.5 for two differing options and the modal
+#     fraction otherwise,
+#   - line reliabilities are the mean of the word reliabilities clamped to
+#     [0, 1]. The sums are accumulated position by position so that they are
+#     bitwise identical to the sequential sums of aggregateSentences.
+#
+# As in aggregateSentences, a word that consists only of metatags still opens
+# a new (possibly empty) word position when the sentence is longer than all
+# preceding sentences of the line group. Empty positions have a reliability
+# of -0.25 and count towards the line reliability.
+
+
+def tokenizeLineGroups(sentences, lineIds, numLines, metaTagTokenizer=None):
+    # flat word arrays for sentences that are ordered by line group
+    if metaTagTokenizer is None:
+        metaTagTokenizer = MetaTagTokenizer()
+    metaTagState = MetaTagState()
+
+    wordIndex = {}
+    wordIds = []
+    elementLines = []
+    elementPositions = []
+    statefulWords = []
+    numPositions = [0] * numLines
+
+    for lineId, sentence in zip(lineIds, sentences):
+        cleanWords, wordSpans, tagIntervals = metaTagTokenizer.tokenize(
+            sentence)
+        for tag, start, end in tagIntervals:
+            metaTagState.setTag(tag, start, end)
+
+        if '' in cleanWords:
+            wordsAndSpans = [(word, wordSpan) for word, wordSpan in zip(
+                cleanWords, wordSpans) if len(word) > 0]
+        else:
+            wordsAndSpans = list(zip(cleanWords, wordSpans))
+        numWords = len(wordsAndSpans)
+        # every word opens a new position when the preceding non-empty words
+        # fill the positions seen so far, so a trailing metatag-only word
+        # opens one position beyond the last non-empty word
+        if len(cleanWords) > 0:
+            sentencePositions = numWords + (1 if len(cleanWords[-1]) == 0
+                                            else 0)
+            if numPositions[lineId] < sentencePositions:
+                numPositions[lineId] = sentencePositions
+
+        tagStates = metaTagState.getFrozenTags()
+        wordIds.extend([wordIndex.setdefault(word, len(wordIndex))
+                        for word, wordSpan in wordsAndSpans])
+        elementLines.extend([lineId] * numWords)
+        elementPositions.extend(range(numWords))
+        statefulWords.extend([
+            StatefulWord(word, wordSpan, tagStates, sentence)
+            for word, wordSpan in wordsAndSpans
+        ])
+
+        metaTagState.reset()
+
+    return (np.array(wordIds, dtype=np.int64),
+            np.array(elementLines, dtype=np.int64),
+            np.array(elementPositions, dtype=np.int64), statefulWords,
+            np.array(numPositions, dtype=np.int64), len(wordIndex))
+
+
+def computeSlotConsensus(wordIds, slots, numSlots, vocabularySize):
+    '''Order the word options and compute the reliability of every slot.
+
+    Returns the order of the elements (grouped by slot, most frequent word
+    first) and the word reliability of every slot.
+    '''
+    numElements = len(wordIds)
+    slotKeys = slots * max(vocabularySize, 1) + wordIds
+    uniqueKeys, keyInverse, keyCounts = np.unique(
+        slotKeys, return_inverse=True, return_counts=True)
+    elementCounts = keyCounts[keyInverse.reshape(-1)]
+
+    order = np.lexsort((np.arange(numElements), -elementCounts, slots))
+
+    slotSizes = np.bincount(slots, minlength=numSlots)
+    slotUniqueWords = np.bincount(uniqueKeys // max(vocabularySize, 1),
+                                  minlength=numSlots)
+    slotStarts = np.cumsum(slotSizes) - slotSizes
+    slotModalCounts = np.zeros(numSlots, dtype=np.int64)
+    occupied = slotSizes > 0
+    slotModalCounts[occupied] = elementCounts[order[slotStarts[occupied]]]
+
+    wordReliabilities = np.where(
+        slotSizes < 2, -0.25,
+        np.where((slotSizes < 3) & (slotUniqueWords > 1), -0.5,
+                 slotModalCounts / np.maximum(slotSizes, 1).astype(float)))
+    return order, slotSizes, wordReliabilities
+
+
+def computeLineReliabilities(wordReliabilities, lineOffsets, numPositions):
+    clampedReliabilities = np.clip(wordReliabilities, 0.0, 1.0)
+    totals = np.zeros(len(numPositions))
+    for position in range(int(numPositions.max()) if len(numPositions) else 0):
+        lineMask = numPositions > position
+        totals[lineMask] += clampedReliabilities[lineOffsets[lineMask] +
+                                                 position]
+    lineReliabilities = np.zeros(len(numPositions))
+    nonEmpty = numPositions > 0
+    lineReliabilities[nonEmpty] = totals[nonEmpty] / numPositions[nonEmpty]
+    return lineReliabilities
+
+
+def computeLineConsensus(sentences, lineIds, numLines=None,
+                         metaTagTokenizer=None):
+    '''Aggregate the transcribed sentences of many line groups.
+
+    sentences is a sequence of word lists and lineIds gives the line group
+    (0 ... numLines - 1) of each sentence; sentences of a group are
+    aggregated in the order that they appear. Returns one dictionary per line
+    group with the same 'reliability', 'wordReliabilities' and 'words'
+    entries as DcwAggregation.aggregateSentences.
+    '''
+    lineIds = np.asarray(lineIds, dtype=np.int64)
+    if numLines is None:
+        numLines = int(lineIds.max()) + 1 if len(lineIds) else 0
+    sentenceOrder = np.argsort(lineIds, kind='stable')
+    wordIds, elementLines, elementPositions, statefulWords, numPositions, vocabularySize = tokenizeLineGroups(
+        [sentences[iSentence] for iSentence in sentenceOrder],
+        lineIds[sentenceOrder].tolist(), numLines, metaTagTokenizer)
+
+    lineOffsets = np.cumsum(numPositions) - numPositions
+    numSlots = int(numPositions.sum())
+    slots = lineOffsets[elementLines] + elementPositions
+
+    order, slotSizes, wordReliabilities = computeSlotConsensus(
+        wordIds, slots, numSlots, vocabularySize)
+    lineReliabilities = computeLineReliabilities(wordReliabilities,
+                                                 lineOffsets, numPositions)
+
+    sortedWords = [statefulWords[iElement] for iElement in order]
+    slotEnds = np.cumsum(slotSizes).tolist()
+    slotStarts = [0] + slotEnds[:-1]
+    slotWords = [sortedWords[slotStart:slotEnd]
+                 for slotStart, slotEnd in zip(slotStarts, slotEnds)]
+    wordReliabilities = wordReliabilities.tolist()
+
+    aggregatedLines = []
+    for lineOffset, lineNumPositions, lineReliability in zip(
+            lineOffsets.tolist(), numPositions.tolist(),
+            lineReliabilities.tolist()):
+        aggregatedLines.append({
+            'reliability': lineReliability,
+            'wordReliabilities':
+            wordReliabilities[lineOffset:lineOffset + lineNumPositions],
+            'words': slotWords[lineOffset:lineOffset + lineNumPositions]
+        })
+    return aggregatedLines
@@ -0,0 +1,112 @@
+import re as regex
+from collections import OrderedDict
+
+# Post-processing filters applied to the consensus text before it is saved:
+#
+#  - the double word filter collapses a word that is immediately repeated
+#    (e.g. `cheese cheese`) with a single precompiled regular expression,
+#  - the duplicate line filter drops a line whose words repeat those of the
+#    previous line that was kept (lines that are likely to have been
+#    transcribed twice). By default only exact duplicates are dropped: every
+#    word of the cleaned line occurs in the previous line and the lines have
+#    the same number of words. The words of the previous line are held in a
+#    set, so the check is linear in the length of the lines. With a
+#    jaccardThreshold, lines whose sets of words have a Jaccard similarity of
+#    at least the threshold are dropped instead.
+#
+# The previous line is compared before double words are removed from it and
+# carries over from one subject to the next. The lines of a subject are
+# filtered together by filterLines, and the filter counts the lines and words
+# that every filter removed.
+
+doubleWordPattern = regex.compile(r' ([^ ]{2,}) \1 ?')
+
+
+class ConsensusLineFilter():
+
+    def __init__(self, _applyDoubleWordFilter=True, _applyDoubleLineFilter=True,
+                 _jaccardThreshold=None, _verbose=False):
+        self.applyDoubleWordFilter = _applyDoubleWordFilter
+        self.applyDoubleLineFilter = _applyDoubleLineFilter
+        self.jaccardThreshold = _jaccardThreshold
+        self.verbose = _verbose
+        self.resetCounters()
+
+    def resetCounters(self):
+        self.counters = OrderedDict([('lines', 0), ('doubleWordLines', 0),
+                                     ('doubleWordsRemoved', 0),
+                                     ('duplicateLines', 0),
+                                     ('duplicateLineWords', 0)])
+
+    def removeDoubleWords(self, consensusSentence):
+        if not self.applyDoubleWordFilter:
+            return consensusSentence
+        cleanConsensusSentence, numRemoved = doubleWordPattern.subn(
+            lambda match: ' ' + match.group(1) + ' ', consensusSentence)
+        if numRemoved > 0:
+            self.counters['doubleWordLines'] += 1
+            self.counters['doubleWordsRemoved'] += numRemoved
+            if self.verbose:
+                print('Found double word(s) in "{}" => {}'.format(
+                    consensusSentence, cleanConsensusSentence))
+        return cleanConsensusSentence
+
+    def isDuplicate(self, cleanConsensusWords, previousWords, previousWordSet):
+        if self.jaccardThreshold is None:
+            # the number of words of the line that occur in the previous
+            # line must equal the length of the longer line
+            if len(previousWords) > len(cleanConsensusWords):
+                return False
+            numShared = 0
+            for word in cleanConsensusWords:
+                if word in previousWordSet:
+                    numShared += 1
+            return numShared == len(cleanConsensusWords)
+        wordSet = set(cleanConsensusWords)
+        numUnion = len(wordSet | previousWordSet)
+        return numUnion > 0 and len(wordSet & previousWordSet) >= (
+            self.jaccardThreshold * numUnion)
+
+    def filterLines(self, consensusSentencesWords, previousWords=[]):
+        '''Filter the consensus words of consecutive lines.
+
+        Returns the cleaned sentence of every line (None for lines that are
+        dropped as duplicates), the index of the last line that was kept (or
+        None) and the words of the last kept line (previousWords if no line
+        was kept), which are compared with the next line.
+        '''
+        cleanConsensusSentences = []
+        lastKeptIndex = None
+        previousWordSet = set(previousWords)
+        counters = self.counters
+        for lineIndex, consensusSentenceWords in enumerate(
+                consensusSentencesWords):
+            counters['lines'] += 1
+            consensusSentence = ' '.join(consensusSentenceWords)
+            cleanConsensusSentence = self.removeDoubleWords(consensusSentence)
+            cleanConsensusWords = cleanConsensusSentence.split(' ')
+
+            if self.applyDoubleLineFilter and self.isDuplicate(
+                    cleanConsensusWords, previousWords, previousWordSet):
+                counters['duplicateLines'] += 1
+                counters['duplicateLineWords'] += len(consensusSentenceWords)
+                if self.verbose:
+                    print('Found duplicate sentence "{}" == "{}"'.format(
+                        cleanConsensusSentence, ' '.join(previousWords)))
+                cleanConsensusSentences.append(None)
+                continue
+
+            # only update if the current sentence was not a duplicate of the
+            # previous.
+            previousWords = consensusSentenceWords
+            previousWordSet = set(consensusSentenceWords)
+            lastKeptIndex = lineIndex
+            cleanConsensusSentences.append(cleanConsensusSentence)
+        return cleanConsensusSentences, lastKeptIndex, previousWords
+
+    def formatCounters(self, title='Consensus filters'):
+        counters = self.counters
+        return '{}: {} lines, {} double words removed from {} lines, {} duplicate lines ({} words) removed'.format(
+            title, counters['lines'], counters['doubleWordsRemoved'],
+            counters['doubleWordLines'], counters['duplicateLines'],
+            counters['duplicateLineWords'])
@@ -0,0 +1,505 @@
+import asyncio
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+
+import numpy as np
+
+from SubjectDocuments import tableExists, getAllResultsReference, encodeSubjectDocument, loadSubjectDocument, decodeSubjectDocument
+from ReliabilitySampler import ReliabilitySampler, hasReliabilityIndex, getSubjectDataReference
+
+# An asyncio HTTP server for the viewer (index.html) that answers the tasks of
+# serveConsensus.php from the SQLite consensus database (see
+# DcwAggregation.saveConsensusDatabase):
+#
+#   task=getSubjectData&id=...           the document of a subject (see
+#                                        SubjectDocuments)
+#   task=getSampleForReliability&...     random subjects in reliability steps
+#                                        (repeatable with a seed parameter)
+#   task=printReliabilitySample          the consensus text of such a sample
+#
+# Any path is accepted for the tasks, and / serves index.html. The documents
+# are read from the SubjectDocuments table if the database has one and are
+# otherwise assembled for every request as by serveConsensus.php. The gzip
+# compressed documents of the most recently requested subjects are kept in an
+# LRU cache of at most cacheMaxBytes bytes, which is cleared whenever the
+# database is changed by another connection. If the database file is
+# replaced (as by a complete run), the server reconnects to the new file.
+# Whether the SubjectDocuments table and the reliability index are used is
+# decided again after every change. Documents carry an ETag, so a viewer that
+# revalidates them gets 304 responses, and are sent compressed to clients
+# that accept gzip. Subjects are sampled from the reliability index (see
+# ReliabilitySampler) if the database has one.
+#
+# The database is read on the event loop: a cached or stored document is a
+# single primary key lookup.
+
+serverHost = '127.0.0.1'
+serverPort = 8080
+subjectCacheMaxBytes = 64 * 1024**2
+indexFileName = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'index.html')
+
+httpReasons = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request',
+               404: 'Not Found', 405: 'Method Not Allowed'}
+
+
+# Whether an Accept-Encoding header allows a content coding, i.e. the coding
+# (or *, if the coding is not listed) has a q-value above 0.
+
+
+def acceptsEncoding(acceptEncoding, encoding):
+    qValues = {}
+    for codingItem in acceptEncoding.lower().split(','):
+        codingParameters = codingItem.split(';')
+        coding = codingParameters[0].strip()
+        if not coding:
+            continue
+        qValue = 1.0
+        for parameter in codingParameters[1:]:
+            name, separator, value = parameter.partition('=')
+            if name.strip() == 'q':
+                try:
+                    qValue = float(value)
+                except ValueError:
+                    qValue = 0.0
+        qValues[coding] = qValue
+    if encoding in qValues:
+        return qValues[encoding] > 0
+    return qValues.get('*', 0.0) > 0
+
+
+class SubjectCache():
+
+    def __init__(self, _maxBytes=subjectCacheMaxBytes):
+        self.maxBytes = _maxBytes
+        self.entries = OrderedDict()
+        self.numBytes = 0
+        self.numHits = 0
+        self.numMisses = 0
+
+    def get(self, subjectId):
+        entry = self.entries.get(subjectId)
+        if entry is None:
+            self.numMisses += 1
+            return None
+        self.numHits += 1
+        self.entries.move_to_end(subjectId)
+        return entry
+
+    def put(self, subjectId, entry):
+        entrySize = len(entry[0])
+        if entrySize > self.maxBytes:
+            return
+        if subjectId in self.entries:
+            self.numBytes -= len(self.entries.pop(subjectId)[0])
+        self.entries[subjectId] = entry
+        self.numBytes += entrySize
+        while self.numBytes > self.maxBytes:
+            evictedId, evictedEntry = self.entries.popitem(last=False)
+            self.numBytes -= len(evictedEntry[0])
+
+    def clear(self):
+        self.entries.clear()
+        self.numBytes = 0
+
+
+class ConsensusServer():
+
+    def __init__(self, _databaseFileName, _cacheMaxBytes=subjectCacheMaxBytes,
+                 _useDocuments=True):
+        self.databaseFileName = _databaseFileName
+        self.preferDocuments = _useDocuments
+        self.connection = None
+        self.subjectCache = SubjectCache(_cacheMaxBytes)
+        self.numRequests = 0
+        self.connect()
+
+    def close(self):
+        self.connection.close()
+
+    def getFileIdentity(self):
+        # a complete run replaces the database file (see
+        # openSqliteDatabase), which the open connection would never notice
+        fileStat = os.stat(self.databaseFileName)
+        return fileStat.st_ino, fileStat.st_mtime_ns
+
+    def connect(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.fileIdentity = self.getFileIdentity()
+        self.connection = sqlite3.connect(self.databaseFileName,
+                                          check_same_thread=False)
+        self.reliabilitySampler = ReliabilitySampler(self.connection)
+        self.dataVersion = self.getDataVersion()
+        self.refreshTables()
+
+    def refreshTables(self):
+        # the serving tables may have been created (or dropped) since the
+        # server was started
+        self.subjectCache.clear()
+        self.useDocuments = self.preferDocuments and tableExists(
+            self.connection, 'SubjectDocuments')
+        self.useReliabilityIndex = hasReliabilityIndex(self.connection)
+
+    def getDataVersion(self):
+        return self.connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def checkDatabase(self):
+        try:
+            fileIdentity = self.getFileIdentity()
+        except FileNotFoundError:
+            # the database is being replaced, so keep the old one until the
+            # new one exists
+            return
+        if fileIdentity != self.fileIdentity:
+            self.connect()
+            return
+        dataVersion = self.getDataVersion()
+        if dataVersion != self.dataVersion:
+            self.dataVersion = dataVersion
+            self.refreshTables()
+
+    def getSubjectDocument(self, subjectId):
+        # the gzip compressed document of a subject and its ETag, or None
+        self.checkDatabase()
+        entry = self.subjectCache.get(subjectId)
+        if entry is not None:
+            return entry
+        if self.useDocuments:
+            encodedDocument = loadSubjectDocument(self.connection, subjectId)
+        else:
+            document = getAllResultsReference(self.connection, subjectId)
+            encodedDocument = None if document is None else encodeSubjectDocument(
+                document)
+        if encodedDocument is None:
+            return None
+        entry = (encodedDocument,
+                 hashlib.sha1(encodedDocument).hexdigest()[:24])
+        self.subjectCache.put(subjectId, entry)
+        return entry
+
+    def getSampleForReliability(self, numSamples, numSteps, seed=None):
+        # SubjectSelector::getSubjectData
+        self.checkDatabase()
+        if self.useReliabilityIndex:
+            return self.reliabilitySampler.getSubjectData(numSamples, numSteps,
+                                                          seed)
+        return getSubjectDataReference(self.connection, numSamples, numSteps)
+
+    def getConsensusText(self, subjectId):
+        # ConsensusTextGenerator::printConsensusText
+        entry = self.getSubjectDocument(subjectId)
+        if entry is None:
+            return ''
+        document = decodeSubjectDocument(entry[0])
+        consensusText = '<br/>'.join([
+            ' '.join([wordOptions[0] for wordOptions in lineDatum['words']])
+            for lineDatum in document['lineData']
+        ])
+        return 'ID: {} (Reliability : {})<br/><br/>{}<hr/>'.format(
+            document['subjectData']['huntingtonId'],
+            document['subjectData']['reliability'], consensusText)
+
+    def printReliabilitySample(self, numSamples=2, numSteps=10):
+        # ReliabilitySamplePrinter::printConsensusTexts
+        return ''.join([
+            self.getConsensusText(exampleDatum['id'])
+            for subjectDatum in self.getSampleForReliability(numSamples,
+                                                             numSteps)
+            for exampleDatum in subjectDatum['exampleData']
+        ])
+
+    def handleRequest(self, method, target, headers):
+        # the status, headers and body of the response to a request
+        if method not in ('GET', 'HEAD'):
+            return 405, {}, b''
+        url = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        task = query.get('task')
+        if task is None:
+            if url.path in ('/', '/index.html'):
+                with open(indexFileName, 'rb') as indexFile:
+                    return 200, {'Content-Type': 'text/html; charset=utf-8'
+                                 }, indexFile.read()
+            return 404, {}, b''
+        try:
+            if task == 'getSubjectData':
+                return self.handleSubjectRequest(int(query['id']), headers)
+            if task == 'getSampleForReliability':
+                return 200, {
+                    'Content-Type': 'application/json; charset=utf-8',
+                    'Cache-Control': 'no-store'
+                }, json.dumps(self.getSampleForReliability(
+                    int(query['numSamples']), int(query['numSteps']),
+                    int(query['seed']) if 'seed' in query else None)
+                ).encode('utf-8')
+            if task == 'printReliabilitySample':
+                return 200, {
+                    'Content-Type': 'text/html; charset=utf-8',
+                    'Cache-Control': 'no-store'
+                }, self.printReliabilitySample().encode('utf-8')
+        except (KeyError, ValueError):
+            return 400, {}, b''
+        return 404, {}, b''
+
+    def handleSubjectRequest(self, subjectId, headers):
+        entry = self.getSubjectDocument(subjectId)
+        if entry is None:
+            return 404, {'Content-Type': 'application/json; charset=utf-8'
+                         }, b'null'
+        encodedDocument, documentHash = entry
+        acceptsGzip = acceptsEncoding(headers.get('accept-encoding', ''),
+                                      'gzip')
+        etag = '"{}{}"'.format(documentHash, '-gzip' if acceptsGzip else '')
+        responseHeaders = {
+            'Content-Type': 'application/json; charset=utf-8',
+            'ETag': etag,
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding'
+        }
+        if etag in [tag.strip() for tag in headers.get('if-none-match',
+                                                       '').split(',')]:
+            return 304, responseHeaders, b''
+        if acceptsGzip:
+            responseHeaders['Content-Encoding'] = 'gzip'
+            return 200, responseHeaders, encodedDocument
+        return 200, responseHeaders, gzip.decompress(encodedDocument)
+
+    async def handleConnection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    requestHead = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        ConnectionError):
+                    break
+                requestLines = requestHead.decode('latin-1').split('\r\n')
+                try:
+                    method, target, version = requestLines[0].split(' ')
+                except ValueError:
+                    break
+                headers = {}
+                for headerLine in requestLines[1:]:
+                    if ':' in headerLine:
+                        name, value = headerLine.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                contentLength = int(headers.get('content-length', 0))
+                if contentLength > 0:
+                    await reader.readexactly(contentLength)
+
+                self.numRequests += 1
+                status, responseHeaders, body = self.handleRequest(
+                    method, target, headers)
+                keepAlive = headers.get('connection', '').lower() != 'close' and (
+                    version == 'HTTP/1.1' or
+                    headers.get('connection', '').lower() == 'keep-alive')
+                responseHeaders['Content-Length'] = str(len(body))
+                responseHeaders['Connection'] = 'keep-alive' if keepAlive else 'close'
+                writer.write(''.join(
+                    ['HTTP/1.1 {} {}\r\n'.format(status, httpReasons[status])] +
+                    ['{}: {}\r\n'.format(name, value)
+                     for name, value in responseHeaders.items()] +
+                    ['\r\n']).encode('latin-1'))
+                if method != 'HEAD':
+                    writer.write(body)
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host=serverHost, port=serverPort):
+        return await asyncio.start_server(self.handleConnection, host, port)
+
+
+def serve(databaseFileName, host=serverHost, port=serverPort):
+    async def run():
+        consensusServer = ConsensusServer(databaseFileName)
+        server = await consensusServer.start(host, int(port))
+        print('Serving {} on http://{}:{}/'.format(databaseFileName, host,
+                                                  port))
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
+
+
+def startServerThread(consensusServer, host=serverHost, port=0):
+    # run the server on its own event loop in a daemon thread; returns the
+    # loop and the bound port
+    loop = asyncio.new_event_loop()
+    serverStarted = threading.Event()
+    boundPort = []
+
+    def run():
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(consensusServer.start(host, port))
+        boundPort.append(server.sockets[0].getsockname()[1])
+        serverStarted.set()
+        loop.run_forever()
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+
+    threading.Thread(target=run, daemon=True).start()
+    serverStarted.wait()
+    return loop, boundPort[0]
+
+
+async def readResponse(reader):
+    responseHead = await reader.readuntil(b'\r\n\r\n')
+    responseLines = responseHead.decode('latin-1').split('\r\n')
+    status = int(responseLines[0].split(' ')[1])
+    headers = {}
+    for headerLine in responseLines[1:]:
+        if ':' in headerLine:
+            name, value = headerLine.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, headers, body
+
+
+async def runLoadTest(host, port, targets, concurrency=16, acceptGzip=True):
+    '''Request the targets (paths with queries) over concurrency keep-alive
+    connections. Returns the latency percentiles, the throughput and the
+    number of responses of every status.'''
+    latencies = []
+    statusCounts = {}
+    targetIndices = itertools.count()
+    requestHeaders = 'Host: {}:{}\r\n{}\r\n'.format(
+        host, port, 'Accept-Encoding: gzip\r\n' if acceptGzip else '')
+
+    async def requestTargets():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for targetIndex in targetIndices:
+                if targetIndex >= len(targets):
+                    break
+                startTime = time.perf_counter()
+                writer.write('GET {} HTTP/1.1\r\n{}'.format(
+                    targets[targetIndex], requestHeaders).encode('latin-1'))
+                status, headers, body = await readResponse(reader)
+                latencies.append(time.perf_counter() - startTime)
+                statusCounts[status] = statusCounts.get(status, 0) + 1
+        finally:
+            writer.close()
+
+    startTime = time.perf_counter()
+    await asyncio.gather(*[requestTargets() for iConnection in range(
+        min(concurrency, max(len(targets), 1)))])
+    elapsedTime = time.perf_counter() - startTime
+    return {
+        'numRequests': len(latencies),
+        'p50': float(np.percentile(latencies, 50)) if latencies else 0.0,
+        'p99': float(np.percentile(latencies, 99)) if latencies else 0.0,
+        'requestsPerSecond': len(latencies) / elapsedTime,
+        'statusCounts': statusCounts
+    }
+
+
+def makeSubjectTargets(subjectIds, numRequests, seed=0):
+    # getSubjectData requests with a skewed (Zipf) popularity of the subjects
+    rng = np.random.RandomState(seed)
+    popularityOrder = rng.permutation(len(subjectIds))
+    ranks = (rng.zipf(1.2, numRequests) - 1) % len(subjectIds)
+    return ['/serveConsensus.php?task=getSubjectData&id={}'.format(
+        subjectIds[popularityOrder[rank]]) for rank in ranks.tolist()]
+
+
+def benchmark(databaseFileName, numRequests=5000, concurrency=16):
+    numRequests = int(numRequests)
+    concurrency = int(concurrency)
+    connection = sqlite3.connect(databaseFileName)
+    subjectIds = [row[0] for row in connection.execute(
+        'SELECT id FROM Subjects ORDER BY id')]
+    connection.close()
+    targets = makeSubjectTargets(subjectIds, numRequests)
+
+    configurations = [('per request', False, 0),
+                      ('documents', True, 0),
+                      ('documents, LRU', True, subjectCacheMaxBytes)]
+    responses = {}
+    for label, useDocuments, cacheMaxBytes in configurations:
+        consensusServer = ConsensusServer(databaseFileName, cacheMaxBytes,
+                                          useDocuments)
+        if useDocuments and not consensusServer.useDocuments:
+            print('{} has no SubjectDocuments table'.format(databaseFileName))
+            consensusServer.close()
+            continue
+        loop, port = startServerThread(consensusServer)
+        result = asyncio.run(runLoadTest(serverHost, port, targets,
+                                         concurrency))
+        cache = consensusServer.subjectCache
+        print('{:<16} {:6d} requests: p50 {:.3f} ms, p99 {:.3f} ms, {:.0f} requests/s{}'.format(
+            label + ':', result['numRequests'], 1e3 * result['p50'],
+            1e3 * result['p99'], result['requestsPerSecond'],
+            ', cache hit rate {:.3f}'.format(
+                cache.numHits / float(cache.numHits + cache.numMisses))
+            if cacheMaxBytes > 0 else ''))
+
+        async def fetchDocuments():
+            reader, writer = await asyncio.open_connection(serverHost, port)
+            documents = []
+            for subjectId in subjectIds:
+                writer.write('GET /serveConsensus.php?task=getSubjectData&id={} HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n'.format(
+                    subjectId).encode('latin-1'))
+                documents.append(await readResponse(reader))
+            # revalidate the last document
+            writer.write('GET /serveConsensus.php?task=getSubjectData&id={} HTTP/1.1\r\nAccept-Encoding: gzip\r\nIf-None-Match: {}\r\n\r\n'.format(
+                subjectIds[-1], documents[-1][1]['etag']).encode('latin-1'))
+            revalidation = await readResponse(reader)
+            writer.close()
+            return documents, revalidation
+
+        responses[label] = asyncio.run(fetchDocuments())
+        loop.call_soon_threadsafe(loop.stop)
+        consensusServer.close()
+
+    numMismatches = 0
+    referenceDocuments = responses['per request'][0]
+    for label, (documents, revalidation) in responses.items():
+        for referenceDocument, document in zip(referenceDocuments, documents):
+            if document[0] != 200 or decodeSubjectDocument(
+                    document[2]) != decodeSubjectDocument(referenceDocument[2]):
+                numMismatches += 1
+        if len(subjectIds) > 0 and revalidation[0] != 304:
+            print('{}: no 304 response to a revalidation'.format(label))
+            numMismatches += 1
+    print('Mismatched documents: {}'.format(numMismatches))
+    return numMismatches
+
+
+def loadTest(databaseFileName, host=serverHost, port=serverPort,
+             numRequests=5000, concurrency=16):
+    # load test a server running in another process (see serve), whose
+    # client and server do not share an interpreter
+    connection = sqlite3.connect(databaseFileName)
+    subjectIds = [row[0] for row in connection.execute(
+        'SELECT id FROM Subjects ORDER BY id')]
+    connection.close()
+    result = asyncio.run(runLoadTest(
+        host, int(port), makeSubjectTargets(subjectIds, int(numRequests)),
+        int(concurrency)))
+    print('{} requests: p50 {:.3f} ms, p99 {:.3f} ms, {:.0f} requests/s, statuses {}'.format(
+        result['numRequests'], 1e3 * result['p50'], 1e3 * result['p99'],
+        result['requestsPerSecond'], result['statusCounts']))
+    return result
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        sys.exit(1 if benchmark(*sys.argv[2:]) > 0 else 0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'loadtest':
+        loadTest(*sys.argv[2:])
+        sys.exit(0)
+    serve(*sys.argv[1:])
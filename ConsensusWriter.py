@@ -0,0 +1,118 @@
+import gzip
+import io
+import time
+
+# zstd compression is available when the zstandard package is installed
+try:
+    import zstandard
+    zstdAvailable = True
+except ImportError:
+    zstdAvailable = False
+
+# Writes the linewise and subjectwise consensus files in a single pass over
+# formatted subjects (see DcwAggregation.formatSubjectConsensus), which may be
+# produced lazily, e.g. by a streaming pipeline.
+#
+# The lines and records of consecutive subjects are collected and written as
+# one block of UTF-8 bytes whenever bufferSize characters have accumulated,
+# so the (binary) files see a few large writes rather than text writes for
+# every subject. Both files may be gzip or zstd compressed; the uncompressed
+# content is identical in every case.
+# Subjectwise records are separated by '"\n' (there is none after the last
+# record).
+
+compressionSuffixes = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+gzipCompressLevel = 6
+
+
+def getCompressedFileName(fileName, compression=None):
+    return fileName + compressionSuffixes[compression]
+
+
+def openConsensusFile(fileName, mode='r', compression=None):
+    # Binary ('rb', 'wb') or UTF-8 text ('r', 'w') file object for a
+    # (compressed) consensus file. Only '\n' ends a line of a text file and
+    # no newlines are translated.
+    binaryMode = mode.rstrip('tb') + 'b'
+    if compression is None:
+        consensusFile = open(fileName, binaryMode)
+    elif compression == 'gzip':
+        consensusFile = gzip.open(fileName, binaryMode,
+                                  compresslevel=gzipCompressLevel)
+    elif compression == 'zstd':
+        if not zstdAvailable:
+            raise ImportError('zstandard is required for zstd compression')
+        consensusFile = zstandard.open(fileName, binaryMode)
+    else:
+        raise ValueError('Unknown compression: {}'.format(compression))
+    if mode.endswith('b'):
+        return consensusFile
+    return io.TextIOWrapper(consensusFile, encoding='utf-8', newline='\n')
+
+
+class ConsensusWriter():
+
+    def __init__(self, _aggregatedDataCsvFileName,
+                 _aggregatedDataSubjectWiseCsvFileName, _compression=None,
+                 _bufferSize=1 << 20):
+        self.compression = _compression
+        self.bufferSize = _bufferSize
+        self.aggregatedDataFile = openConsensusFile(
+            _aggregatedDataCsvFileName, 'wb', _compression)
+        try:
+            self.aggregatedDataSubjectWiseFile = openConsensusFile(
+                _aggregatedDataSubjectWiseCsvFileName, 'wb', _compression)
+        except BaseException:
+            self.aggregatedDataFile.close()
+            raise
+        self.linewiseChunks = []
+        self.subjectWiseChunks = []
+        self.numBufferedCharacters = 0
+        self.numSubjects = 0
+        self.numLines = 0
+        self.writeTime = 0.0
+        # the words of the last unfiltered line of every subject
+        self.lastSubjectWords = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def writeSubject(self, subject, linewiseLines, subjectWiseRecord,
+                     lastConsensusSentenceWords):
+        if self.numSubjects > 0:
+            self.subjectWiseChunks.append('"\n')
+        self.subjectWiseChunks.append(subjectWiseRecord)
+        self.linewiseChunks.extend(linewiseLines)
+        self.numSubjects += 1
+        self.numLines += len(linewiseLines)
+        self.lastSubjectWords.append((subject, lastConsensusSentenceWords[1]))
+        self.numBufferedCharacters += len(subjectWiseRecord) + sum(
+            [len(line) for line in linewiseLines])
+        if self.numBufferedCharacters >= self.bufferSize:
+            self.flush()
+
+    def writeSubjects(self, subjectConsensus):
+        for formattedSubject in subjectConsensus:
+            self.writeSubject(*formattedSubject)
+        return self.lastSubjectWords
+
+    def flush(self):
+        startTime = time.perf_counter()
+        self.aggregatedDataFile.write(''.join(
+            self.linewiseChunks).encode('utf-8'))
+        self.aggregatedDataSubjectWiseFile.write(''.join(
+            self.subjectWiseChunks).encode('utf-8'))
+        self.linewiseChunks = []
+        self.subjectWiseChunks = []
+        self.numBufferedCharacters = 0
+        self.writeTime += time.perf_counter() - startTime
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.aggregatedDataFile.close()
+            self.aggregatedDataSubjectWiseFile.close()
@@ -7,21 +7,36 @@ import matplotlib.pyplot as mplplot
 import dateutil.parser
 import pickle
 import sys
-import re as regex
-import copy
 import itertools
-import functools
 import gc
 import os
 import glob
+import shutil
+import heapq
+import tempfile
+import time
+import traceback
+import contextlib
+import concurrent.futures
 from collections import Counter, OrderedDict
 
-# Classes to encapsulate single lines of text and multiple lines of text
-from TextLine import TextLine
-from TelegramLines import TelegramLines
-from LineMatcher import LineMatcher
+from LineGrouping import computeBestLineIndices
 from MetaTagState import MetaTagState
 from StatefulWord import StatefulWord
+from ClassificationRowDecoder import ClassificationRowDecoder
+from MetaTagTokenizer import MetaTagTokenizer
+from ConsensusEngine import computeLineConsensus
+from StageCache import StageCache, stageCacheVersion, hashFile, saveColumns, loadColumns, encodeLineDetails, decodeLineDetails, encodeLineGroups, decodeLineGroups
+from StageCache import lineDetailIndexColumns, takeRows, concatenateRows, takeLineGroupRows, concatenateLineGroups
+from ConsensusDatabaseLoader import ConsensusDatabaseLoader, openSqliteDatabase
+from ColumnarExport import exportConsensusTables
+from ConsensusFilters import ConsensusLineFilter
+from ConsensusWriter import ConsensusWriter, openConsensusFile, getCompressedFileName
+from SubjectIndex import loadSubjectIndex
+from BoxConsensus import makeBoxesFrame, aggregateBoxes, encodeAggregatedBoxes, decodeAggregatedBoxes, storeBoxConsensus
+from LineBoxIndex import buildLineBoxIndex, storeLineBoxIndex
+from SubjectDocuments import storeSubjectDocuments
+from ReliabilitySampler import storeReliabilityIndex, reliabilityBucketCounts
 
 verbose = True
 extraVerbose = False
@@ -34,21 +49,77 @@ if verbose:
 
 # ## Globally relevant variables
 
-saveIdentifiedLineDetails = True  # Need to do this to recompute for every codebook
 applyDoubleLineFix = False
 applyDoubleWordFilter = True
 applyDoubleLineFilter = True
+# Drop lines whose words have at least this Jaccard similarity to those of
+# the previous line instead of exact duplicates only (None)
+duplicateLineJaccardThreshold = None
+# Stream subjects through the pipeline in batches instead of loading the
+# whole export (subjects are then written in order of completion)
+streamingIngest = False
+streamingSubjectsPerBatch = 500
+streamingMaxBufferedRecords = 200000
+# Directory of the temporary files of subjects spilled to disk by streaming
+# ingest (None uses the system temporary directory)
+streamingSpillDirectory = None
 classificationBaseDirectory = '/Users/hughdickinson/Google Drive/classifications'
 consensusBaseDirectory = '/Users/hughdickinson/Google Drive/consensus/testing'
 databaseNamePattern = 'dcwConsensus_{mss_label}'
+# Load the consensus into an SQLite database (named after databaseNamePattern)
+# with the tables of the MySQL database read by serveConsensus.php
+saveConsensusDatabase = False
+databaseBatchSize = 10000
+databaseCommitRows = 200000
+# Also store the getSubjectData response of every subject of the database,
+# ready to serve (see SubjectDocuments)
+saveSubjectDocuments = False
+# Also index the subjects by reliability for the sampling of the reliability
+# explorer (see ReliabilitySampler)
+saveReliabilityIndex = False
+# Also export the complete consensus (word alternatives, spans, reliabilities
+# and metatags) as columnar tables (see ColumnarExport), as 'npy' arrays or
+# 'parquet' files
+saveColumnarExport = False
+columnarExportDirectoryPattern = 'decoding-the-civil-war-consensus-columnar_{mss_label}'
+columnarExportFormat = 'npy'
 aggregatedDataFileNamePattern = 'decoding-the-civil-war-aggregated_{mss_label}.txt'
 # 'decoding-the-civil-war-consensus-linewise.csv'
 aggregatedDataCsvFileNamePattern = 'decoding-the-civil-war-consensus-linewise_{mss_label}.csv'
 # 'decoding-the-civil-war-consensus-subjectwise.csv'
 aggregatedDataSubjectWiseCsvFileNamePattern = 'decoding-the-civil-war-consensus-subjectwise_{mss_label}_withBreaks.csv'
-# 'dataWithLineIDs_subset.pkl'
-identifiedLineFilePathPattern = 'dataWithLineIDs_subset_{mss_label}.pkl'
+# Compress the linewise and subjectwise files (None, 'gzip' or 'zstd'), which
+# appends .gz or .zst to their names
+outputCompression = None
+outputBufferSize = 1 << 20
+# Cache the outputs of ingest, line grouping and sentence aggregation (see
+# StageCache), so that re-runs only recompute stages whose inputs changed
+useStageCache = True
+stageCacheDirectory = 'stageCache'
+stageCacheMaxBytes = 4 * 1024**3
+# Only process the classifications that were added to an export since the
+# previous run and patch the existing output files
+incrementalMode = False
+incrementalStateDirectory = 'incrementalState'
+subjectDataFileName = 'decoding-the-civil-war-subjects-7-24-17.csv'
+# The subject data are parsed once and persisted here (see SubjectIndex)
+subjectIndexDirectory = 'subjectIndex'
+# Aggregate the telegram boxes (task T2) from the same pass over the export
+# and store them, with the lines of every box, in the consensus database
+aggregateTelegramBoxes = False
+boxOverlapThreshold = 0.7
+# Number of manuscripts processed in parallel (None uses every core)
+numManuscriptWorkers = None
+manuscriptLogDirectory = '.'
+# Number of worker processes that share the subjects of a single export
+numSubjectShards = 1
+# Number of processes that aggregate the shards of an export at once (None
+# uses every core, or the share of the cores of every manuscript worker in
+# runManuscripts)
+numShardWorkers = None
+manuscriptLogFileNamePattern = 'dcwAggregation_{mss_label}.log'
 liveDate = dateutil.parser.parse("2016-06-20T00:00:00.00Z")
+metaTagTokenizer = MetaTagTokenizer()
 
 
 def loadSubjectData(subjectDataFileName):
@@ -76,66 +147,154 @@ def loadSubjectData(subjectDataFileName):
 
 def loadTelegrams(sampleDataFileName):
 
+    telegrams, nTelegramsParsed, boxesFrame = loadClassifications(
+        sampleDataFileName)
+    return telegrams, nTelegramsParsed
+
+# Single pass over an export that extracts the transcribed lines of every
+# telegram and, with extractBoxes, the telegram boxes that were marked (as a
+# frame of box records, see BoxConsensus.makeBoxesFrame; None otherwise).
+
+
+def loadClassifications(sampleDataFileName, extractBoxes=False):
+
     telegrams = {}
+    boxRecords = []
 
     with open(sampleDataFileName) as csvfile:
-        parsedCsv = csv.DictReader(csvfile)
+        parsedCsv = csv.reader(csvfile)
+        rowDecoder = ClassificationRowDecoder(next(parsedCsv), liveDate,
+                                              _extractBoxes=extractBoxes)
         nTelegramsParsed = 0
-        for recordIndex, record in enumerate(parsedCsv):
-            done = False
-            recordIsTelegram = True
-
-            # check the date that the classification was made
-            if "metadata" in record:
-                parsedMetadata = json.loads(record["metadata"])
-                parsedDate = dateutil.parser.parse(
-                    parsedMetadata['started_at'])
-                # skip "testing" data before the site went live
-                if parsedDate < liveDate:
-                    continue
-
-            # parse the annotations and the subject data
-            parsedAnnotations = json.loads(record["annotations"])
-            parsedSubjectData = json.loads(record["subject_data"])
-
-            # initialize container for transcribed lines
-            transcribedLines = TelegramLines()
-
-            # loop over tasks in the annotation
-            for task in parsedAnnotations:
-                # Check if the current record is for a telegram (tasks may be stored out of order, so
-                # some tasks may be processed before non-telegrams are caught -
-                # inefficient but unavoidable?)
-                if task['task'] == "T1" and (
-                        task['value'] is None
-                        or not task['value'].startswith("Telegram")):
-                    recordIsTelegram = False
-                    break
-
-                # Process transcriptions of text lines
-                if task['task'].startswith("T12") and len(task['value']) > 0:
-                    # process the lines that were transcribed for this task
-                    for taskValueItem in task['value']:
-                        transcribedLine = TextLine(
-                            taskValueItem['x1'], taskValueItem['y1'],
-                            taskValueItem['x2'], taskValueItem['y2'],
-                            taskValueItem['details'][0]['value'])
-                        transcribedLines.addLine(transcribedLine)
+        for recordIndex, row in enumerate(parsedCsv):
+            transcribedLines, boxes = rowDecoder.decodeRecord(row)
+            if boxes:
+                subjectKey = rowDecoder.getSubjectKey(row)
+                for box in boxes:
+                    boxRecords.append((subjectKey, ) + box)
 
             # if the transcribed lines of a telegram have been processed then update the
             # list of independent transcriptions for this subject
-            if recordIsTelegram:
+            if transcribedLines is not None:
                 nTelegramsParsed += 1
-                if int(record['subject_ids']) in telegrams:
-                    telegrams[int(record['subject_ids'])].append(
+                subjectKey = rowDecoder.getSubjectKey(row)
+                if subjectKey in telegrams:
+                    telegrams[subjectKey].append(
                         (recordIndex, transcribedLines))
                 else:
                     telegrams.update({
-                        int(record['subject_ids']): [(recordIndex,
-                                                      transcribedLines)]
+                        subjectKey: [(recordIndex, transcribedLines)]
                     })
 
-    return telegrams, nTelegramsParsed
+    if verbose:
+        print(rowDecoder.formatStageTimes())
+
+    return telegrams, nTelegramsParsed, makeBoxesFrame(
+        boxRecords) if extractBoxes else None
+
+# Streaming alternative to loadTelegrams for exports that are too large to
+# hold in memory. A cheap first pass over the subject_ids column finds the
+# last record of every subject, so that the second pass can hand a subject on
+# as soon as all of its records have been parsed. Batches of complete
+# subjects are yielded as dictionaries with the same layout as the output of
+# loadTelegrams (in order of completion, rather than subject order).
+# If too many records of incomplete subjects accumulate, they are written to
+# disk as chunks sorted by subject and merged back after the export has been
+# read, so that memory use is bounded by maxBufferedRecords and the batch
+# size rather than by the size of the export.
+
+
+def findLastRecordIndices(sampleDataFileName):
+    lastRecordIndices = {}
+    with open(sampleDataFileName) as csvfile:
+        parsedCsv = csv.reader(csvfile)
+        subjectColumn = next(parsedCsv).index('subject_ids')
+        for recordIndex, row in enumerate(parsedCsv):
+            lastRecordIndices[int(row[subjectColumn])] = recordIndex
+    return lastRecordIndices
+
+
+def spillTelegramChunk(bufferedTelegrams, spillDirectory):
+    spillFile = tempfile.NamedTemporaryFile(
+        mode='wb', suffix='.pkl', dir=spillDirectory, delete=False)
+    with spillFile:
+        for subjectKey in sorted(bufferedTelegrams):
+            for recordIndex, transcribedLines in bufferedTelegrams[subjectKey]:
+                pickle.dump((subjectKey, recordIndex, transcribedLines),
+                            spillFile, protocol=pickle.HIGHEST_PROTOCOL)
+    return spillFile.name
+
+
+def readTelegramChunk(spillFileName):
+    with open(spillFileName, 'rb') as spillFile:
+        while True:
+            try:
+                yield pickle.load(spillFile)
+            except EOFError:
+                break
+
+
+def iterTelegramBatches(sampleDataFileName, subjectsPerBatch=500,
+                        maxBufferedRecords=200000, spillDirectory=None):
+    lastRecordIndices = findLastRecordIndices(sampleDataFileName)
+
+    bufferedTelegrams = {}
+    numBufferedRecords = 0
+    spilledSubjects = set()
+    spillFileNames = []
+    batch = {}
+
+    with open(sampleDataFileName) as csvfile:
+        parsedCsv = csv.reader(csvfile)
+        rowDecoder = ClassificationRowDecoder(next(parsedCsv), liveDate)
+        for recordIndex, row in enumerate(parsedCsv):
+            subjectKey = rowDecoder.getSubjectKey(row)
+            transcribedLines = rowDecoder.decode(row)
+            if transcribedLines is not None:
+                bufferedTelegrams.setdefault(subjectKey, []).append(
+                    (recordIndex, transcribedLines))
+                numBufferedRecords += 1
+
+            if recordIndex == lastRecordIndices[subjectKey]:
+                # subjects with records on disk are completed by the merge
+                if subjectKey in bufferedTelegrams and subjectKey not in spilledSubjects:
+                    transcriptions = bufferedTelegrams.pop(subjectKey)
+                    numBufferedRecords -= len(transcriptions)
+                    batch[subjectKey] = transcriptions
+                    if len(batch) >= subjectsPerBatch:
+                        yield batch
+                        batch = {}
+
+            if numBufferedRecords > maxBufferedRecords:
+                spillFileNames.append(spillTelegramChunk(
+                    bufferedTelegrams, spillDirectory))
+                spilledSubjects.update(bufferedTelegrams)
+                bufferedTelegrams = {}
+                numBufferedRecords = 0
+
+    if spillFileNames:
+        spillFileNames.append(spillTelegramChunk(
+            bufferedTelegrams, spillDirectory))
+        bufferedTelegrams = {}
+        try:
+            mergedRecords = heapq.merge(
+                *[readTelegramChunk(spillFileName)
+                  for spillFileName in spillFileNames],
+                key=lambda spilledRecord: spilledRecord[:2])
+            for subjectKey, subjectRecords in itertools.groupby(
+                    mergedRecords, key=lambda spilledRecord: spilledRecord[0]):
+                batch[subjectKey] = [(recordIndex, transcribedLines)
+                                     for _, recordIndex, transcribedLines in subjectRecords]
+                if len(batch) >= subjectsPerBatch:
+                    yield batch
+                    batch = {}
+        finally:
+            for spillFileName in spillFileNames:
+                os.remove(spillFileName)
+
+    batch.update(bufferedTelegrams)
+    if batch:
+        yield batch
 
 # Cast parsed data into structures that enable "straightfoward"
 # aggregation analysis
@@ -144,7 +303,21 @@ def loadTelegrams(sampleDataFileName):
 def processLoadedTelegrams(telegrams):
 
     transcriptionLineStats = {}
-    transcriptionLineDetails = []
+    # the columns of the line details, read directly from the coordinate
+    # arrays of every transcription
+    transcriptionLineDetails = OrderedDict(
+        (column, []) for column in ['subjectKey', 'transcriptionIndex',
+                                    'numLines', 'startedAt', 'x1', 'y1', 'x2',
+                                    'y2', 'words'])
+    subjectKeys = transcriptionLineDetails['subjectKey']
+    transcriptionIndices = transcriptionLineDetails['transcriptionIndex']
+    lineCounts = transcriptionLineDetails['numLines']
+    startTimes = transcriptionLineDetails['startedAt']
+    x1s = transcriptionLineDetails['x1']
+    y1s = transcriptionLineDetails['y1']
+    x2s = transcriptionLineDetails['x2']
+    y2s = transcriptionLineDetails['y2']
+    lineWords = transcriptionLineDetails['words']
     # loop over distinct subjects (currently individual telegram-type pages,
     # codebook handling to be implemented)
     for key, transcriptions in telegrams.items():
@@ -161,19 +334,16 @@ def processLoadedTelegrams(telegrams):
             maxLines = numLines if numLines > maxLines else maxLines
             minLines = numLines if numLines < minLines else minLines
             # process the lines of the individual transcriptions of a subject
-            for textLine in transcription.getLines():
-                # Add a dictionary describing the current line
-                lineDescription = {
-                    'subjectKey': key,
-                    'transcriptionIndex': transcriptionIndex,
-                    'numLines': numLines,
-                    'x1': textLine.getStart()['x'],
-                    'y1': textLine.getStart()['y'],
-                    'x2': textLine.getEnd()['x'],
-                    'y2': textLine.getEnd()['y'],
-                    'words': textLine.getWords()
-                }
-                transcriptionLineDetails.append(lineDescription)
+            for x1, y1, x2, y2, text in transcription.iterLineCoords():
+                x1s.append(x1)
+                y1s.append(y1)
+                x2s.append(x2)
+                y2s.append(y2)
+                lineWords.append(text.split())
+            subjectKeys.extend([key] * numLines)
+            transcriptionIndices.extend([transcriptionIndex] * numLines)
+            lineCounts.extend([numLines] * numLines)
+            startTimes.extend([transcription.startedAt] * numLines)
         transcriptionLineStats.update({
             key: {
                 'minLines': minLines,
@@ -204,42 +374,18 @@ def processLoadedTelegrams(telegrams):
 # coordinates of separately marked annotated lines
 
 
-def groupTranscriptionsLinewise(transcriptionLineDetailsFrame, lineTolerance=40, identifiedLineFilePath=None, saveIdentifiedLineDetails=False):
-
-    if saveIdentifiedLineDetails or identifiedLineFilePath is None:
-        transcriptionLineDetailsFrame['bestLineIndex'] = pd.Series(
-            np.zeros_like(transcriptionLineDetailsFrame['subjectKey']),
-            index=transcriptionLineDetailsFrame.index)
-        # iterate over rows in sorted, grouped dataset and insert the best line
-        # index
-        bestLineIndex = -1
-        currentSubject = -1
-        numSubjectsProcessed = 0
-        # line matcher with 40 pixel tolerance for y coordinates of lines that are
-        # considered to be the same
-        lineMatcher = LineMatcher(lineTolerance)
-        for index, row in transcriptionLineDetailsFrame.iterrows():
-            # if this is a new subject, reset the line index
-            if currentSubject != index[0]:
-                bestLineIndex = -1
-                currentSubject = index[0]
-                numSubjectsProcessed += 1
-                if numSubjectsProcessed % 100 == 0:
-                    print('Processed {0} subjects...'.format(
-                        numSubjectsProcessed))
-
-            # if the line coordinates do not match within tolerance, then increment
-            # the line index
-            if lineMatcher.compare((index[3], index[1], index[4], index[2])):
-                bestLineIndex += 1
-
-            # update the dataframe with the best line index
-            transcriptionLineDetailsFrame.ix[index,
-                                             'bestLineIndex'] = bestLineIndex
-    else:
-        identifiedLineFile = open(identifiedLineFilePath, 'rb')
-        transcriptionLineDetailsFrame = pickle.load(identifiedLineFile)
-        identifiedLineFile.close()
+def groupTranscriptionsLinewise(transcriptionLineDetailsFrame, lineTolerance=40):
+
+    # assign the best line index to all rows of the sorted, grouped
+    # dataset at once, using a 40 pixel (by default) tolerance for y
+    # coordinates of lines that are considered to be the same
+    transcriptionLineDetailsFrame['bestLineIndex'] = computeBestLineIndices(
+        transcriptionLineDetailsFrame.index.get_level_values(0).values,
+        transcriptionLineDetailsFrame.index.get_level_values(1).values,
+        transcriptionLineDetailsFrame.index.get_level_values(2).values,
+        transcriptionLineDetailsFrame.index.get_level_values(3).values,
+        transcriptionLineDetailsFrame.index.get_level_values(4).values,
+        yTolerance=lineTolerance)
 
     return transcriptionLineDetailsFrame
 
@@ -338,19 +484,14 @@ def computeConsensusWordReliability(wordOptions):
 # Now aggregate the text of the spatially matched lines
 # In the process, identify, strip and note any metatags e.g.
 # `[unclear][/unclear]` that surround individual words.
+#
+# aggregateSentences handles the sentences of a single line group. The
+# pipeline aggregates all line groups at once with
+# ConsensusEngine.computeLineConsensus, which produces the same results.
 
 def aggregateSentences(sentences):
     metaTagState = MetaTagState()
 
-    unclearPattern = r'(\[unclear\]).+?(\[/unclear\])'
-    insertionPattern = r'(\[insertion\]).+?(\[/insertion\])'
-    deletionPattern = r'(\[deletion\]).+?(\[/deletion\])'
-
-    emptyTagPairPattern = r'\[([^/]+?)\]\[/\1\]'
-
-    genericStartPattern = r'(\[([^/]+?)\])'
-    genericEndPattern = r'(\[/(.+?)\])'
-
     aggregatedSentence = {
         'reliability': 0.0,
         'wordReliabilities': [],
@@ -366,67 +507,26 @@ def aggregateSentences(sentences):
 
         # metatag pairs are better described in "sentence coordinates", these
         # can always be mapped to words later
-        fullSentence = ' '.join(sentence)
+        cleanWords, wordSpans, tagIntervals = metaTagTokenizer.tokenize(
+            sentence)
 
-        # Remove any empty metatag pairs
-        sentenceLength = len(sentence)
-        while True:
-            fullSentence = regex.sub(emptyTagPairPattern, '', fullSentence)
-            if len(fullSentence) == sentenceLength:
-                # no further replacement possible
-                break
-            else:
-                sentenceLength = len(fullSentence)
-
-        unclearResults = regex.finditer(unclearPattern, fullSentence)
-
-        insertionResults = regex.finditer(insertionPattern, fullSentence)
-
-        deletionResults = regex.finditer(deletionPattern, fullSentence)
-
-        for unclearResult in unclearResults:
-            '''print ('\nUnclear:\n', sentence, '\nnumgroups (start)', len(list(unclearResult.groups())), 'groups => ', list(unclearResult.groups()))
-            for index, match in enumerate(unclearResult.groups()) :
-                print (match, unclearResult.start(
-                    index+1), unclearResult.end(index+1))
-            print ('Tagging unclear between' , unclearResult.end(1), 'and', unclearResult.start(2))'''
-            metaTagState.setTag('unclear',
-                                unclearResult.end(1), unclearResult.start(2))
-
-        for insertionResult in insertionResults:
-            '''print ('\nInsertion:\n', sentence, '\nnumgroups (start)', len(list(insertionResult.groups())), 'groups => ', list(insertionResult.groups()))
-            for index, match in enumerate(insertionResult.groups()) :
-                print (match, insertionResult.start(index+1), insertionResult.end(index+1))'''
-            metaTagState.setTag('insertion',
-                                insertionResult.end(1),
-                                insertionResult.start(2))
-
-        for deletionResult in deletionResults:
-            '''print ('\nDeletion:\n', sentence, '\nnumgroups (start)', len(list(deletionResult.groups())), 'groups => ', list(deletionResult.groups()))
-            for index, match in enumerate(deletionResult.groups()) :
-                print (match, deletionResult.start(index+1), deletionResult.end(index+1))'''
-            metaTagState.setTag('deletion',
-                                deletionResult.end(1), deletionResult.start(2))
+        for tag, start, end in tagIntervals:
+            metaTagState.setTag(tag, start, end)
 
         iWord = 0
-        sentencePosition = 0
-        for word in sentence:
+        for nonMetaWord, wordSpan in zip(cleanWords, wordSpans):
             if (len(aggregatedSentence['words']) < iWord + 1):
                 aggregatedSentence['words'].append([])
                 statefulAggregatedSentence['words'].append([])
 
-            nonMetaWord = regex.sub(genericStartPattern, '', word)
-            nonMetaWord = regex.sub(genericEndPattern, '', nonMetaWord)
             if len(nonMetaWord) > 0:
                 aggregatedSentence['words'][iWord].append(nonMetaWord)
                 statefulAggregatedSentence['words'][iWord].append(
-                    StatefulWord(nonMetaWord, (
-                        sentencePosition, sentencePosition + len(word)
-                    ), copy.deepcopy(metaTagState.getSetTags()), sentence))
+                    StatefulWord(nonMetaWord, wordSpan,
+                                 metaTagState.getFrozenTags(), sentence))
                 # Only increment wordcount if there was actually a word and not
                 # just a collection of metatags
                 iWord += 1
-            sentencePosition += len(word) + 1
 
         metaTagState.reset()
         iSentence += 1
@@ -458,7 +558,14 @@ def aggregateSentences(sentences):
     return statefulAggregatedSentence
 
 
-def processSentences(transcriptionLineDetailsFrame):
+def processSentences(transcriptionLineDetailsFrame, subjectsFrame):
+
+    lineGroupedTranscriptionLineDetails = aggregateLineGroups(
+        transcriptionLineDetailsFrame)
+    return mergeSubjectData(lineGroupedTranscriptionLineDetails, subjectsFrame)
+
+
+def aggregateLineGroups(transcriptionLineDetailsFrame):
 
     # Several indices over the data were establshed to perform the
     # aggregation. hey are no longer required and a more informative index is
@@ -469,28 +576,46 @@ def processSentences(transcriptionLineDetailsFrame):
     transcriptionLineDetailsReIndexed.set_index(
         'bestLineIndex', append=True, inplace=True)
 
-    lineGroupedTranscriptionLineDetails = transcriptionLineDetailsReIndexed.groupby(
-        level=[0, 1]).aggregate({
-            "words":
-            aggregateSentences,
-            'subjectKey':
-            lambda x: x.iloc[0],
-            'y1':
-            np.mean,
-            'y2':
-            np.mean,
-            'x1':
-            np.mean,
-            'x2':
-            np.mean,
-            'transcriptionIndex':
-            lambda x: tuple([xi for xi in x]),
-            'numLines':
-            lambda x: tuple([xi for xi in x])
-        })
+    lineGroups = transcriptionLineDetailsReIndexed.groupby(level=[0, 1])
+    lineGroupedTranscriptionLineDetails = lineGroups.aggregate({
+        'subjectKey': 'first',
+        'y1': 'mean',
+        'y2': 'mean',
+        'x1': 'mean',
+        'x2': 'mean'
+    })
+    # The text of all line groups is aggregated at once (see
+    # ConsensusEngine). Group numbers follow the order of the aggregated rows.
+    groupNumbers = lineGroups.ngroup().values
+    numGroups = len(lineGroupedTranscriptionLineDetails)
+    lineGroupedTranscriptionLineDetails.insert(
+        0, 'words',
+        computeLineConsensus(
+            transcriptionLineDetailsReIndexed['words'].tolist(), groupNumbers,
+            numGroups, metaTagTokenizer))
+    for column in ['transcriptionIndex', 'numLines']:
+        lineGroupedTranscriptionLineDetails[column] = collectLineGroupValues(
+            transcriptionLineDetailsReIndexed[column].values, groupNumbers,
+            numGroups)
 
     lineGroupedTranscriptionLineDetails = lineGroupedTranscriptionLineDetails.reset_index(
         level=[1])
+    return lineGroupedTranscriptionLineDetails
+
+
+def collectLineGroupValues(values, groupNumbers, numGroups):
+    # tuple of the values in every group, in the order of the rows
+    groupOrder = np.argsort(groupNumbers, kind='stable')
+    groupEnds = np.cumsum(np.bincount(groupNumbers,
+                                      minlength=numGroups)).tolist()
+    sortedValues = values[groupOrder].tolist()
+    return [
+        tuple(sortedValues[groupStart:groupEnd])
+        for groupStart, groupEnd in zip([0] + groupEnds[:-1], groupEnds)
+    ]
+
+
+def mergeSubjectData(lineGroupedTranscriptionLineDetails, subjectsFrame):
     lineGroupedTranscriptionLineDetails = pd.merge(
         lineGroupedTranscriptionLineDetails,
         subjectsFrame,
@@ -500,91 +625,859 @@ def processSentences(transcriptionLineDetailsFrame):
 
     return lineGroupedTranscriptionLineDetails
 
+
+# Run the per-subject stages over batches of telegrams, e.g. those yielded by
+# iterTelegramBatches, producing one line grouped frame per batch.
+
+
+def processTelegramBatches(telegramBatches, subjectsFrame, lineTolerance=40):
+    for telegrams in telegramBatches:
+        transcriptionLineStats, transcriptionLineDetailsFrame = processLoadedTelegrams(
+            telegrams)
+        transcriptionLineDetailsFrame = groupTranscriptionsLinewise(
+            transcriptionLineDetailsFrame, lineTolerance)
+        yield processSentences(transcriptionLineDetailsFrame, subjectsFrame)
+
+# Every stage from processLoadedTelegrams to aggregateLineGroups only uses
+# the rows of a single subject, so the subjects of a single (large) export
+# can be hash partitioned into shards that are processed by separate worker
+# processes. The shard results are combined in subject order before the
+# subject data are merged, which reproduces the output of a serial run.
+# There are never more worker processes than cores (or numWorkers), so a
+# large numShards only makes the shards smaller.
+
+
+def aggregateTelegramShard(telegrams, lineTolerance=40):
+    transcriptionLineStats, transcriptionLineDetailsFrame = processLoadedTelegrams(
+        telegrams)
+    transcriptionLineDetailsFrame = groupTranscriptionsLinewise(
+        transcriptionLineDetailsFrame, lineTolerance)
+    return aggregateLineGroups(transcriptionLineDetailsFrame)
+
+
+def getShardWorkerCount(numShards, numWorkers=None):
+    if numWorkers is None:
+        numWorkers = numShardWorkers or os.cpu_count() or 1
+    return max(1, min(numShards, numWorkers))
+
+
+def processTelegramsSharded(telegrams, numShards, subjectsFrame,
+                            lineTolerance=40, numWorkers=None):
+    shards = [{} for shardIndex in range(numShards)]
+    for subjectKey, transcriptions in telegrams.items():
+        shards[hash(subjectKey) % numShards][subjectKey] = transcriptions
+    shards = [shard for shard in shards if len(shard) > 0]
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=getShardWorkerCount(len(shards), numWorkers)) as executor:
+        shardResults = list(executor.map(
+            aggregateTelegramShard, shards, itertools.repeat(lineTolerance)))
+
+    # a stable sort on the subject keeps the line order within each subject
+    lineGroupedTranscriptionLineDetails = pd.concat(shardResults).sort_index(
+        kind='mergesort')
+    return mergeSubjectData(lineGroupedTranscriptionLineDetails, subjectsFrame)
+
+# Run ingest, line grouping and sentence aggregation for an export, reusing
+# the output of every stage that is found in the stage cache. Each stage is
+# keyed by the key of its input and its own parameters, so e.g. a different
+# lineTolerance reuses the ingested lines but recomputes the later stages.
+
+
+def runCachedStages(sampleDataFileName, lineTolerance=40, stageCache=None,
+                    overlapThreshold=None):
+    # With an overlapThreshold, the telegram boxes of the export are
+    # aggregated as well (see BoxConsensus) and a tuple of the line groups
+    # and the aggregated boxes is returned.
+    extractBoxes = overlapThreshold is not None
+    if stageCache is None:
+        telegrams, nTelegramsParsed, boxesFrame = loadClassifications(
+            sampleDataFileName, extractBoxes)
+        print('Parsed {} telegrams and stored {}.'.format(
+            nTelegramsParsed, len(telegrams)))
+        transcriptionLineStats, transcriptionLineDetailsFrame = processLoadedTelegrams(
+            telegrams)
+        transcriptionLineDetailsFrame = groupTranscriptionsLinewise(
+            transcriptionLineDetailsFrame, lineTolerance)
+        # This is an intentional no-op
+        transcriptionLineDetailsFrame = doubleLineFix(
+            transcriptionLineDetailsFrame, applyDoubleLineFix=False)
+        lineGroupedTranscriptionLineDetails = aggregateLineGroups(
+            transcriptionLineDetailsFrame)
+        if not extractBoxes:
+            return lineGroupedTranscriptionLineDetails
+        return lineGroupedTranscriptionLineDetails, aggregateBoxes(
+            boxesFrame, overlapThreshold)
+
+    ingestKey = stageCache.makeKey('ingest', hashFile(sampleDataFileName),
+                                   liveDate=liveDate.isoformat())
+    groupingKey = stageCache.makeKey('lineGrouping', ingestKey,
+                                     lineTolerance=lineTolerance)
+    aggregationKey = stageCache.makeKey('sentenceAggregation', groupingKey)
+
+    aggregatedBoxes = None
+    if extractBoxes:
+        boxConsensusKey = stageCache.makeKey(
+            'boxConsensus', ingestKey, overlapThreshold=overlapThreshold)
+        cachedColumns = stageCache.load('boxConsensus', boxConsensusKey)
+        if cachedColumns is not None:
+            if verbose:
+                print('Using cached box consensus.')
+            aggregatedBoxes = decodeAggregatedBoxes(cachedColumns)
+    boxesMissing = extractBoxes and aggregatedBoxes is None
+
+    lineGroupedTranscriptionLineDetails = None
+    transcriptionLineDetailsFrame = None
+    cachedColumns = stageCache.load('sentenceAggregation', aggregationKey)
+    if cachedColumns is not None:
+        if verbose:
+            print('Using cached sentence aggregation.')
+        lineGroupedTranscriptionLineDetails = decodeLineGroups(cachedColumns)
+    else:
+        cachedColumns = stageCache.load('ingest', ingestKey)
+        if cachedColumns is not None:
+            if verbose:
+                print('Using cached ingested lines.')
+            transcriptionLineDetailsFrame = decodeLineDetails(cachedColumns)
+
+    # the lines and the boxes are extracted in a single pass over the export
+    linesMissing = lineGroupedTranscriptionLineDetails is None and transcriptionLineDetailsFrame is None
+    if linesMissing or boxesMissing:
+        telegrams, nTelegramsParsed, boxesFrame = loadClassifications(
+            sampleDataFileName, boxesMissing)
+        print('Parsed {} telegrams and stored {}.'.format(
+            nTelegramsParsed, len(telegrams)))
+        if linesMissing:
+            transcriptionLineStats, transcriptionLineDetailsFrame = processLoadedTelegrams(
+                telegrams)
+            stageCache.store('ingest', ingestKey,
+                             encodeLineDetails(transcriptionLineDetailsFrame))
+        del telegrams
+        if boxesMissing:
+            aggregatedBoxes = aggregateBoxes(boxesFrame, overlapThreshold)
+            stageCache.store('boxConsensus', boxConsensusKey,
+                             encodeAggregatedBoxes(aggregatedBoxes))
+
+    if lineGroupedTranscriptionLineDetails is None:
+        cachedColumns = stageCache.load('lineGrouping', groupingKey)
+        if cachedColumns is not None:
+            if verbose:
+                print('Using cached line grouping.')
+            transcriptionLineDetailsFrame['bestLineIndex'] = cachedColumns[
+                'bestLineIndex']
+        else:
+            transcriptionLineDetailsFrame = groupTranscriptionsLinewise(
+                transcriptionLineDetailsFrame, lineTolerance)
+            stageCache.store('lineGrouping', groupingKey, {
+                'bestLineIndex': transcriptionLineDetailsFrame['bestLineIndex'].values})
+
+        # This is an intentional no-op
+        transcriptionLineDetailsFrame = doubleLineFix(
+            transcriptionLineDetailsFrame, applyDoubleLineFix=False)
+
+        lineGroupedTranscriptionLineDetails = aggregateLineGroups(
+            transcriptionLineDetailsFrame)
+        stageCache.store('sentenceAggregation', aggregationKey,
+                         encodeLineGroups(lineGroupedTranscriptionLineDetails))
+    if not extractBoxes:
+        return lineGroupedTranscriptionLineDetails
+    return lineGroupedTranscriptionLineDetails, aggregatedBoxes
+
 # ## Save the "most popular" transcriptions
 # Also attempt to filter out double words e.g. `cheese cheese` and
 # adjacent lines with a large fraction of shared text that are likely to
 # erroneously repeated.
+# The line grouped data may be passed as a single frame, or as an iterable of
+# frames (e.g. from processTelegramBatches) that are written consecutively.
 
 
 def saveAggregatedData(lineGroupedTranscriptionLineDetails, aggregatedDataCsvFileName, aggregatedDataSubjectWiseCsvFileName):
 
-    aggregatedDataFile = open(aggregatedDataCsvFileName, 'w')
-    aggregatedDataSubjectWiseFile = open(
-        aggregatedDataSubjectWiseCsvFileName, 'w')
+    writeSubjectConsensus(
+        formatSubjectConsensus(lineGroupedTranscriptionLineDetails),
+        aggregatedDataCsvFileName, aggregatedDataSubjectWiseCsvFileName)
+
+
+# ## Store consensus data in an SQLite database
+# The rows are inserted in batches by a ConsensusDatabaseLoader. Without
+# replacedSubjects the database is rebuilt, otherwise the rows of the
+# replaced subjects are deleted before the frames are loaded, except for
+# their Subjects rows, which are updated in place so that every replaced
+# subject keeps its id. Frames are
+# yielded once they are loaded, so the database can be filled while the
+# frames of processTelegramBatches are written.
+
+
+def getDatabaseFileName(mssLabel):
+    return databaseNamePattern.format(mss_label=mssLabel) + '.sqlite'
+
+
+def storeConsensusBatches(lineGroupedFrames, databaseFileName, replacedSubjects=None):
+    connection = openSqliteDatabase(databaseFileName,
+                                    recreate=replacedSubjects is None)
+    try:
+        databaseLoader = ConsensusDatabaseLoader(
+            connection, databaseBatchSize, databaseCommitRows)
+        if replacedSubjects is not None:
+            databaseLoader.deleteSubjects(sorted(replacedSubjects),
+                                          keepSubjects=True)
+        for lineGroupedTranscriptionLineDetails in lineGroupedFrames:
+            databaseLoader.loadConsensus(lineGroupedTranscriptionLineDetails)
+            yield lineGroupedTranscriptionLineDetails
+        databaseLoader.deleteKeptSubjects()
+        databaseLoader.finish()
+        print(databaseLoader.formatStatistics())
+    finally:
+        connection.close()
+
+
+def storeConsensusData(lineGroupedTranscriptionLineDetails, databaseFileName, replacedSubjects=None):
+    for lineGroupedFrame in storeConsensusBatches(
+            [lineGroupedTranscriptionLineDetails], databaseFileName,
+            replacedSubjects):
+        pass
+
+# The aggregated telegram boxes replace the box tables of the database (see
+# BoxConsensus.storeBoxConsensus), along with the lines of every box and the
+# box statistics (see LineBoxIndex).
+
+
+def storeBoxData(aggregatedBoxes, lineGroupedTranscriptionLineDetails, subjectIndex, databaseFileName):
+    connection = openSqliteDatabase(databaseFileName)
+    try:
+        subjectKeys = set(np.asarray(aggregatedBoxes.index).tolist()) | set(
+            np.asarray(lineGroupedTranscriptionLineDetails.index).tolist())
+        numStoredBoxes = storeBoxConsensus(connection, aggregatedBoxes,
+                                           subjectIndex.getPageFrame(),
+                                           subjectKeys)
+        lineBoxIndex = buildLineBoxIndex(lineGroupedTranscriptionLineDetails,
+                                         aggregatedBoxes)
+        storeLineBoxIndex(connection, lineBoxIndex, recreate=True)
+    finally:
+        connection.close()
+    print('Stored {} of {} aggregated boxes with {} box lines.'.format(
+        numStoredBoxes, len(aggregatedBoxes),
+        len(lineBoxIndex['BoxLines']['zooniverseId'])))
+
+# The subject documents and the reliability index are built from the
+# complete database, so they are stored last. Only the documents of the
+# replacedSubjects are rebuilt if they are given; the reliability index is
+# always rebuilt.
+
+
+def storeServingData(databaseFileName, replacedSubjects=None):
+    if not (saveSubjectDocuments or saveReliabilityIndex):
+        return
+    connection = openSqliteDatabase(databaseFileName)
+    try:
+        if saveSubjectDocuments:
+            startTime = time.perf_counter()
+            numDocuments, numBytes = storeSubjectDocuments(
+                connection,
+                None if replacedSubjects is None else sorted(replacedSubjects))
+            print('Stored {} subject documents ({:.1f} MB) in {:.3f} s.'.format(
+                numDocuments, numBytes / 1e6, time.perf_counter() - startTime))
+        if saveReliabilityIndex:
+            startTime = time.perf_counter()
+            numIndexedSubjects = storeReliabilityIndex(
+                connection, reliabilityBucketCounts)
+            print('Indexed the reliabilities of {} subjects in {:.3f} s.'.format(
+                numIndexedSubjects, time.perf_counter() - startTime))
+    finally:
+        connection.close()
+
+
+# ## Export the consensus as columnar tables
+# The tables are built from the encoded line groups (see
+# StageCache.encodeLineGroups). Like storeConsensusBatches,
+# exportColumnarBatches yields the frames it is passed and writes the
+# export once all frames have been seen.
+
+
+def exportColumnarData(lineGroupedTranscriptionLineDetails, subjectsFrame, mssLabel):
+    exportConsensusTables(
+        encodeLineGroups(lineGroupedTranscriptionLineDetails)
+        if len(lineGroupedTranscriptionLineDetails) > 0 else None,
+        subjectsFrame, columnarExportDirectoryPattern.format(
+            mss_label=mssLabel), columnarExportFormat)
+
+
+def exportColumnarBatches(lineGroupedFrames, subjectsFrame, mssLabel):
+    lineGroupColumns = []
+    for lineGroupedTranscriptionLineDetails in lineGroupedFrames:
+        if len(lineGroupedTranscriptionLineDetails) > 0:
+            lineGroupColumns.append(
+                encodeLineGroups(lineGroupedTranscriptionLineDetails))
+        yield lineGroupedTranscriptionLineDetails
+    exportConsensusTables(
+        concatenateLineGroups(lineGroupColumns)
+        if len(lineGroupColumns) > 0 else None, subjectsFrame,
+        columnarExportDirectoryPattern.format(mss_label=mssLabel),
+        columnarExportFormat)
+
+
+# Write formatted subjects (see formatSubjectConsensus) to the linewise and
+# subjectwise files with a ConsensusWriter, returning the words of the last
+# unfiltered line of every subject.
+
+
+def writeSubjectConsensus(subjectConsensus, aggregatedDataCsvFileName, aggregatedDataSubjectWiseCsvFileName):
+
     # detailedAggregatedDataFile = open(aggregatedDataFileName, 'w')
-    currentSubject = -1
-    lastConsensusSentenceWords = (0, [])
-    for index, row in lineGroupedTranscriptionLineDetails.iterrows():
-        if index != currentSubject:
-            if currentSubject != -1:
-                aggregatedDataSubjectWiseFile.write('"\n')
-            aggregatedDataSubjectWiseFile.write(
-                '{0}@@{1}@@{2}@@"'.format(index, row['huntington_id'], row['url']))
-
-            currentSubject = index
-
-        # count the number of transcriptions that contributed to a sentence in case a deadlock between
-        # duplicate lines must be broken - currently not used
-        numTranscribedWords = functools.reduce(
-            lambda total, increment: total + increment,
-            [len(wordlist) for wordlist in row['words']['words']], 0)
-
-        consensusSentenceWords = [
-            wordlist[0].word for wordlist in row['words']['words']
-            if len(wordlist) > 0
-        ]
-        consensusSentence = ' '.join(consensusSentenceWords)
-
-        doubleWordRegex = r' ([^ ]{2,}) \1 ?'
-        doubleWordMatch = regex.search(
-            pattern=doubleWordRegex, string=consensusSentence)
-        cleanConsensusSentence = consensusSentence
-        if applyDoubleWordFilter and doubleWordMatch is not None:
-            cleanConsensusSentence = regex.sub(
-                pattern=doubleWordRegex,
-                repl=lambda match: ' ' + match.group(1) + ' ',
-                string=consensusSentence)
-            if extraVerbose:
-                print('Found double word {} in "{}" => {}'.format(
-                    doubleWordMatch.group(1), consensusSentence,
-                    cleanConsensusSentence))
-
-        cleanConsensusWords = cleanConsensusSentence.split(' ')
-
-        # Identify duplicate sentences after double word removal (currently only
-        # exact duplicates)
-        lineWordIntersection = [
-            word for word in cleanConsensusWords
-            if word in lastConsensusSentenceWords[1]
-        ]
-        if applyDoubleLineFilter and (len(lineWordIntersection) == max(
-                len(cleanConsensusWords), len(lastConsensusSentenceWords[1]))):
-            if extraVerbose:
-                print('Found duplicate sentence "{}" == "{}" ({})'.format(
-                    cleanConsensusSentence, ' '.join(lastConsensusSentenceWords[
-                        1]), lineWordIntersection))
-            # Do not write the duplicate sentence to file
-            continue
-
-        # only update if the current sentence was not a duplicate of the
-        # previous.
-        lastConsensusSentenceWords = (
-            numTranscribedWords, consensusSentenceWords)
-
-        aggregatedDataFile.write('{0}@@{1}@@{2}@@{3}@@{4}@@{5}\n'.format(
-            currentSubject,
-            row['huntington_id'],
-            row['bestLineIndex'],
-            '"' + cleanConsensusSentence + '"',
-            #'(' + str(row['y1']) + ', ' + str(row['y2']),
-            [len(wordlist) for wordlist in row['words']['words']],
-            # row['numLines'],
-            row['url']))
-        # Note "<br />" line break sequence added at request of Huntington
-        aggregatedDataSubjectWiseFile.write(
-            '{0}<br />'.format(cleanConsensusSentence))
-    aggregatedDataFile.close()
-    aggregatedDataSubjectWiseFile.close()
+    with ConsensusWriter(aggregatedDataCsvFileName,
+                         aggregatedDataSubjectWiseCsvFileName,
+                         outputCompression, outputBufferSize) as consensusWriter:
+        return consensusWriter.writeSubjects(subjectConsensus)
+
+# Format the consensus of every subject, yielding the subject, its lines of
+# the linewise file, its record in the subjectwise file (without the '"\n'
+# that separates records) and the words of the last line that was not
+# filtered as a duplicate. Duplicate lines are identified against that line
+# even across subject boundaries, so it is passed on to the next subject.
+# The double word and duplicate line filters are applied by a
+# ConsensusLineFilter (see ConsensusFilters); unless a filter is passed in,
+# one is made from the global settings and its counters are printed once all
+# subjects have been formatted.
+
+
+def makeLineFilter():
+    return ConsensusLineFilter(applyDoubleWordFilter, applyDoubleLineFilter,
+                               duplicateLineJaccardThreshold, extraVerbose)
+
+
+def iterLineGroupRows(lineGroupedTranscriptionLineDetails):
+    if len(lineGroupedTranscriptionLineDetails) == 0:
+        return iter([])
+    return zip(lineGroupedTranscriptionLineDetails.index.tolist(),
+               lineGroupedTranscriptionLineDetails['huntington_id'].tolist(),
+               lineGroupedTranscriptionLineDetails['url'].tolist(),
+               lineGroupedTranscriptionLineDetails['bestLineIndex'].tolist(),
+               lineGroupedTranscriptionLineDetails['words'])
+
+
+def formatSubjectConsensus(lineGroupedTranscriptionLineDetails,
+                           lastConsensusSentenceWords=(0, []), lineFilter=None):
+    reportFilterCounters = lineFilter is None
+    if lineFilter is None:
+        lineFilter = makeLineFilter()
+    if isinstance(lineGroupedTranscriptionLineDetails, pd.DataFrame):
+        lineGroupedTranscriptionLineDetails = [
+            lineGroupedTranscriptionLineDetails]
+    for currentSubject, subjectRows in itertools.groupby(
+            itertools.chain.from_iterable(
+                iterLineGroupRows(lineGroupedFrame)
+                for lineGroupedFrame in lineGroupedTranscriptionLineDetails),
+            key=lambda row: row[0]):
+        subjectRows = list(subjectRows)
+        index, huntingtonId, url = subjectRows[0][:3]
+        subjectWiseRecord = '{0}@@{1}@@{2}@@"'.format(index, huntingtonId, url)
+
+        cleanConsensusSentences, lastKeptIndex, lastWords = lineFilter.filterLines([
+            [wordlist[0].word for wordlist in aggregatedSentence['words']
+             if len(wordlist) > 0]
+            for index, huntingtonId, url, bestLineIndex, aggregatedSentence in subjectRows
+        ], lastConsensusSentenceWords[1])
+        if lastKeptIndex is not None:
+            # count the number of transcriptions that contributed to a sentence in case a deadlock between
+            # duplicate lines must be broken - currently not used
+            numTranscribedWords = sum([
+                len(wordlist)
+                for wordlist in subjectRows[lastKeptIndex][4]['words']])
+            lastConsensusSentenceWords = (numTranscribedWords, lastWords)
+
+        linewiseLines = []
+        for (index, huntingtonId, url, bestLineIndex, aggregatedSentence), cleanConsensusSentence in zip(
+                subjectRows, cleanConsensusSentences):
+            # Do not write duplicate sentences to file
+            if cleanConsensusSentence is None:
+                continue
+            linewiseLines.append('{0}@@{1}@@{2}@@{3}@@{4}@@{5}\n'.format(
+                currentSubject,
+                huntingtonId,
+                bestLineIndex,
+                '"' + cleanConsensusSentence + '"',
+                #'(' + str(row['y1']) + ', ' + str(row['y2']),
+                [len(wordlist) for wordlist in aggregatedSentence['words']],
+                # row['numLines'],
+                url))
+            # Note "<br />" line break sequence added at request of Huntington
+            subjectWiseRecord += '{0}<br />'.format(cleanConsensusSentence)
+        yield currentSubject, linewiseLines, subjectWiseRecord, lastConsensusSentenceWords
+    if reportFilterCounters and verbose:
+        print(lineFilter.formatCounters())
+
+
+# ## Incremental processing of cumulative exports
+# Zooniverse exports are cumulative: every export repeats the records of the
+# previous one and appends the classifications made since. In incremental
+# mode the state of the last run of every mss label is kept in
+# incrementalStateDirectory (ingested lines and aggregated line groups in the
+# StageCache column format, plus the number of records processed and the id
+# of the last classification). A run then
+#
+#  - checks that the export still starts with the processed records (the
+#    classification id of the last processed record must be unchanged),
+#    otherwise the export is processed from scratch,
+#  - decodes only the records that were appended,
+#  - regroups and re-aggregates only the subjects with new transcriptions,
+#    together with their previously ingested lines,
+#  - patches the linewise and subjectwise files: the lines of unaffected
+#    subjects are copied from the previous files and only affected subjects
+#    are formatted again. Since duplicate lines are detected across subject
+#    boundaries, a following subject is also formatted again if the last
+#    line of the subject before it changed.
+#
+# The state is only valid for the same line tolerance, live date and subject
+# data file; if any of them changes the export is processed from scratch.
+
+
+def loadNewTelegrams(sampleDataFileName, numProcessedRecords=0,
+                     lastClassificationId=None):
+
+    telegrams = {}
+    exportSummary = {
+        'numRecords': 0,
+        'lastClassificationId': None,
+        'startsWithProcessedRecords': numProcessedRecords == 0
+    }
+
+    with open(sampleDataFileName) as csvfile:
+        parsedCsv = csv.reader(csvfile)
+        rowDecoder = ClassificationRowDecoder(next(parsedCsv), liveDate)
+        nTelegramsParsed = 0
+        for recordIndex, row in enumerate(parsedCsv):
+            exportSummary['numRecords'] = recordIndex + 1
+            exportSummary['lastClassificationId'] = rowDecoder.getClassificationId(
+                row)
+            if recordIndex < numProcessedRecords:
+                if recordIndex == numProcessedRecords - 1:
+                    exportSummary['startsWithProcessedRecords'] = exportSummary[
+                        'lastClassificationId'] == lastClassificationId
+                continue
+
+            transcribedLines = rowDecoder.decode(row)
+            if transcribedLines is not None:
+                nTelegramsParsed += 1
+                telegrams.setdefault(rowDecoder.getSubjectKey(row), []).append(
+                    (recordIndex, transcribedLines))
+
+    if verbose:
+        print(rowDecoder.formatStageTimes())
+
+    return telegrams, nTelegramsParsed, exportSummary
+
+
+def loadIncrementalState(stateDirectory, stateParameters):
+    try:
+        with open(os.path.join(stateDirectory, 'state.json')) as stateFile:
+            state = json.load(stateFile)
+        if state['parameters'] != stateParameters:
+            return None
+        for name in ['lineDetails', 'lineGroups', 'lastSubjectWords']:
+            state[name] = loadColumns(os.path.join(stateDirectory, name))
+    except (OSError, ValueError, KeyError):
+        return None
+    state['lastSubjectWords'] = [
+        (subject, words.split()) for subject, words in zip(
+            state['lastSubjectWords']['subjects'].tolist(),
+            state['lastSubjectWords']['words'])
+    ]
+    return state
+
+
+def saveIncrementalState(stateDirectory, state):
+    # the new state is written next to the old one and swapped into place
+    newStateDirectory = stateDirectory + '.new'
+    shutil.rmtree(newStateDirectory, ignore_errors=True)
+    for name in ['lineDetails', 'lineGroups', 'lastSubjectWords']:
+        os.makedirs(os.path.join(newStateDirectory, name))
+    saveColumns(os.path.join(newStateDirectory, 'lineDetails'),
+                state['lineDetails'])
+    saveColumns(os.path.join(newStateDirectory, 'lineGroups'),
+                state['lineGroups'])
+    saveColumns(os.path.join(newStateDirectory, 'lastSubjectWords'), {
+        'subjects': np.array([subject for subject, words in state['lastSubjectWords']],
+                             dtype=np.int64),
+        'words': [' '.join(words) for subject, words in state['lastSubjectWords']]
+    })
+    with open(os.path.join(newStateDirectory, 'state.json'), 'w') as stateFile:
+        json.dump({name: state[name] for name in
+                   ['parameters', 'numRecords', 'lastClassificationId']},
+                  stateFile)
+    shutil.rmtree(stateDirectory, ignore_errors=True)
+    os.rename(newStateDirectory, stateDirectory)
+
+
+def readSubjectConsensus(aggregatedDataCsvFileName, aggregatedDataSubjectWiseCsvFileName):
+    # the lines and records of every subject in previously written files
+    linewiseLines = {}
+    with openConsensusFile(aggregatedDataCsvFileName, 'r',
+                           outputCompression) as aggregatedDataFile:
+        for line in aggregatedDataFile:
+            linewiseLines.setdefault(line.split('@@', 1)[0], []).append(line)
+    with openConsensusFile(aggregatedDataSubjectWiseCsvFileName, 'r',
+                           outputCompression) as aggregatedDataSubjectWiseFile:
+        subjectWiseContent = aggregatedDataSubjectWiseFile.read()
+    subjectWiseRecords = {}
+    if len(subjectWiseContent) > 0:
+        for subjectWiseRecord in subjectWiseContent.split('"\n'):
+            subjectWiseRecords[subjectWiseRecord.split(
+                '@@', 1)[0]] = subjectWiseRecord
+    return linewiseLines, subjectWiseRecords
+
+
+def patchSubjectConsensus(lineGroupColumns, subjectsFrame, affectedSubjects,
+                          previousLastSubjectWords, linewiseLines,
+                          subjectWiseRecords):
+    # words of the last line that preceded every subject in the previous run
+    previousPrecedingWords = {}
+    precedingWords = []
+    for subject, lastWords in previousLastSubjectWords:
+        previousPrecedingWords[subject] = precedingWords
+        precedingWords = lastWords
+    previousLastWords = dict(previousLastSubjectWords)
+
+    # only the line groups of subjects that are formatted again are decoded
+    subjectIndex = lineGroupColumns['index']
+
+    def decodeSubjects(subjects):
+        return mergeSubjectData(decodeLineGroups(takeLineGroupRows(
+            lineGroupColumns, np.flatnonzero(np.isin(subjectIndex, subjects)))),
+            subjectsFrame)
+
+    affectedLineGroups = decodeSubjects(list(affectedSubjects))
+
+    numFormatted = 0
+    lineFilter = makeLineFilter()
+    precedingWords = []
+    for subject in np.unique(subjectIndex).tolist():
+        if (subject in affectedSubjects or str(subject) not in subjectWiseRecords
+                or previousPrecedingWords.get(subject) != precedingWords):
+            subjectLineGroups = affectedLineGroups.loc[[subject]] if subject in affectedSubjects else decodeSubjects(
+                [subject])
+            subject, subjectLines, subjectWiseRecord, lastConsensusSentenceWords = next(
+                formatSubjectConsensus(subjectLineGroups, (0, precedingWords),
+                                       lineFilter))
+            numFormatted += 1
+        else:
+            subjectLines = linewiseLines.get(str(subject), [])
+            subjectWiseRecord = subjectWiseRecords[str(subject)]
+            lastConsensusSentenceWords = (0, previousLastWords[subject])
+        precedingWords = lastConsensusSentenceWords[1]
+        yield subject, subjectLines, subjectWiseRecord, lastConsensusSentenceWords
+    if verbose:
+        print('Formatted {} subjects, copied the remaining subjects.'.format(
+            numFormatted))
+        print(lineFilter.formatCounters())
+
+
+def processManuscriptIncrementally(sampleDataFileName, subjectIndex, lineTolerance=40):
+    subjectsFrame = subjectIndex.getFrame()
+    mssLabel = getMssLabel(sampleDataFileName)
+    aggregatedDataCsvFileName = getCompressedFileName(
+        aggregatedDataCsvFileNamePattern.format(mss_label=mssLabel),
+        outputCompression)
+    aggregatedDataSubjectWiseCsvFileName = getCompressedFileName(
+        aggregatedDataSubjectWiseCsvFileNamePattern.format(mss_label=mssLabel),
+        outputCompression)
+    stateDirectory = os.path.join(incrementalStateDirectory, mssLabel)
+    stateParameters = {
+        'lineTolerance': lineTolerance,
+        'liveDate': liveDate.isoformat(),
+        'subjectData': subjectIndex.contentHash,
+        'version': stageCacheVersion
+    }
+
+    state = None
+    if os.path.isfile(aggregatedDataCsvFileName) and os.path.isfile(
+            aggregatedDataSubjectWiseCsvFileName):
+        state = loadIncrementalState(stateDirectory, stateParameters)
+    if state is not None:
+        telegrams, nTelegramsParsed, exportSummary = loadNewTelegrams(
+            sampleDataFileName, state['numRecords'],
+            state['lastClassificationId'])
+        if not exportSummary['startsWithProcessedRecords']:
+            print('{} does not extend the processed export, processing all records.'.format(
+                sampleDataFileName))
+            state = None
+    if state is None:
+        telegrams, nTelegramsParsed, exportSummary = loadNewTelegrams(
+            sampleDataFileName)
+    print('Parsed {} new telegrams for {} subjects.'.format(
+        nTelegramsParsed, len(telegrams)))
+
+    if len(telegrams) == 0 and state is None:
+        # nothing has been transcribed yet
+        saveAggregatedData(pd.DataFrame(), aggregatedDataCsvFileName,
+                           aggregatedDataSubjectWiseCsvFileName)
+        if saveConsensusDatabase:
+            storeConsensusData(pd.DataFrame(), getDatabaseFileName(mssLabel))
+            storeServingData(getDatabaseFileName(mssLabel))
+        if saveColumnarExport:
+            exportColumnarData(pd.DataFrame(), subjectsFrame, mssLabel)
+        return mssLabel
+
+    if state is None:
+        transcriptionLineStats, transcriptionLineDetailsFrame = processLoadedTelegrams(
+            telegrams)
+        lineDetails = encodeLineDetails(transcriptionLineDetailsFrame)
+        lineGroupedTranscriptionLineDetails = aggregateLineGroups(
+            groupTranscriptionsLinewise(transcriptionLineDetailsFrame,
+                                        lineTolerance))
+        lineGroups = encodeLineGroups(lineGroupedTranscriptionLineDetails)
+        lineGroupedTranscriptionLineDetails = mergeSubjectData(
+            lineGroupedTranscriptionLineDetails, subjectsFrame)
+        subjectConsensus = formatSubjectConsensus(
+            lineGroupedTranscriptionLineDetails)
+    else:
+        affectedSubjects = set(telegrams)
+        lineDetails = state['lineDetails']
+        lineGroups = state['lineGroups']
+        if len(telegrams) > 0:
+            transcriptionLineStats, transcriptionLineDetailsFrame = processLoadedTelegrams(
+                telegrams)
+            # a stable sort places the new lines of a subject after its
+            # previous lines with the same coordinates, as in a complete run
+            lineDetails = concatenateRows(
+                [lineDetails, encodeLineDetails(transcriptionLineDetailsFrame)])
+            lineDetails = takeRows(lineDetails, np.lexsort(
+                [lineDetails[column] for column in reversed(lineDetailIndexColumns)]))
+            affectedLineGroups = aggregateLineGroups(groupTranscriptionsLinewise(
+                decodeLineDetails(takeRows(lineDetails, np.flatnonzero(np.isin(
+                    lineDetails['subjectKey'], list(affectedSubjects))))),
+                lineTolerance))
+            keptRows = np.flatnonzero(np.concatenate([
+                np.logical_not(np.isin(lineGroups['index'], list(affectedSubjects))),
+                np.ones(len(affectedLineGroups), dtype=bool)
+            ]))
+            lineGroups = concatenateLineGroups(
+                [lineGroups, encodeLineGroups(affectedLineGroups)])
+            lineGroups = takeLineGroupRows(lineGroups, keptRows[np.argsort(
+                lineGroups['index'][keptRows], kind='stable')])
+        linewiseLines, subjectWiseRecords = readSubjectConsensus(
+            aggregatedDataCsvFileName, aggregatedDataSubjectWiseCsvFileName)
+        subjectConsensus = patchSubjectConsensus(
+            lineGroups, subjectsFrame, affectedSubjects,
+            state['lastSubjectWords'],
+            linewiseLines, subjectWiseRecords)
+
+    lastSubjectWords = writeSubjectConsensus(
+        subjectConsensus, aggregatedDataCsvFileName + '.tmp',
+        aggregatedDataSubjectWiseCsvFileName + '.tmp')
+    os.replace(aggregatedDataCsvFileName + '.tmp', aggregatedDataCsvFileName)
+    os.replace(aggregatedDataSubjectWiseCsvFileName + '.tmp',
+               aggregatedDataSubjectWiseCsvFileName)
+
+    if saveConsensusDatabase:
+        # only the rows of the affected subjects are replaced, unless there is
+        # no database to patch
+        databaseFileName = getDatabaseFileName(mssLabel)
+        if state is None:
+            storeConsensusData(lineGroupedTranscriptionLineDetails,
+                               databaseFileName)
+            storeServingData(databaseFileName)
+        elif not os.path.isfile(databaseFileName):
+            storeConsensusData(
+                mergeSubjectData(decodeLineGroups(lineGroups), subjectsFrame),
+                databaseFileName)
+            storeServingData(databaseFileName)
+        elif len(telegrams) > 0:
+            storeConsensusData(mergeSubjectData(affectedLineGroups,
+                                                subjectsFrame),
+                               databaseFileName, affectedSubjects)
+            storeServingData(databaseFileName, affectedSubjects)
+    if saveColumnarExport:
+        exportConsensusTables(
+            lineGroups, subjectsFrame,
+            columnarExportDirectoryPattern.format(mss_label=mssLabel),
+            columnarExportFormat)
+
+    saveIncrementalState(stateDirectory, {
+        'parameters': stateParameters,
+        'numRecords': exportSummary['numRecords'],
+        'lastClassificationId': exportSummary['lastClassificationId'],
+        'lineDetails': lineDetails,
+        'lineGroups': lineGroups,
+        'lastSubjectWords': lastSubjectWords
+    })
+    return mssLabel
+
+# ## Process a single classification export
+# Each manuscript (mss label) is independent of the others and writes its own
+# output files, so runManuscripts fans the exports out across a pool of
+# worker processes. The output of every job is written to its own log file
+# and a failing job is reported without affecting the others.
+
+
+def processManuscript(sampleDataFileName, subjectDataFileName,
+                      shardWorkers=None):
+
+    print('Processing {}...'.format(sampleDataFileName))
+    # mssLabel = remainingClassificationCsvFiles[ledgerIndex].split('/')[-1][len(
+    #     'classification_export_'):-4]
+    mssLabel = getMssLabel(sampleDataFileName)
+    # databaseName = databaseNamePattern.format(
+    #     mss_label=mssLabel
+    # )
+    # 'dcwConsensusDoubleLineFix' if applyDoubleLineFix else 'dcwConsensus'
+    # sampleDataFileName = classificationCsvFiles[
+    #     ledgerIndex]  # 'decoding-the-civil-war-classifications-2.csv'
+    aggregatedDataFileName = aggregatedDataFileNamePattern.format(
+        mss_label=mssLabel)  # 'decoding-the-civil-war-aggregated.txt'
+    aggregatedDataCsvFileName = getCompressedFileName(
+        aggregatedDataCsvFileNamePattern.format(mss_label=mssLabel),
+        outputCompression)  # 'decoding-the-civil-war-consensus-linewise.csv'
+    aggregatedDataSubjectWiseCsvFileName = getCompressedFileName(
+        aggregatedDataSubjectWiseCsvFileNamePattern.format(mss_label=mssLabel),
+        outputCompression)  # 'decoding-the-civil-war-consensus-subjectwise.csv'
+
+    # the subject data are shared by every manuscript
+    subjectIndex = loadSubjectIndex(subjectDataFileName, subjectIndexDirectory)
+    subjectsFrame = subjectIndex.getFrame()
+
+    if aggregateTelegramBoxes and (incrementalMode or streamingIngest):
+        print('Telegram boxes are only aggregated by complete runs.')
+
+    if incrementalMode:
+        return processManuscriptIncrementally(sampleDataFileName,
+                                              subjectIndex, 40)
+
+    if streamingIngest:
+        if streamingSpillDirectory is not None:
+            os.makedirs(streamingSpillDirectory, exist_ok=True)
+        telegramBatches = iterTelegramBatches(
+            sampleDataFileName, streamingSubjectsPerBatch,
+            streamingMaxBufferedRecords, streamingSpillDirectory)
+        lineGroupedFrames = processTelegramBatches(telegramBatches,
+                                                   subjectsFrame, 40)
+        if saveConsensusDatabase:
+            lineGroupedFrames = storeConsensusBatches(
+                lineGroupedFrames, getDatabaseFileName(mssLabel))
+        if saveColumnarExport:
+            lineGroupedFrames = exportColumnarBatches(lineGroupedFrames,
+                                                      subjectsFrame, mssLabel)
+        saveAggregatedData(lineGroupedFrames, aggregatedDataCsvFileName,
+                           aggregatedDataSubjectWiseCsvFileName)
+        if saveConsensusDatabase:
+            storeServingData(getDatabaseFileName(mssLabel))
+        return mssLabel
+
+    if numSubjectShards > 1:
+        # the grouped line data are never gathered in one process, so the
+        # stage cache is not used in this mode
+        telegrams, nTelegramsParsed, boxesFrame = loadClassifications(
+            sampleDataFileName, aggregateTelegramBoxes)
+        print('Parsed {} telegrams and stored {}.'.format(
+            nTelegramsParsed, len(telegrams)))
+        lineGroupedTranscriptionLineDetails = processTelegramsSharded(
+            telegrams, numSubjectShards, subjectsFrame, 40, shardWorkers)
+        saveAggregatedData(lineGroupedTranscriptionLineDetails,
+                           aggregatedDataCsvFileName, aggregatedDataSubjectWiseCsvFileName)
+        if saveConsensusDatabase:
+            storeConsensusData(lineGroupedTranscriptionLineDetails,
+                               getDatabaseFileName(mssLabel))
+        if aggregateTelegramBoxes:
+            storeBoxData(aggregateBoxes(boxesFrame, boxOverlapThreshold),
+                         lineGroupedTranscriptionLineDetails, subjectIndex,
+                         getDatabaseFileName(mssLabel))
+        if saveConsensusDatabase:
+            storeServingData(getDatabaseFileName(mssLabel))
+        if saveColumnarExport:
+            exportColumnarData(lineGroupedTranscriptionLineDetails,
+                               subjectsFrame, mssLabel)
+        return mssLabel
+
+    stageCache = StageCache(stageCacheDirectory,
+                            stageCacheMaxBytes) if useStageCache else None
+    if aggregateTelegramBoxes:
+        lineGroupedTranscriptionLineDetails, aggregatedBoxes = runCachedStages(
+            sampleDataFileName, 40, stageCache, boxOverlapThreshold)
+    else:
+        lineGroupedTranscriptionLineDetails = runCachedStages(
+            sampleDataFileName, 40, stageCache)
+    lineGroupedTranscriptionLineDetails = mergeSubjectData(
+        lineGroupedTranscriptionLineDetails, subjectsFrame)
+    saveAggregatedData(lineGroupedTranscriptionLineDetails,
+                       aggregatedDataCsvFileName, aggregatedDataSubjectWiseCsvFileName)
+    if saveConsensusDatabase:
+        storeConsensusData(lineGroupedTranscriptionLineDetails,
+                           getDatabaseFileName(mssLabel))
+    if aggregateTelegramBoxes:
+        storeBoxData(aggregatedBoxes, lineGroupedTranscriptionLineDetails,
+                     subjectIndex, getDatabaseFileName(mssLabel))
+    if saveConsensusDatabase:
+        storeServingData(getDatabaseFileName(mssLabel))
+    if saveColumnarExport:
+        exportColumnarData(lineGroupedTranscriptionLineDetails, subjectsFrame,
+                           mssLabel)
+    return mssLabel
+
+
+def getMssLabel(sampleDataFileName):
+    return os.path.basename(sampleDataFileName)[len(
+        'classification_export_'):-4]
+
+
+def runManuscriptJob(sampleDataFileName, subjectDataFileName, logDirectory,
+                     shardWorkers=None):
+    mssLabel = getMssLabel(sampleDataFileName)
+    logFileName = os.path.join(
+        logDirectory, manuscriptLogFileNamePattern.format(mss_label=mssLabel))
+    error = None
+    startTime = time.perf_counter()
+    with open(logFileName, 'w') as logFile:
+        with contextlib.redirect_stdout(logFile), contextlib.redirect_stderr(logFile):
+            try:
+                processManuscript(sampleDataFileName, subjectDataFileName,
+                                  shardWorkers)
+            except Exception:
+                error = traceback.format_exc()
+                print(error)
+    return mssLabel, time.perf_counter() - startTime, error
+
+
+def runManuscripts(classificationCsvFiles, subjectDataFileName,
+                   numWorkers=None, logDirectory='.'):
+    os.makedirs(logDirectory, exist_ok=True)
+    # build (or validate) the persisted subject index once, so that the
+    # workers only map it
+    loadSubjectIndex(subjectDataFileName, subjectIndexDirectory)
+    # the manuscript workers share the cores with the shard workers of a
+    # sharded export, rather than each of them using every core
+    numCores = os.cpu_count() or 1
+    if numWorkers is None:
+        numWorkers = max(1, min(numCores, len(classificationCsvFiles)))
+    shardWorkers = numShardWorkers or max(1, numCores // numWorkers)
+    jobResults = []
+    startTime = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=numWorkers) as executor:
+        jobs = {
+            executor.submit(runManuscriptJob, sampleDataFileName,
+                            subjectDataFileName, logDirectory,
+                            shardWorkers): sampleDataFileName
+            for sampleDataFileName in classificationCsvFiles
+        }
+        for job in concurrent.futures.as_completed(jobs):
+            try:
+                jobResult = job.result()
+            except Exception as e:
+                # the worker process itself failed (e.g. it was killed)
+                jobResult = (getMssLabel(jobs[job]), float('nan'), repr(e))
+            jobResults.append(jobResult)
+            print('{} {} after {:.1f} s'.format(
+                jobResult[0], 'FAILED' if jobResult[2] else 'finished',
+                jobResult[1]))
+
+    # summarize the wall time spent on every manuscript
+    print('\n{:<40} {:>10}  {}'.format('mss label', 'wall time', 'status'))
+    for mssLabel, wallTime, error in sorted(
+            jobResults, key=lambda jobResult: jobResult[0]):
+        print('{:<40} {:>9.1f}s  {}'.format(
+            mssLabel, wallTime, 'failed' if error else 'ok'))
+    numFailed = len([jobResult for jobResult in jobResults if jobResult[2]])
+    print('Processed {} manuscripts ({} failed) in {:.1f} s'.format(
+        len(jobResults), numFailed, time.perf_counter() - startTime))
+    return jobResults
 
 
 if __name__ == '__main__':
@@ -619,55 +1512,13 @@ if __name__ == '__main__':
 
     # print(*enumerate(remainingClassificationCsvFiles), sep='\n')
 
-    # ledgerIndex = 30
-    for sampleDataFileName in classificationCsvFiles:
-        print('Processing {}...'.format(sampleDataFileName))
-        # mssLabel = remainingClassificationCsvFiles[ledgerIndex].split('/')[-1][len(
-        #     'classification_export_'):-4]
-        mssLabel = sampleDataFileName.split('/')[-1][len(
-            'classification_export_'):-4]
-        # databaseName = databaseNamePattern.format(
-        #     mss_label=mssLabel
-        # )
-        # 'dcwConsensusDoubleLineFix' if applyDoubleLineFix else 'dcwConsensus'
-        # sampleDataFileName = classificationCsvFiles[
-        #     ledgerIndex]  # 'decoding-the-civil-war-classifications-2.csv'
-        aggregatedDataFileName = aggregatedDataFileNamePattern.format(
-            mss_label=mssLabel)  # 'decoding-the-civil-war-aggregated.txt'
-        aggregatedDataCsvFileName = aggregatedDataCsvFileNamePattern.format(
-            mss_label=mssLabel)  # 'decoding-the-civil-war-consensus-linewise.csv'
-        aggregatedDataSubjectWiseCsvFileName = aggregatedDataSubjectWiseCsvFileNamePattern.format(
-            mss_label=mssLabel)  # 'decoding-the-civil-war-consensus-subjectwise.csv'
-        identifiedLineFilePath = identifiedLineFilePathPattern.format(
-            mss_label=mssLabel)  # 'dataWithLineIDs_subset.pkl'
-
-        subjectDataFileName = 'decoding-the-civil-war-subjects-7-24-17.csv'
-
-        subjectsFrame = loadSubjectData(subjectDataFileName)
-
-        telegrams, nTelegramsParsed = loadTelegrams(sampleDataFileName)
-        print('Parsed {} telegrams and stored {}.'.format(
-            nTelegramsParsed, len(telegrams)))
+    # the number of worker processes may also be given on the command line
+    if len(sys.argv) > 1:
+        numManuscriptWorkers = int(sys.argv[1])
 
-        transcriptionLineStats, transcriptionLineDetailsFrame = processLoadedTelegrams(
-            telegrams)
-
-        transcriptionLineDetailsFrame = groupTranscriptionsLinewise(
-            transcriptionLineDetailsFrame, 40, identifiedLineFilePath, saveIdentifiedLineDetails)
-
-        # This is an intentional no-op
-        transcriptionLineDetailsFrame = doubleLineFix(
-            transcriptionLineDetailsFrame, applyDoubleLineFix=False)
-
-        # The previous step is time consuming so serialize the processed data at
-        # this stage
-        if saveIdentifiedLineDetails:
-            transcriptionLineDetailsFrame.to_pickle(identifiedLineFilePath)
-
-        lineGroupedTranscriptionLineDetails = processSentences(
-            transcriptionLineDetailsFrame)
-        saveAggregatedData(lineGroupedTranscriptionLineDetails,
-                           aggregatedDataCsvFileName, aggregatedDataSubjectWiseCsvFileName)
+    # ledgerIndex = 30
+    runManuscripts(classificationCsvFiles, subjectDataFileName,
+                   numManuscriptWorkers, manuscriptLogDirectory)
 
 
 #
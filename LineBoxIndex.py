@@ -0,0 +1,206 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# Assigns the consensus lines of every subject to its aggregated telegram
+# boxes, as LineBoxMatcher in serveConsensus.php does for every page request,
+# and computes the statistics of every box.
+#
+# A line belongs to a box if the mean of its y coordinates lies strictly
+# between the top and the bottom of the box and the line overlaps the box
+# horizontally (with LineBoxMatcher's condition on the overlap fraction).
+# Only the y test needs an index: the lines are sorted by subject and mean y
+# (a complex key, which numpy orders by its real then its imaginary part), so
+# the candidate lines of every box are a contiguous range found by two binary
+# searches. The x test is then applied to the candidates only.
+#
+# The lines are a merged line grouped frame (see
+# DcwAggregation.mergeSubjectData) and the boxes a frame indexed by subject
+# with the columns of the SubjectBoxes table (bestBoxIndex, meanX, meanY,
+# meanWidth, meanHeight). The index holds the lines of every box in the order
+# of the lines of the subject, and the number of lines and the mean line
+# reliability of every box (NaN for boxes without lines).
+
+minXOverlapFraction = 0.95
+
+lineBoxTableColumns = OrderedDict([
+    ('BoxLines', ('zooniverseId', 'bestBoxIndex', 'bestLineIndex')),
+    ('BoxStats', ('zooniverseId', 'bestBoxIndex', 'numLines', 'reliability'))
+])
+
+lineBoxSqliteSchema = [
+    '''CREATE TABLE IF NOT EXISTS BoxLines (
+    zooniverseId INT NOT NULL,
+    bestBoxIndex INT NOT NULL,
+    bestLineIndex INT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS BoxStats (
+    zooniverseId INT NOT NULL,
+    bestBoxIndex INT NOT NULL,
+    numLines INT NOT NULL,
+    reliability REAL
+    )''',
+    'CREATE INDEX IF NOT EXISTS BoxLinesZooniverseId ON BoxLines (zooniverseId)',
+    'CREATE INDEX IF NOT EXISTS BoxStatsZooniverseId ON BoxStats (zooniverseId)'
+]
+
+
+def getLineColumns(lineGroupedTranscriptionLineDetails):
+    frame = lineGroupedTranscriptionLineDetails
+    return {
+        'subjectKey': np.asarray(frame.index, dtype=np.int64),
+        'bestLineIndex': frame['bestLineIndex'].to_numpy(dtype=np.int64),
+        'x1': frame['x1'].to_numpy(dtype=np.float64),
+        'x2': frame['x2'].to_numpy(dtype=np.float64),
+        'y1': frame['y1'].to_numpy(dtype=np.float64),
+        'y2': frame['y2'].to_numpy(dtype=np.float64),
+        'reliability': np.array(
+            [lineWords['reliability'] for lineWords in frame['words']],
+            dtype=np.float64)
+    }
+
+
+def getBoxColumns(boxesFrame):
+    columns = {'subjectKey': np.asarray(boxesFrame.index, dtype=np.int64)}
+    columns['bestBoxIndex'] = boxesFrame['bestBoxIndex'].to_numpy(
+        dtype=np.int64)
+    for column in ['meanX', 'meanY', 'meanWidth', 'meanHeight']:
+        columns[column] = boxesFrame[column].to_numpy(dtype=np.float64)
+    return columns
+
+
+def matchLinesToBoxes(lineColumns, boxColumns):
+    '''Find the lines of every box.
+
+    Returns the row of the box and the row of the line of every match,
+    ordered by box and then by line.
+    '''
+    numLines = len(lineColumns['subjectKey'])
+    if numLines == 0 or len(boxColumns['subjectKey']) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # sorted (subject, mean y) keys of the lines
+    meanLineY = 0.5 * (lineColumns['y1'] + lineColumns['y2'])
+    lineOrder = np.lexsort((meanLineY, lineColumns['subjectKey']))
+    lineKeys = (lineColumns['subjectKey'][lineOrder] +
+                1j * meanLineY[lineOrder])
+
+    minY = boxColumns['meanY']
+    maxY = boxColumns['meanY'] + boxColumns['meanHeight']
+    firstCandidates = np.searchsorted(
+        lineKeys, boxColumns['subjectKey'] + 1j * minY, side='right')
+    endCandidates = np.searchsorted(
+        lineKeys, boxColumns['subjectKey'] + 1j * maxY, side='left')
+    numCandidates = np.maximum(endCandidates - firstCandidates, 0)
+
+    # expand the candidate ranges into (box, line) pairs
+    boxRows = np.repeat(np.arange(len(numCandidates)), numCandidates)
+    candidateStarts = np.cumsum(numCandidates) - numCandidates
+    lineRows = lineOrder[np.repeat(firstCandidates - candidateStarts,
+                                   numCandidates) +
+                         np.arange(len(boxRows))]
+
+    minX = boxColumns['meanX'][boxRows]
+    maxX = minX + boxColumns['meanWidth'][boxRows]
+    x1 = lineColumns['x1'][lineRows]
+    x2 = lineColumns['x2'][lineRows]
+    xOverlaps = np.minimum(maxX, x2) - np.maximum(minX, x1)
+    overlapping = xOverlaps > 0
+    inBox = np.zeros(len(boxRows), dtype=bool)
+    inBox[overlapping] = ((x2 - x1)[overlapping] / xOverlaps[overlapping] >
+                         minXOverlapFraction)
+    boxRows = boxRows[inBox]
+    lineRows = lineRows[inBox]
+
+    matchOrder = np.lexsort((lineRows, boxRows))
+    return boxRows[matchOrder], lineRows[matchOrder]
+
+
+def buildLineBoxIndex(lineGroupedTranscriptionLineDetails, boxesFrame):
+    lineColumns = getLineColumns(lineGroupedTranscriptionLineDetails)
+    boxColumns = getBoxColumns(boxesFrame)
+    boxRows, lineRows = matchLinesToBoxes(lineColumns, boxColumns)
+
+    numBoxes = len(boxColumns['subjectKey'])
+    numBoxLines = np.bincount(boxRows, minlength=numBoxes)
+    reliabilitySums = np.bincount(boxRows,
+                                  weights=lineColumns['reliability'][lineRows],
+                                  minlength=numBoxes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        boxReliabilities = reliabilitySums / numBoxLines
+    boxReliabilities[numBoxLines == 0] = np.nan
+
+    return {
+        'BoxLines': OrderedDict([
+            ('zooniverseId', boxColumns['subjectKey'][boxRows]),
+            ('bestBoxIndex', boxColumns['bestBoxIndex'][boxRows]),
+            ('bestLineIndex', lineColumns['bestLineIndex'][lineRows])
+        ]),
+        'BoxStats': OrderedDict([
+            ('zooniverseId', boxColumns['subjectKey']),
+            ('bestBoxIndex', boxColumns['bestBoxIndex']),
+            ('numLines', numBoxLines.astype(np.int64)),
+            ('reliability', boxReliabilities)
+        ])
+    }
+
+
+def storeLineBoxIndex(connection, lineBoxIndex, replaceSubjects=False,
+                      placeholder='?', recreate=False):
+    cursor = connection.cursor()
+    if recreate:
+        for table in lineBoxTableColumns:
+            cursor.execute('DROP TABLE IF EXISTS {}'.format(table))
+    for statement in lineBoxSqliteSchema:
+        cursor.execute(statement)
+    if replaceSubjects:
+        zooniverseIds = [
+            (zooniverseId, ) for zooniverseId in np.unique(
+                lineBoxIndex['BoxStats']['zooniverseId']).tolist()
+        ]
+        for table in lineBoxTableColumns:
+            cursor.executemany(
+                'DELETE FROM {} WHERE zooniverseId = {}'.format(
+                    table, placeholder), zooniverseIds)
+    for table, columns in lineBoxTableColumns.items():
+        tableColumns = lineBoxIndex[table]
+        rows = zip(*[[None if pd.isnull(value) else value
+                      for value in tableColumns[column].tolist()]
+                     for column in columns])
+        cursor.executemany(
+            'INSERT INTO {} ({}) VALUES ({})'.format(
+                table, ', '.join(columns),
+                ', '.join([placeholder] * len(columns))), rows)
+    connection.commit()
+
+
+def getLinesForBoxesReference(lines, boxes):
+    # LineBoxMatcher::getLinesForBoxes for the lines and boxes (lists of
+    # dicts with the columns of SubjectLines and SubjectBoxes) of one subject
+    boxLines = OrderedDict()
+    for box in boxes:
+        minY = box['meanY']
+        maxY = box['meanY'] + box['meanHeight']
+        minX = box['meanX']
+        maxX = box['meanX'] + box['meanWidth']
+        linesInBox = []
+        for line in lines:
+            meanLineY = 0.5 * (line['meanY1'] + line['meanY2'])
+            xOverlap = min(maxX, line['meanX2']) - max(minX, line['meanX1'])
+            xOverlapFraction = (line['meanX2'] - line['meanX1']
+                                ) / xOverlap if xOverlap > 0 else 0
+            if meanLineY > minY and meanLineY < maxY and (
+                    xOverlapFraction > minXOverlapFraction):
+                linesInBox.append(line)
+        boxLines[box['bestBoxIndex']] = linesInBox
+
+    boxStats = OrderedDict()
+    for bestBoxIndex, linesInBox in boxLines.items():
+        reliability = sum(line['lineReliability'] for line in linesInBox)
+        boxStats[bestBoxIndex] = {
+            'reliability': reliability / len(linesInBox)
+            if len(linesInBox) > 0 else float('nan'),
+            'numLines': len(linesInBox)
+        }
+    return {'boxLines': boxLines, 'boxStats': boxStats}
@@ -0,0 +1,217 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+from LineMatcher import LineMatcher
+
+# Vectorized equivalent of the LineMatcher sweep performed by
+# DcwAggregation.groupTranscriptionsLinewise.
+#
+# LineMatcher compares every line against the coordinates of the line that
+# *started* the current group (it only updates its state when a line is
+# found to be different), so a group is a run of lines whose y1 and y2 both
+# lie within yTolerance of the first line of the run. This is a chain of
+# "leaders" rather than a simple threshold on consecutive differences, so
+# the engine works in three array passes:
+#
+#   1. for every line, find the first later line in the same subject that
+#      LineMatcher would consider different from it (the next leader if that
+#      line were a leader),
+#   2. follow the leader chain from the start of every subject by pointer
+#      doubling,
+#   3. turn the resulting leader mask into bestLineIndex values with a
+#      cumulative sum that restarts at every subject boundary.
+#
+# The first line of every subject starts line 0. The original loop shared a
+# single LineMatcher across subjects, so the first line of a subject was
+# compared with the current group of the previous subject (or, for the first
+# subject, with the initial coordinates (-1, -1, -1, -1)) and got index -1
+# whenever it matched. That made the lines of a subject depend on the
+# subject before it in the frame, which differs between complete, sharded,
+# streaming and incremental runs.
+
+
+def _findNextLeaders(y1, y2, segmentEnds, yTolerance):
+    numRows = len(y1)
+    nextLeaders = segmentEnds.copy()
+    unresolved = np.arange(numRows)
+    offset = 1
+    while unresolved.size > 0:
+        candidates = unresolved + offset
+        # lines that ran off the end of their subject are resolved to the
+        # start of the next subject
+        inSegment = candidates < segmentEnds[unresolved]
+        unresolved = unresolved[inSegment]
+        candidates = candidates[inSegment]
+        different = np.logical_or(
+            np.abs(y1[candidates] - y1[unresolved]) > yTolerance,
+            np.abs(y2[candidates] - y2[unresolved]) > yTolerance)
+        nextLeaders[unresolved[different]] = candidates[different]
+        unresolved = unresolved[np.logical_not(different)]
+        offset += 1
+    return nextLeaders
+
+
+def _followLeaderChain(nextLeaders, numRows):
+    # nextLeaders[i] > i for all i and the sentinel numRows maps to itself,
+    # so after k doubling steps the reached set holds the first 2**k leaders
+    jump = np.append(nextLeaders, numRows)
+    reached = np.zeros(numRows + 1, dtype=bool)
+    reached[0] = True
+    members = np.array([0])
+    while not reached[numRows]:
+        members = jump[members]
+        reached[members] = True
+        members = np.flatnonzero(reached)
+        jump = jump[jump]
+    return reached[:numRows]
+
+
+def computeBestLineIndices(subjectKeys, y1, y2, x1=None, x2=None,
+                           yTolerance=40, xTolerance=None):
+    '''Assign a best line index to every transcribed line.
+
+    The inputs are parallel arrays in the order that
+    groupTranscriptionsLinewise visits the rows, i.e. sorted by subject and
+    then by (y1, y2, x1, x2); lines of a subject must be contiguous. The
+    result is an int64 array that is identical to running a
+    LineMatcher(yTolerance, xTolerance) over each subject, starting from the
+    coordinates of its first line (which gets index 0).
+
+    LineMatcher.compare only consults the x coordinates when the y
+    coordinates already match, and then combines the x test with that
+    (false) result using "and", so x1, x2 and xTolerance can never split a
+    group. They are accepted so that callers can pass the same arguments as
+    they would to LineMatcher.
+    '''
+    subjectKeys = np.asarray(subjectKeys)
+    numLines = len(subjectKeys)
+    if numLines == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    subjectStarts = np.flatnonzero(
+        np.concatenate(([True], subjectKeys[1:] != subjectKeys[:-1])))
+    subjectSizes = np.diff(np.append(subjectStarts, numLines))
+
+    # prepend a virtual line to every subject, from which the leader chain
+    # of the subject continues with its first line
+    virtualRows = subjectStarts + np.arange(len(subjectStarts))
+    numRows = numLines + len(subjectStarts)
+    realRows = np.ones(numRows, dtype=bool)
+    realRows[virtualRows] = False
+    extendedY1 = np.full(numRows, -1.0)
+    extendedY2 = np.full(numRows, -1.0)
+    extendedY1[realRows] = np.asarray(y1, dtype=np.float64)
+    extendedY2[realRows] = np.asarray(y2, dtype=np.float64)
+    segmentEnds = np.repeat(np.append(virtualRows[1:], numRows),
+                            subjectSizes + 1)
+
+    nextLeaders = _findNextLeaders(
+        extendedY1, extendedY2, segmentEnds, yTolerance)
+    nextLeaders[virtualRows] = virtualRows + 1
+    isLeader = _followLeaderChain(nextLeaders, numRows)[realRows]
+
+    # every leader increments the line index of its subject, which starts
+    # at -1 before the first line
+    leaderCounts = np.cumsum(isLeader, dtype=np.int64)
+    countsBeforeSubject = leaderCounts[subjectStarts] - \
+        isLeader[subjectStarts]
+    return leaderCounts - np.repeat(countsBeforeSubject, subjectSizes) - 1
+
+
+def computeBestLineIndicesLoop(subjectKeys, y1, y2, x1, x2,
+                               yTolerance=40, xTolerance=None):
+    # Reference implementation: the LineMatcher sweep over plain arrays,
+    # starting a new matcher at the first line of every subject.
+    bestLineIndices = np.zeros(len(subjectKeys), dtype=np.int64)
+    currentSubject = None
+    bestLineIndex = -1
+    lineMatcher = None
+    for row, subjectKey in enumerate(subjectKeys):
+        lineCoords = (x1[row], y1[row], x2[row], y2[row])
+        if subjectKey != currentSubject:
+            currentSubject = subjectKey
+            bestLineIndex = 0
+            lineMatcher = LineMatcher(yTolerance, xTolerance)
+            lineMatcher.setCurrentCoords(lineCoords)
+        elif lineMatcher.compare(lineCoords):
+            bestLineIndex += 1
+        bestLineIndices[row] = bestLineIndex
+    return bestLineIndices
+
+
+def makeSyntheticLineFrame(numLines, linesPerSubject=200, transcribers=10,
+                           lineSpacing=60.0, jitter=12.0, seed=0):
+    # Synthetic stand-in for the sorted output of processLoadedTelegrams:
+    # every subject has linesPerSubject/transcribers lines of text, each
+    # marked by every transcriber with jittered coordinates.
+    rng = np.random.RandomState(seed)
+    numSubjects = max(1, numLines // linesPerSubject)
+    linesPerPage = max(1, linesPerSubject // transcribers)
+    subjectKeys = np.repeat(np.arange(numSubjects) + 1959000,
+                            linesPerPage * transcribers)[:numLines]
+    numLines = len(subjectKeys)
+    pageLine = np.tile(np.repeat(np.arange(linesPerPage), transcribers),
+                       numSubjects)[:numLines]
+    y1 = 100.0 + lineSpacing * pageLine + rng.normal(0.0, jitter, numLines)
+    y2 = y1 + rng.normal(0.0, jitter, numLines)
+    x1 = 50.0 + rng.normal(0.0, 3 * jitter, numLines)
+    x2 = 900.0 + rng.normal(0.0, 3 * jitter, numLines)
+    frame = pd.DataFrame({
+        'subjectKey': subjectKeys,
+        'y1': y1,
+        'y2': y2,
+        'x1': x1,
+        'x2': x2
+    })
+    return frame.sort_values(['subjectKey', 'y1', 'y2', 'x1', 'x2'],
+                             kind='mergesort').reset_index(drop=True)
+
+
+def benchmark(numLines=1000000, lineTolerance=40, loopLines=None):
+    frame = makeSyntheticLineFrame(numLines)
+    arrays = [frame[column].values
+              for column in ['subjectKey', 'y1', 'y2', 'x1', 'x2']]
+
+    startTime = time.perf_counter()
+    vectorizedIndices = computeBestLineIndices(
+        *arrays, yTolerance=lineTolerance)
+    vectorizedTime = time.perf_counter() - startTime
+    print('Vectorized grouping of {} lines: {:.3f} s'.format(
+        len(frame), vectorizedTime))
+
+    loopLines = len(frame) if loopLines is None else min(loopLines,
+                                                          len(frame))
+    startTime = time.perf_counter()
+    loopIndices = computeBestLineIndicesLoop(
+        *[array[:loopLines] for array in arrays], yTolerance=lineTolerance)
+    loopTime = time.perf_counter() - startTime
+    print('LineMatcher loop over {} lines: {:.3f} s ({:.1f}x slower per line)'.format(
+        loopLines, loopTime,
+        (loopTime / loopLines) / (vectorizedTime / len(frame))))
+
+    # the iterrows() sweep used by groupTranscriptionsLinewise, without the
+    # cost of the per-cell write back
+    startTime = time.perf_counter()
+    lineMatcher = LineMatcher(lineTolerance)
+    for index, row in frame.iloc[:loopLines].iterrows():
+        lineMatcher.compare((row['x1'], row['y1'], row['x2'], row['y2']))
+    iterrowsTime = time.perf_counter() - startTime
+    print('iterrows() sweep over {} lines: {:.3f} s ({:.1f}x slower per line)'.format(
+        loopLines, iterrowsTime,
+        (iterrowsTime / loopLines) / (vectorizedTime / len(frame))))
+
+    # the vectorized engine runs each subject independently, so a prefix of
+    # whole subjects can be checked against the loop directly
+    subsetIndices = computeBestLineIndices(
+        *[array[:loopLines] for array in arrays], yTolerance=lineTolerance)
+    numMismatches = np.count_nonzero(subsetIndices != loopIndices)
+    print('Mismatched line indices: {}'.format(numMismatches))
+    return numMismatches
+
+
+if __name__ == '__main__':
+    numLines = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    loopLines = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    sys.exit(1 if benchmark(numLines, loopLines=loopLines) > 0 else 0)
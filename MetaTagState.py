@@ -1,17 +1,122 @@
+import copy
+import sys
+import time
+import tracemalloc
+
+
+class FrozenTagState(dict):
+    # Read-only mapping of tag -> tuple of (start, end) intervals. A single
+    # instance is shared by every word of a sentence, so it must not change.
+
+    def _readOnly(self, *args, **kwargs):
+        raise TypeError('FrozenTagState is read-only')
+
+    __setitem__ = __delitem__ = _readOnly
+    clear = pop = popitem = setdefault = update = _readOnly
+
+    def __reduce__(self):
+        return (FrozenTagState, (dict(self), ))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+emptyTagState = FrozenTagState()
+
+
 class MetaTagState():
 
     def __init__(self):
         self.setTags = {}
+        self.frozenTags = emptyTagState
 
     def setTag(self, tag, start, end):
         if tag in self.setTags:
             self.setTags[tag].append((start, end))
         else:
             self.setTags.update({tag: [(start, end)]})
+        self.frozenTags = None
         return self.setTags[tag]
 
     def reset(self):
         self.setTags = {}
+        self.frozenTags = emptyTagState
 
     def getSetTags(self):
         return self.setTags
+
+    def getFrozenTags(self):
+        # immutable snapshot of the set tags, built once per state
+        if self.frozenTags is None:
+            self.frozenTags = FrozenTagState(
+                (tag, tuple(intervals)) for tag, intervals in self.setTags.items())
+        return self.frozenTags
+
+
+def benchmark(numSentences=10000, wordsPerSentence=12, tagsPerSentence=4,
+              seed=0):
+    # Compare a deep copy of the tag state for every word with a single
+    # frozen state shared by the words of each tag-heavy sentence.
+    import random
+    from MetaTagTokenizer import MetaTagTokenizer
+    from StatefulWord import StatefulWord
+
+    random.seed(seed)
+    tagNames = MetaTagTokenizer.tagNames
+    sentences = []
+    for iSentence in range(numSentences):
+        words = ['word{}'.format(random.randint(0, 500))
+                 for iWord in range(wordsPerSentence)]
+        for iTag in range(tagsPerSentence):
+            tag = random.choice(tagNames)
+            iWord = random.randrange(wordsPerSentence)
+            words[iWord] = '[{0}]{1}[/{0}]'.format(tag, words[iWord])
+        sentences.append(words)
+
+    metaTagTokenizer = MetaTagTokenizer()
+    tokenizedSentences = [metaTagTokenizer.tokenize(sentence)
+                          for sentence in sentences]
+
+    def buildWords(shareState):
+        metaTagState = MetaTagState()
+        statefulWords = []
+        for sentence, (cleanWords, wordSpans, tagIntervals) in zip(
+                sentences, tokenizedSentences):
+            for tag, start, end in tagIntervals:
+                metaTagState.setTag(tag, start, end)
+            for word, wordSpan in zip(cleanWords, wordSpans):
+                tagStates = metaTagState.getFrozenTags() if shareState else copy.deepcopy(
+                    metaTagState.getSetTags())
+                statefulWords.append(
+                    StatefulWord(word, wordSpan, tagStates, sentence))
+            metaTagState.reset()
+        return statefulWords
+
+    results = []
+    for shareState in (False, True):
+        startTime = time.perf_counter()
+        statefulWords = buildWords(shareState)
+        elapsedTime = time.perf_counter() - startTime
+        del statefulWords
+        tracemalloc.start()
+        statefulWords = buildWords(shareState)
+        retainedBytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('{:<24} {:.3f} s, {:.1f} MB retained for {} words'.format(
+            'shared frozen state:' if shareState else 'deep copy per word:',
+            elapsedTime, retainedBytes / 1e6, len(statefulWords)))
+        results.append(statefulWords)
+
+    numMismatches = len([
+        copiedWord for copiedWord, sharedWord in zip(*results)
+        if {tag: tuple(intervals) for tag, intervals in copiedWord.tagStates.items()} != sharedWord.tagStates
+    ])
+    print('Mismatched tag states: {}'.format(numMismatches))
+    return numMismatches
+
+
+if __name__ == '__main__':
+    sys.exit(1 if benchmark() > 0 else 0)
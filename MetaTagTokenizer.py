@@ -0,0 +1,159 @@
+import csv
+import itertools
+import re as regex
+import sys
+import time
+
+from ClassificationRowDecoder import ClassificationRowDecoder
+
+# Tokenizer for the [tag]...[/tag] markup in transcribed sentences.
+#
+# For a sentence (a list of whitespace separated words) it returns, in one
+# pass over the words:
+#
+#  - the word with any metatags stripped (empty for words that consist only
+#    of metatags),
+#  - the (start, end) span of the word in sentence coordinates,
+#  - the (tag, start, end) intervals enclosed by unclear, insertion and
+#    deletion tags, in sentence coordinates after empty tag pairs have been
+#    removed.
+#
+# Most transcribed sentences contain no markup at all, and since every
+# pattern needs a "[" to match, those sentences are tokenized without any
+# regular expression. Sentences with markup use the same patterns as before,
+# compiled once, and each pattern is only run when its literal prefix occurs
+# in the sentence, so the results are identical to running every pattern on
+# every sentence.
+
+
+class MetaTagTokenizer():
+
+    tagNames = ('unclear', 'insertion', 'deletion')
+
+    emptyTagPairPattern = regex.compile(r'\[([^/]+?)\]\[/\1\]')
+    genericStartPattern = regex.compile(r'(\[([^/]+?)\])')
+    genericEndPattern = regex.compile(r'(\[/(.+?)\])')
+    tagPatterns = [(tag, '[{}]'.format(tag), '[/{}]'.format(tag),
+                    regex.compile(r'(\[{0}\]).+?(\[/{0}\])'.format(tag)))
+                   for tag in tagNames]
+
+    def tokenize(self, sentence):
+        fullSentence = ' '.join(sentence)
+        spanEnds = list(itertools.accumulate(
+            len(word) + 1 for word in sentence))
+        spans = [(spanEnd - len(word) - 1, spanEnd - 1)
+                 for word, spanEnd in zip(sentence, spanEnds)]
+
+        if '[' not in fullSentence:
+            return sentence, spans, []
+
+        return (self.stripWords(sentence), spans,
+                self.findTagIntervals(fullSentence, len(sentence)))
+
+    def stripWords(self, sentence):
+        cleanWords = []
+        for word in sentence:
+            if '[' in word:
+                word = self.genericStartPattern.sub('', word)
+                word = self.genericEndPattern.sub('', word)
+            cleanWords.append(word)
+        return cleanWords
+
+    def findTagIntervals(self, fullSentence, numWords):
+        # Remove any empty metatag pairs (this can only change sentences that
+        # contain "][/"). As before, the removal is repeated until the length
+        # of the sentence stops changing, starting from its word count.
+        if '][/' in fullSentence:
+            sentenceLength = numWords
+            while True:
+                fullSentence = self.emptyTagPairPattern.sub('', fullSentence)
+                if len(fullSentence) == sentenceLength:
+                    # no further replacement possible
+                    break
+                else:
+                    sentenceLength = len(fullSentence)
+
+        tagIntervals = []
+        for tag, startTag, endTag, tagPattern in self.tagPatterns:
+            if startTag in fullSentence and endTag in fullSentence:
+                for tagResult in tagPattern.finditer(fullSentence):
+                    tagIntervals.append(
+                        (tag, tagResult.end(1), tagResult.start(2)))
+        return tagIntervals
+
+
+def tokenizeWithPatterns(sentence):
+    # Reference implementation: the per-sentence regex passes that were
+    # previously performed by DcwAggregation.aggregateSentences.
+    fullSentence = ' '.join(sentence)
+    sentenceLength = len(sentence)
+    while True:
+        fullSentence = regex.sub(r'\[([^/]+?)\]\[/\1\]', '', fullSentence)
+        if len(fullSentence) == sentenceLength:
+            break
+        else:
+            sentenceLength = len(fullSentence)
+    tagIntervals = []
+    for tag in MetaTagTokenizer.tagNames:
+        for tagResult in regex.finditer(
+                r'(\[{0}\]).+?(\[/{0}\])'.format(tag), fullSentence):
+            tagIntervals.append((tag, tagResult.end(1), tagResult.start(2)))
+    cleanWords = []
+    spans = []
+    sentencePosition = 0
+    for word in sentence:
+        nonMetaWord = regex.sub(r'(\[([^/]+?)\])', '', word)
+        nonMetaWord = regex.sub(r'(\[/(.+?)\])', '', nonMetaWord)
+        cleanWords.append(nonMetaWord)
+        spans.append((sentencePosition, sentencePosition + len(word)))
+        sentencePosition += len(word) + 1
+    return cleanWords, spans, tagIntervals
+
+
+def loadSentences(sampleDataFileName):
+    # the words of every transcribed line in a classification export
+    sentences = []
+    with open(sampleDataFileName) as csvfile:
+        parsedCsv = csv.reader(csvfile)
+        rowDecoder = ClassificationRowDecoder(next(parsedCsv))
+        for row in parsedCsv:
+            transcribedLines = rowDecoder.decode(row)
+            if transcribedLines is not None:
+                sentences.extend(textLine.getWords()
+                                 for textLine in transcribedLines.getLines())
+    return sentences
+
+
+def benchmark(sentences, numRepeats=3):
+    numTagged = len([sentence for sentence in sentences
+                     if '[' in ' '.join(sentence)])
+    print('Corpus: {} sentences, {} with metatags'.format(
+        len(sentences), numTagged))
+
+    startTime = time.perf_counter()
+    for repeat in range(numRepeats):
+        patternResults = [tokenizeWithPatterns(sentence)
+                          for sentence in sentences]
+    patternTime = (time.perf_counter() - startTime) / numRepeats
+
+    metaTagTokenizer = MetaTagTokenizer()
+    startTime = time.perf_counter()
+    for repeat in range(numRepeats):
+        tokenizerResults = [metaTagTokenizer.tokenize(sentence)
+                            for sentence in sentences]
+    tokenizerTime = (time.perf_counter() - startTime) / numRepeats
+
+    numMismatches = len([
+        sentence for sentence, patternResult, tokenizerResult in zip(
+            sentences, patternResults, tokenizerResults)
+        if tuple(map(list, patternResult)) != tuple(map(list, tokenizerResult))
+    ])
+    print('Per-sentence patterns: {:.3f} s, MetaTagTokenizer: {:.3f} s ({:.1f}x faster)'.format(
+        patternTime, tokenizerTime, patternTime / tokenizerTime))
+    print('Mismatched sentences: {}'.format(numMismatches))
+    return numMismatches
+
+
+if __name__ == '__main__':
+    # the corpus is read from the transcribed lines of a classification export
+    sys.exit(1 if benchmark(loadSentences(sys.argv[1])) > 0 else 0)
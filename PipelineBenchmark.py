@@ -0,0 +1,327 @@
+import concurrent.futures
+import contextlib
+import datetime
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from SyntheticExport import getExportParameters, getExportKey, getSyntheticExport
+
+# End-to-end benchmark of the aggregation pipeline on synthetic exports (see
+# SyntheticExport), so that every change can be compared against the
+# previous release without the real exports.
+#
+# For every export size, the stages of DcwAggregation are run in order:
+#
+#   loadSubjectData -> loadTelegrams -> processLoadedTelegrams ->
+#   groupTranscriptionsLinewise -> processSentences -> saveAggregatedData
+#
+# and the wall time of every stage is recorded together with the peak
+# resident set size of the process after the stage. Every size is run in a
+# fresh worker process, so that the memory of one size never counts towards
+# the next. With traceAllocations, the peak of the memory that was allocated
+# by Python during every stage is recorded as well (tracemalloc slows the
+# stages down, so those timings are not comparable with untraced runs).
+#
+# The results of a run are stored as JSON, with the parameters of the
+# exports and the versions of the environment, in benchmarkResultsDirectory.
+# compareBenchmarks prints the ratios of the stage times of two runs.
+
+benchmarkSizes = (10000, 100000, 1000000)
+benchmarkExportDirectory = 'syntheticExports'
+benchmarkResultsDirectory = 'benchmarkResults'
+benchmarkResultsFileNamePattern = 'pipelineBenchmark_{label}.json'
+traceAllocations = False
+pipelineStages = ('loadSubjectData', 'loadTelegrams',
+                  'processLoadedTelegrams', 'groupTranscriptionsLinewise',
+                  'processSentences', 'saveAggregatedData')
+
+# ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+
+
+def getPeakRss():
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxRss if sys.platform == 'darwin' else maxRss * 1024
+
+# Records the wall time and memory of the stages of a pipeline run, which are
+# measured by wrapping every stage in a "with recorder.stage(name):" block.
+
+
+class StageRecorder():
+
+    def __init__(self, _traceAllocations=False):
+        self.traceAllocations = _traceAllocations
+        self.stages = []
+        if self.traceAllocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        gc.collect()
+        if self.traceAllocations:
+            tracemalloc.reset_peak()
+            startAllocated = tracemalloc.get_traced_memory()[0]
+        startTime = time.perf_counter()
+        yield
+        stageRecord = OrderedDict([
+            ('stage', name),
+            ('seconds', time.perf_counter() - startTime),
+            ('peakRssBytes', getPeakRss())
+        ])
+        if self.traceAllocations:
+            allocated, peakAllocated = tracemalloc.get_traced_memory()
+            stageRecord['peakAllocatedBytes'] = peakAllocated - startAllocated
+            stageRecord['retainedBytes'] = allocated - startAllocated
+        self.stages.append(stageRecord)
+
+    def getTotalTime(self):
+        return sum(stageRecord['seconds'] for stageRecord in self.stages)
+
+# Run the pipeline on an export, writing the consensus files to
+# outputDirectory. Returns the stage records and the sizes of the
+# intermediate data.
+
+
+def runPipeline(sampleDataFileName, subjectDataFileName, outputDirectory,
+                traceAllocations=False, lineTolerance=40):
+    import DcwAggregation
+
+    recorder = StageRecorder(traceAllocations)
+    startRss = getPeakRss()
+    with recorder.stage('loadSubjectData'):
+        subjectsFrame = DcwAggregation.loadSubjectData(subjectDataFileName)
+    with recorder.stage('loadTelegrams'):
+        telegrams, nTelegramsParsed = DcwAggregation.loadTelegrams(
+            sampleDataFileName)
+    with recorder.stage('processLoadedTelegrams'):
+        transcriptionLineStats, transcriptionLineDetailsFrame = DcwAggregation.processLoadedTelegrams(
+            telegrams)
+    numSubjects = len(telegrams)
+    del telegrams, transcriptionLineStats
+    with recorder.stage('groupTranscriptionsLinewise'):
+        transcriptionLineDetailsFrame = DcwAggregation.groupTranscriptionsLinewise(
+            transcriptionLineDetailsFrame, lineTolerance)
+    with recorder.stage('processSentences'):
+        lineGroupedTranscriptionLineDetails = DcwAggregation.processSentences(
+            transcriptionLineDetailsFrame, subjectsFrame)
+    numLines = len(transcriptionLineDetailsFrame)
+    del transcriptionLineDetailsFrame
+    with recorder.stage('saveAggregatedData'):
+        DcwAggregation.saveAggregatedData(
+            lineGroupedTranscriptionLineDetails,
+            os.path.join(outputDirectory, 'consensus-linewise.csv'),
+            os.path.join(outputDirectory, 'consensus-subjectwise.csv'))
+
+    return OrderedDict([
+        ('counts', OrderedDict([
+            ('telegrams', nTelegramsParsed),
+            ('subjects', numSubjects),
+            ('transcribedLines', numLines),
+            ('lineGroups', len(lineGroupedTranscriptionLineDetails))
+        ])),
+        ('startRssBytes', startRss),
+        ('totalSeconds', recorder.getTotalTime()),
+        ('stages', recorder.stages)
+    ])
+
+# Run in a worker process by runBenchmarks. The pipeline output is quiet
+# and discarded, so that only the summary of every size is printed.
+
+
+def runPipelineJob(sampleDataFileName, subjectDataFileName,
+                   traceAllocations=False):
+    import DcwAggregation
+
+    DcwAggregation.verbose = False
+    with tempfile.TemporaryDirectory(
+            prefix='pipelineBenchmark-') as outputDirectory:
+        with open(os.devnull, 'w') as devNull, contextlib.redirect_stdout(
+                devNull):
+            return runPipeline(sampleDataFileName, subjectDataFileName,
+                               outputDirectory, traceAllocations)
+
+
+def getGitRevision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def getEnvironment():
+    from ClassificationRowDecoder import fastJsonBackend
+
+    return OrderedDict([
+        ('gitRevision', getGitRevision()),
+        ('python', platform.python_version()),
+        ('numpy', np.__version__),
+        ('pandas', pd.__version__),
+        ('jsonBackend', fastJsonBackend),
+        ('platform', platform.platform()),
+        ('processor', platform.processor() or platform.machine()),
+        ('cpuCount', os.cpu_count())
+    ])
+
+
+def formatBytes(numBytes):
+    return '{:.1f} MB'.format(numBytes / 1024.0**2)
+
+
+def formatSizeResult(sizeResult):
+    reportLines = ['{} classifications: {:.2f} s, peak RSS {} ({})'.format(
+        sizeResult['numClassifications'],
+        sizeResult['totalSeconds'],
+        formatBytes(sizeResult['stages'][-1]['peakRssBytes']),
+        ', '.join('{}={}'.format(name, count)
+                  for name, count in sizeResult['counts'].items()))]
+    for stageRecord in sizeResult['stages']:
+        reportLines.append('  {:<28} {:9.3f} s  {:>10}{}'.format(
+            stageRecord['stage'], stageRecord['seconds'],
+            formatBytes(stageRecord['peakRssBytes']),
+            '  (allocated {})'.format(formatBytes(
+                stageRecord['peakAllocatedBytes']))
+            if 'peakAllocatedBytes' in stageRecord else ''))
+    return '\n'.join(reportLines)
+
+# Run the pipeline on a synthetic export of every size (generating the
+# exports that are not yet in exportDirectory) and store the results in
+# resultsDirectory as benchmarkResultsFileNamePattern.format(label=label).
+# The label defaults to the git revision (or the date if there is none).
+
+
+def runBenchmarks(sizes=benchmarkSizes, label=None,
+                  exportDirectory=benchmarkExportDirectory,
+                  resultsDirectory=benchmarkResultsDirectory,
+                  traceAllocations=traceAllocations, **parameters):
+    exportParameters = getExportParameters(**parameters)
+    environment = getEnvironment()
+    if label is None:
+        label = environment['gitRevision'] or datetime.datetime.now(
+        ).strftime('%Y%m%d-%H%M%S')
+    results = OrderedDict([
+        ('label', label),
+        ('date', datetime.datetime.now().isoformat()),
+        ('environment', environment),
+        ('exportParameters', exportParameters),
+        ('traceAllocations', traceAllocations),
+        ('sizes', [])
+    ])
+
+    os.makedirs(resultsDirectory, exist_ok=True)
+    resultsFileName = os.path.join(
+        resultsDirectory, benchmarkResultsFileNamePattern.format(label=label))
+    for numClassifications in sizes:
+        startTime = time.perf_counter()
+        sampleDataFileName, subjectDataFileName = getSyntheticExport(
+            numClassifications, exportDirectory, **exportParameters)
+        print('Synthetic export of {} classifications ready in {:.1f} s: {}'.format(
+            numClassifications, time.perf_counter() - startTime,
+            sampleDataFileName))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+            sizeResult = OrderedDict([
+                ('numClassifications', numClassifications),
+                ('exportKey', getExportKey(numClassifications,
+                                           exportParameters)),
+                ('exportBytes', os.path.getsize(sampleDataFileName))
+            ])
+            sizeResult.update(executor.submit(
+                runPipelineJob, sampleDataFileName, subjectDataFileName,
+                traceAllocations).result())
+        results['sizes'].append(sizeResult)
+        print(formatSizeResult(sizeResult))
+        # store the results after every size, so that the smaller sizes are
+        # kept if a larger one fails
+        with open(resultsFileName, 'w') as resultsFile:
+            json.dump(results, resultsFile, indent=2)
+    print('Stored the results in {}'.format(resultsFileName))
+    return results
+
+
+def loadBenchmarkResults(resultsFileName):
+    with open(resultsFileName) as resultsFile:
+        return json.load(resultsFile)
+
+# Print the ratios of the stage times and peak RSS of two runs (new /
+# baseline) for every size that both runs measured on the same export.
+
+
+def compareBenchmarks(baselineFileName, resultsFileName):
+    baseline = loadBenchmarkResults(baselineFileName)
+    results = loadBenchmarkResults(resultsFileName)
+    baselineSizes = {(sizeResult['numClassifications'],
+                      sizeResult['exportKey']): sizeResult
+                     for sizeResult in baseline['sizes']}
+    print('{} ({}) vs baseline {} ({})'.format(
+        results['label'], results['environment']['gitRevision'],
+        baseline['label'], baseline['environment']['gitRevision']))
+    numCompared = 0
+    for sizeResult in results['sizes']:
+        baselineResult = baselineSizes.get((sizeResult['numClassifications'],
+                                            sizeResult['exportKey']))
+        if baselineResult is None:
+            print('{} classifications: no baseline for this export'.format(
+                sizeResult['numClassifications']))
+            continue
+        numCompared += 1
+        baselineStages = {stageRecord['stage']: stageRecord
+                          for stageRecord in baselineResult['stages']}
+        print('{} classifications: {:.2f} s vs {:.2f} s ({:.2f}x)'.format(
+            sizeResult['numClassifications'], sizeResult['totalSeconds'],
+            baselineResult['totalSeconds'],
+            sizeResult['totalSeconds'] / baselineResult['totalSeconds']))
+        for stageRecord in sizeResult['stages']:
+            baselineStage = baselineStages.get(stageRecord['stage'])
+            if baselineStage is None:
+                continue
+            print('  {:<28} {:9.3f} s {:9.3f} s {:6.2f}x   peak RSS {:6.2f}x'.format(
+                stageRecord['stage'], stageRecord['seconds'],
+                baselineStage['seconds'],
+                stageRecord['seconds'] / max(baselineStage['seconds'], 1e-9),
+                stageRecord['peakRssBytes'] / float(
+                    baselineStage['peakRssBytes'])))
+    return numCompared
+
+
+def benchmark(*sizes):
+    sizes = [int(size) for size in sizes] if sizes else [10000]
+    with tempfile.TemporaryDirectory(
+            prefix='pipelineBenchmark-') as benchmarkDirectory:
+        results = runBenchmarks(
+            sizes, 'benchmark', os.path.join(benchmarkDirectory, 'exports'),
+            os.path.join(benchmarkDirectory, 'results'))
+    # every size must have run every stage
+    numIncomplete = len([
+        sizeResult for sizeResult in results['sizes']
+        if [stageRecord['stage'] for stageRecord in sizeResult['stages']] !=
+        list(pipelineStages)
+    ])
+    print('Incomplete runs: {}'.format(numIncomplete))
+    return numIncomplete
+
+
+if __name__ == '__main__':
+    # python PipelineBenchmark.py run [label] [sizes...]
+    # python PipelineBenchmark.py compare <baseline json> <results json>
+    # python PipelineBenchmark.py [sizes...] (quick check in a temporary
+    # directory)
+    if len(sys.argv) > 1 and sys.argv[1] == 'run':
+        runBenchmarks([int(size) for size in sys.argv[3:]] or benchmarkSizes,
+                      sys.argv[2] if len(sys.argv) > 2 else None)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        sys.exit(0 if compareBenchmarks(sys.argv[2], sys.argv[3]) > 0 else 1)
+    else:
+        sys.exit(1 if benchmark(*sys.argv[1:]) > 0 else 0)
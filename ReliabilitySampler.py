@@ -0,0 +1,240 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from SubjectDocuments import tableExists
+
+# Samples the subjects of the consensus database in steps of reliability, as
+# SubjectSelector::getSubjectData in serveConsensus.php does with one
+# ORDER BY RAND() query (a scan and sort of Subjects) per step.
+#
+# The index is built once, after the database is loaded: the ReliabilityIndex
+# table holds the subjects sorted by reliability (position is the rank of a
+# subject), so the subjects of any step are a contiguous range of positions
+# that is found with two lookups in the index on subjectReliability. For the
+# numbers of steps in bucketCounts (the viewer requests 10), the offsets of
+# every step are stored in ReliabilityBuckets and the subjects of every step
+# are stored in a shuffled order in ReliabilityBucketSubjects. A sample of N
+# subjects of such a step is then N consecutive shuffled subjects from a
+# random offset (wrapping around), and a sample of any other step is N
+# distinct random positions of its range. Either way, sampling N subjects
+# from K steps reads O(K N) rows by their primary keys.
+#
+# As in the PHP, a step holds the subjects whose reliability lies strictly
+# between its bounds, and samples are repeatable when a seed is given.
+
+reliabilityBucketCounts = (10, )
+
+reliabilitySqliteSchema = [
+    '''CREATE TABLE IF NOT EXISTS ReliabilityIndex (
+    position INTEGER NOT NULL PRIMARY KEY,
+    subjectId INT NOT NULL,
+    subjectReliability REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS ReliabilityBuckets (
+    numBuckets INT NOT NULL,
+    bucketIndex INT NOT NULL,
+    minReliability REAL NOT NULL,
+    maxReliability REAL NOT NULL,
+    start INT NOT NULL,
+    end INT NOT NULL,
+    PRIMARY KEY (numBuckets, bucketIndex)
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS ReliabilityBucketSubjects (
+    numBuckets INT NOT NULL,
+    position INT NOT NULL,
+    subjectId INT NOT NULL,
+    PRIMARY KEY (numBuckets, position)
+    ) WITHOUT ROWID''',
+    'CREATE INDEX IF NOT EXISTS ReliabilityIndexReliability ON ReliabilityIndex (subjectReliability)'
+]
+
+reliabilityTables = ['ReliabilityIndex', 'ReliabilityBuckets',
+                     'ReliabilityBucketSubjects']
+sampleQuery = 'SELECT id, huntingtonId, subjectReliability, url FROM Subjects WHERE id = ?'
+
+
+def getStepBounds(numSteps):
+    # the bounds of the steps of SubjectSelector::getSubjectData
+    if numSteps <= 0:
+        return []
+    stepSize = 1.0 / numSteps
+    return [(stepSize * iStep, stepSize * (iStep + 1))
+            for iStep in range(numSteps)]
+
+
+def storeReliabilityIndex(connection, bucketCounts=reliabilityBucketCounts,
+                          seed=0):
+    '''Replace the reliability index of the subjects in the database.
+
+    Returns the number of indexed subjects.
+    '''
+    cursor = connection.cursor()
+    for table in reliabilityTables:
+        cursor.execute('DROP TABLE IF EXISTS {}'.format(table))
+    for statement in reliabilitySqliteSchema:
+        cursor.execute(statement)
+
+    subjectRows = cursor.execute(
+        'SELECT id, subjectReliability FROM Subjects').fetchall()
+    subjectIds = np.array([row[0] for row in subjectRows], dtype=np.int64)
+    reliabilities = np.array([row[1] for row in subjectRows],
+                             dtype=np.float64)
+    order = np.lexsort([subjectIds, reliabilities])
+    subjectIds = subjectIds[order]
+    reliabilities = reliabilities[order]
+    cursor.executemany(
+        'INSERT INTO ReliabilityIndex (position, subjectId, '
+        'subjectReliability) VALUES (?, ?, ?)',
+        zip(range(len(subjectIds)), subjectIds.tolist(),
+            reliabilities.tolist()))
+
+    rng = np.random.RandomState(seed)
+    for numBuckets in bucketCounts:
+        bucketRows = []
+        bucketSubjectRows = []
+        for bucketIndex, (minReliability, maxReliability) in enumerate(
+                getStepBounds(numBuckets)):
+            start = int(np.searchsorted(reliabilities, minReliability,
+                                        'right'))
+            end = max(start, int(np.searchsorted(reliabilities,
+                                                 maxReliability, 'left')))
+            bucketRows.append((numBuckets, bucketIndex, minReliability,
+                               maxReliability, start, end))
+            # the shuffled subjects of a bucket occupy the positions of its
+            # subjects in ReliabilityIndex
+            bucketSubjectRows.extend(
+                (numBuckets, start + iSubject, subjectId)
+                for iSubject, subjectId in enumerate(
+                    rng.permutation(subjectIds[start:end]).tolist()))
+        cursor.executemany(
+            'INSERT INTO ReliabilityBuckets (numBuckets, bucketIndex, '
+            'minReliability, maxReliability, start, end) '
+            'VALUES (?, ?, ?, ?, ?, ?)', bucketRows)
+        cursor.executemany(
+            'INSERT INTO ReliabilityBucketSubjects (numBuckets, position, '
+            'subjectId) VALUES (?, ?, ?)', bucketSubjectRows)
+    connection.commit()
+    return len(subjectIds)
+
+
+def sampleDistinct(rng, numValues, numSamples):
+    # numSamples distinct integers in [0, numValues) (Floyd's algorithm)
+    chosen = []
+    chosenValues = set()
+    for upperValue in range(numValues - numSamples, numValues):
+        value = rng.randint(upperValue + 1)
+        if value in chosenValues:
+            value = upperValue
+        chosen.append(value)
+        chosenValues.add(value)
+    return chosen
+
+
+class ReliabilitySampler():
+
+    def __init__(self, _connection):
+        self.connection = _connection
+
+    def getStoredBuckets(self, numBuckets):
+        return self.connection.execute(
+            'SELECT start, end FROM ReliabilityBuckets WHERE numBuckets = ? '
+            'ORDER BY bucketIndex', (numBuckets, )).fetchall()
+
+    def getRange(self, minReliability, maxReliability):
+        # the positions of the subjects with reliabilities strictly between
+        # the bounds
+        # (the index on subjectReliability is ordered by reliability, then
+        # by position)
+        start = self.connection.execute(
+            'SELECT position FROM ReliabilityIndex WHERE subjectReliability > ? '
+            'ORDER BY subjectReliability, position LIMIT 1',
+            (minReliability, )).fetchone()
+        end = self.connection.execute(
+            'SELECT position FROM ReliabilityIndex WHERE subjectReliability < ? '
+            'ORDER BY subjectReliability DESC, position DESC LIMIT 1',
+            (maxReliability, )).fetchone()
+        if start is None or end is None or end[0] < start[0]:
+            return 0, 0
+        return start[0], end[0] + 1
+
+    def sampleIds(self, numSamples, numSteps, rng):
+        # the ids of the subjects sampled from every step
+        storedBuckets = self.getStoredBuckets(numSteps)
+        sampledIds = []
+        for iStep, (minReliability, maxReliability) in enumerate(
+                getStepBounds(numSteps)):
+            if len(storedBuckets) == numSteps:
+                start, end = storedBuckets[iStep]
+                numStepSamples = min(numSamples, end - start)
+                offset = rng.randint(end - start) if end > start else 0
+                stepIds = [row[0] for row in self.connection.execute(
+                    'SELECT subjectId FROM ReliabilityBucketSubjects WHERE '
+                    'numBuckets = ? AND position >= ? AND position < ? '
+                    'ORDER BY position', (numSteps, start + offset, start +
+                                          min(offset + numStepSamples,
+                                              end - start)))]
+                stepIds += [row[0] for row in self.connection.execute(
+                    'SELECT subjectId FROM ReliabilityBucketSubjects WHERE '
+                    'numBuckets = ? AND position >= ? AND position < ? '
+                    'ORDER BY position',
+                    (numSteps, start, start + offset + numStepSamples -
+                     (end - start)))]
+            else:
+                start, end = self.getRange(minReliability, maxReliability)
+                stepIds = [
+                    self.connection.execute(
+                        'SELECT subjectId FROM ReliabilityIndex WHERE '
+                        'position = ?', (start + position, )).fetchone()[0]
+                    for position in sampleDistinct(
+                        rng, end - start, min(numSamples, end - start))
+                ]
+            sampledIds.append(stepIds)
+        return sampledIds
+
+    def getSubjectData(self, numSamples, numSteps, seed=None):
+        # the response of SubjectSelector::getSubjectData
+        if numSteps <= 0:
+            return None
+        rng = np.random.RandomState(seed)
+        cursor = self.connection.cursor()
+        allResults = []
+        for (minReliability, maxReliability), stepIds in zip(
+                getStepBounds(numSteps),
+                self.sampleIds(numSamples, numSteps, rng)):
+            exampleData = []
+            for subjectId in stepIds:
+                cursor.execute(sampleQuery, (subjectId, ))
+                columns = [description[0]
+                           for description in cursor.description]
+                exampleData.append(OrderedDict(zip(columns,
+                                                   cursor.fetchone())))
+            allResults.append(OrderedDict([
+                ('minReliability', minReliability),
+                ('maxReliability', maxReliability),
+                ('exampleData', exampleData)
+            ]))
+        return allResults
+
+
+def hasReliabilityIndex(connection):
+    return all(tableExists(connection, table) for table in reliabilityTables)
+
+
+def getSubjectDataReference(connection, numSamples, numSteps):
+    # SubjectSelector::getSubjectData: one ORDER BY RANDOM() query per step
+    allResults = []
+    for minReliability, maxReliability in getStepBounds(numSteps):
+        cursor = connection.execute(
+            'SELECT id, huntingtonId, subjectReliability, url FROM Subjects '
+            'WHERE subjectReliability > ? AND subjectReliability < ? '
+            'ORDER BY RANDOM() LIMIT ?',
+            (minReliability, maxReliability, numSamples))
+        columns = [description[0] for description in cursor.description]
+        allResults.append(OrderedDict([
+            ('minReliability', minReliability),
+            ('maxReliability', maxReliability),
+            ('exampleData', [OrderedDict(zip(columns, row))
+                             for row in cursor.fetchall()])
+        ]))
+    return allResults if numSteps > 0 else None
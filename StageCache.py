@@ -0,0 +1,403 @@
+import gc
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+from MetaTagState import FrozenTagState, emptyTagState
+from StatefulWord import StatefulWord
+
+# Content addressed cache for the outputs of the pipeline stages.
+#
+# Every entry is identified by a key that hashes the stage name, the key of
+# its input (the content hash of the classification export for the first
+# stage, the key of the preceding stage otherwise) and the stage parameters,
+# so an entry can only be reused when everything that it was computed from
+# is unchanged. Changing e.g. the line tolerance therefore only invalidates
+# line grouping and the stages after it.
+#
+# Entries are directories of columns: numeric columns are stored as .npy
+# files and string columns as UTF-8 data with an array of offsets. Entries
+# are written to a temporary directory that is renamed into place, and the
+# least recently used entries are removed when the total size of the cache
+# exceeds maxBytes.
+#
+# Increment stageCacheVersion whenever a stage or an encoding changes in a way
+# that alters its output.
+
+stageCacheVersion = 1
+
+
+class StageCache():
+
+    def __init__(self, _cacheDirectory, _maxBytes=4 * 1024**3):
+        self.cacheDirectory = _cacheDirectory
+        self.maxBytes = _maxBytes
+        self.numHits = 0
+        self.numMisses = 0
+        os.makedirs(self.cacheDirectory, exist_ok=True)
+
+    def makeKey(self, stageName, inputKey, **parameters):
+        keySource = json.dumps([stageCacheVersion, stageName, inputKey,
+                                sorted(parameters.items())], default=str)
+        return hashlib.sha1(keySource.encode('utf-8')).hexdigest()
+
+    def getEntryDirectory(self, stageName, key):
+        return os.path.join(self.cacheDirectory,
+                            '{}-{}'.format(stageName, key))
+
+    def load(self, stageName, key):
+        entryDirectory = self.getEntryDirectory(stageName, key)
+        metadataFileName = os.path.join(entryDirectory, 'meta.json')
+        try:
+            columns = loadColumns(entryDirectory)
+            # the modification time of the metadata records the last use
+            os.utime(metadataFileName)
+        except (OSError, ValueError, KeyError):
+            self.numMisses += 1
+            return None
+        self.numHits += 1
+        return columns
+
+    def store(self, stageName, key, columns):
+        entryDirectory = self.getEntryDirectory(stageName, key)
+        temporaryDirectory = tempfile.mkdtemp(prefix='.tmp-',
+                                              dir=self.cacheDirectory)
+        try:
+            saveColumns(temporaryDirectory, columns, stage=stageName, key=key)
+            if os.path.isdir(entryDirectory):
+                shutil.rmtree(entryDirectory, ignore_errors=True)
+            os.rename(temporaryDirectory, entryDirectory)
+        except OSError:
+            # e.g. another process stored the same entry concurrently
+            shutil.rmtree(temporaryDirectory, ignore_errors=True)
+        self.evict(keepDirectory=entryDirectory)
+
+    def listEntries(self):
+        entries = []
+        for entryName in os.listdir(self.cacheDirectory):
+            entryDirectory = os.path.join(self.cacheDirectory, entryName)
+            metadataFileName = os.path.join(entryDirectory, 'meta.json')
+            if entryName.startswith('.') or not os.path.isfile(
+                    metadataFileName):
+                continue
+            entrySize = sum(
+                os.path.getsize(os.path.join(entryDirectory, fileName))
+                for fileName in os.listdir(entryDirectory))
+            entries.append((os.path.getmtime(metadataFileName), entrySize,
+                            entryDirectory))
+        return entries
+
+    def evict(self, keepDirectory=None):
+        # remove the least recently used entries until the cache fits
+        entries = sorted(self.listEntries())
+        totalBytes = sum(entrySize for lastUsed, entrySize, entryDirectory in entries)
+        for lastUsed, entrySize, entryDirectory in entries:
+            if totalBytes <= self.maxBytes:
+                break
+            if entryDirectory == keepDirectory:
+                continue
+            shutil.rmtree(entryDirectory, ignore_errors=True)
+            totalBytes -= entrySize
+        return totalBytes
+
+
+def saveColumns(directory, columns, **attributes):
+    # numeric columns are saved as .npy files and lists of strings as UTF-8
+    # data with offsets, described by meta.json (with any extra attributes)
+    columnKinds = {}
+    for name, values in columns.items():
+        if isinstance(values, np.ndarray):
+            columnKinds[name] = 'array'
+            np.save(os.path.join(directory, name + '.npy'), values)
+        else:
+            columnKinds[name] = 'strings'
+            data, offsets = encodeStrings(values)
+            np.save(os.path.join(directory, name + '.data.npy'), data)
+            np.save(os.path.join(directory, name + '.offsets.npy'), offsets)
+    attributes['columns'] = columnKinds
+    with open(os.path.join(directory, 'meta.json'), 'w') as metadataFile:
+        json.dump(attributes, metadataFile)
+
+
+def loadColumns(directory, mmapMode=None):
+    # numeric columns are memory mapped if an mmapMode (e.g. 'r') is given
+    with open(os.path.join(directory, 'meta.json')) as metadataFile:
+        metadata = json.load(metadataFile)
+    columns = {}
+    for name, kind in metadata['columns'].items():
+        if kind == 'strings':
+            columns[name] = decodeStrings(
+                np.load(os.path.join(directory, name + '.data.npy'),
+                        mmap_mode=mmapMode),
+                np.load(os.path.join(directory, name + '.offsets.npy'),
+                        mmap_mode=mmapMode))
+        else:
+            columns[name] = np.load(os.path.join(directory, name + '.npy'),
+                                    mmap_mode=mmapMode)
+    return columns
+
+
+def hashFile(fileName, blockSize=1 << 22):
+    fileHash = hashlib.sha1()
+    with open(fileName, 'rb') as inputFile:
+        for block in iter(lambda: inputFile.read(blockSize), b''):
+            fileHash.update(block)
+    return fileHash.hexdigest()
+
+
+def encodeStrings(strings):
+    encodedStrings = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encodedStrings) + 1, dtype=np.int64)
+    np.cumsum([len(encodedString) for encodedString in encodedStrings],
+              out=offsets[1:])
+    return np.frombuffer(b''.join(encodedStrings), dtype=np.uint8), offsets
+
+
+def decodeStrings(data, offsets):
+    buffer = data.tobytes()
+    offsets = offsets.tolist()
+    return [buffer[start:end].decode('utf-8')
+            for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def splitFlatValues(values, lengths):
+    ends = np.cumsum(lengths).tolist()
+    return [values[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+
+# Encodings of the stage outputs as columns
+#
+# Ingest: the sorted transcribed line frame built by processLoadedTelegrams.
+# The words of every line are stored as a space separated string, which
+# reproduces the original list since words never contain whitespace.
+
+lineDetailColumns = ['subjectKey', 'transcriptionIndex', 'numLines',
+                     'startedAt', 'x1', 'y1', 'x2', 'y2']
+lineDetailIndexColumns = ['subjectKey', 'y1', 'y2', 'x1', 'x2']
+
+
+def encodeLineDetails(transcriptionLineDetailsFrame):
+    columns = {column: transcriptionLineDetailsFrame[column].values
+               for column in lineDetailColumns}
+    columns['words'] = [' '.join(words)
+                        for words in transcriptionLineDetailsFrame['words']]
+    return columns
+
+
+def decodeLineDetails(columns):
+    transcriptionLineDetailsFrame = pd.DataFrame(
+        {column: columns[column] for column in lineDetailColumns})
+    transcriptionLineDetailsFrame['words'] = [
+        words.split() for words in columns['words']]
+    # the rows were stored in sorted order
+    transcriptionLineDetailsFrame.index = pd.MultiIndex.from_arrays(
+        [transcriptionLineDetailsFrame[column]
+         for column in lineDetailIndexColumns])
+    return transcriptionLineDetailsFrame
+
+
+# Sentence aggregation: the line grouped frame built by aggregateLineGroups.
+# Every StatefulWord is stored as its word, span, sentence and tag state,
+# where sentences and (frozen) tag states are stored once and shared again
+# by the decoded words, as they are in the aggregated data.
+
+
+def encodeLineGroups(lineGroupedTranscriptionLineDetails):
+    frame = lineGroupedTranscriptionLineDetails
+    columns = {column: frame[column].values
+               for column in ['bestLineIndex', 'subjectKey', 'y1', 'y2',
+                              'x1', 'x2']}
+    columns['index'] = frame.index.values
+    for column in ['transcriptionIndex', 'numLines']:
+        columns[column + 'Lengths'] = np.array(
+            [len(values) for values in frame[column]], dtype=np.int64)
+        columns[column] = np.array(
+            [value for values in frame[column] for value in values],
+            dtype=np.int64)
+
+    sentenceIds = {}
+    sentences = []
+    tagStateIds = {}
+    tagStates = []
+    lineReliabilities = []
+    numPositions = []
+    wordReliabilities = []
+    slotSizes = []
+    words = []
+    spans = []
+    wordSentenceIds = []
+    wordTagStateIds = []
+    for aggregatedSentence in frame['words']:
+        lineReliabilities.append(aggregatedSentence['reliability'])
+        numPositions.append(len(aggregatedSentence['words']))
+        wordReliabilities.extend(aggregatedSentence['wordReliabilities'])
+        for wordOptions in aggregatedSentence['words']:
+            slotSizes.append(len(wordOptions))
+            for statefulWord in wordOptions:
+                sentenceId = sentenceIds.get(id(statefulWord.sentence))
+                if sentenceId is None:
+                    sentenceId = sentenceIds[id(statefulWord.sentence)] = len(
+                        sentences)
+                    sentences.append(' '.join(statefulWord.sentence))
+                tagStateId = tagStateIds.get(id(statefulWord.tagStates))
+                if tagStateId is None:
+                    tagStateId = tagStateIds[id(statefulWord.tagStates)] = len(
+                        tagStates)
+                    tagStates.append(json.dumps(statefulWord.tagStates))
+                words.append(statefulWord.word)
+                spans.append(statefulWord.span)
+                wordSentenceIds.append(sentenceId)
+                wordTagStateIds.append(tagStateId)
+
+    columns.update({
+        'reliability': np.array(lineReliabilities, dtype=np.float64),
+        'numPositions': np.array(numPositions, dtype=np.int64),
+        'wordReliabilities': np.array(wordReliabilities, dtype=np.float64),
+        'slotSizes': np.array(slotSizes, dtype=np.int64),
+        'spans': np.array(spans, dtype=np.int64).reshape(-1, 2),
+        'sentenceIds': np.array(wordSentenceIds, dtype=np.int64),
+        'tagStateIds': np.array(wordTagStateIds, dtype=np.int64),
+        'words': words,
+        'sentences': sentences,
+        'tagStates': tagStates
+    })
+    return columns
+
+
+def decodeLineGroups(columns):
+    sentences = [sentence.split() for sentence in columns['sentences']]
+    tagStates = []
+    for tagState in columns['tagStates']:
+        tagState = json.loads(tagState)
+        tagStates.append(FrozenTagState(
+            (tag, tuple(tuple(interval) for interval in intervals))
+            for tag, intervals in tagState.items()) if tagState else emptyTagState)
+
+    # the words cannot form reference cycles, so garbage collection is paused
+    # while they are created, which otherwise dominates the decoding time
+    gcWasEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        statefulWords = [
+            StatefulWord(word, tuple(span), tagStates[tagStateId],
+                         sentences[sentenceId])
+            for word, span, sentenceId, tagStateId in zip(
+                columns['words'], columns['spans'].tolist(),
+                columns['sentenceIds'].tolist(),
+                columns['tagStateIds'].tolist())
+        ]
+    finally:
+        if gcWasEnabled:
+            gc.enable()
+    slotWords = splitFlatValues(statefulWords, columns['slotSizes'])
+    numPositions = columns['numPositions']
+    aggregatedSentences = [
+        {
+            'reliability': lineReliability,
+            'wordReliabilities': lineWordReliabilities,
+            'words': lineWords
+        }
+        for lineReliability, lineWordReliabilities, lineWords in zip(
+            columns['reliability'].tolist(),
+            splitFlatValues(columns['wordReliabilities'].tolist(),
+                            numPositions),
+            splitFlatValues(slotWords, numPositions))
+    ]
+
+    lineGroupedTranscriptionLineDetails = pd.DataFrame(
+        {'bestLineIndex': columns['bestLineIndex']},
+        index=pd.Index(columns['index'], name='subjectKey'))
+    lineGroupedTranscriptionLineDetails['words'] = aggregatedSentences
+    for column in ['subjectKey', 'y1', 'y2', 'x1', 'x2']:
+        lineGroupedTranscriptionLineDetails[column] = columns[column]
+    for column in ['transcriptionIndex', 'numLines']:
+        lineGroupedTranscriptionLineDetails[column] = [
+            tuple(values) for values in splitFlatValues(
+                columns[column].tolist(), columns[column + 'Lengths'])
+        ]
+    return lineGroupedTranscriptionLineDetails
+
+
+# Row operations on encoded stage outputs, so that the rows of some subjects
+# can be replaced without decoding the others. takeRows and concatenateRows
+# handle tables with one value per row (e.g. encoded line details), the line
+# group variants also handle the flat and shared columns of encodeLineGroups.
+
+
+def gatherRanges(starts, lengths):
+    # concatenation of range(start, start + length) for all pairs
+    lengths = np.asarray(lengths, dtype=np.int64)
+    rangeStarts = np.cumsum(lengths) - lengths
+    return np.repeat(np.asarray(starts, dtype=np.int64) - rangeStarts,
+                     lengths) + np.arange(lengths.sum(), dtype=np.int64)
+
+
+def takeValues(values, indices):
+    if isinstance(values, np.ndarray):
+        return values[indices]
+    return [values[index] for index in indices.tolist()]
+
+
+def takeRows(columns, rows):
+    return {name: takeValues(values, rows) for name, values in columns.items()}
+
+
+def concatenateRows(columnsList):
+    return {
+        name: np.concatenate([columns[name] for columns in columnsList])
+        if isinstance(columnsList[0][name], np.ndarray) else
+        [value for columns in columnsList for value in columns[name]]
+        for name in columnsList[0]
+    }
+
+
+lineGroupRowColumns = ['bestLineIndex', 'subjectKey', 'y1', 'y2', 'x1', 'x2',
+                       'index', 'reliability', 'numPositions',
+                       'transcriptionIndexLengths', 'numLinesLengths']
+lineGroupElementColumns = ['spans', 'sentenceIds', 'tagStateIds', 'words']
+
+
+def takeLineGroupRows(columns, rows):
+    rows = np.asarray(rows, dtype=np.int64)
+    selected = {name: columns[name][rows] for name in lineGroupRowColumns}
+    for name in ['transcriptionIndex', 'numLines']:
+        lengths = columns[name + 'Lengths']
+        selected[name] = columns[name][gatherRanges(
+            (np.cumsum(lengths) - lengths)[rows], lengths[rows])]
+
+    numPositions = columns['numPositions']
+    slots = gatherRanges((np.cumsum(numPositions) - numPositions)[rows],
+                         numPositions[rows])
+    selected['wordReliabilities'] = columns['wordReliabilities'][slots]
+    slotSizes = columns['slotSizes']
+    selected['slotSizes'] = slotSizes[slots]
+    elements = gatherRanges((np.cumsum(slotSizes) - slotSizes)[slots],
+                            slotSizes[slots])
+    for name in lineGroupElementColumns:
+        selected[name] = takeValues(columns[name], elements)
+
+    # only keep the shared sentences and tag states that are still used
+    for idName, tableName in [('sentenceIds', 'sentences'),
+                              ('tagStateIds', 'tagStates')]:
+        usedIds, selected[idName] = np.unique(selected[idName],
+                                              return_inverse=True)
+        selected[idName] = selected[idName].reshape(-1).astype(np.int64)
+        selected[tableName] = takeValues(columns[tableName], usedIds)
+    return selected
+
+
+def concatenateLineGroups(columnsList):
+    concatenated = concatenateRows(columnsList)
+    for idName, tableName in [('sentenceIds', 'sentences'),
+                              ('tagStateIds', 'tagStates')]:
+        tableOffsets = np.cumsum([0] + [len(columns[tableName])
+                                        for columns in columnsList[:-1]])
+        concatenated[idName] = np.concatenate([
+            columns[idName] + tableOffset
+            for columns, tableOffset in zip(columnsList, tableOffsets)
+        ])
+    return concatenated
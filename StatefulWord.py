@@ -1,5 +1,7 @@
 class StatefulWord():
 
+    __slots__ = ('word', 'tagStates', 'sentence', 'span')
+
     def __init__(self, _word, _span, _tagStates, _sentence):
         self.word = _word
         self.tagStates = _tagStates
@@ -0,0 +1,432 @@
+import gzip
+import itertools
+import json
+from collections import OrderedDict
+
+from ConsensusDatabaseLoader import decodeWordTags, findWordTag
+from LineBoxIndex import getLinesForBoxesReference
+
+# Precomputed responses of the getSubjectData task of serveConsensus.php.
+#
+# For every page view, ConsensusProcessor joins the Subjects, SubjectLines and
+# LineWords tables, regroups the words of every line, matches the lines to
+# the telegram boxes and queries the metatags of the subject. Here the same
+# document (the array returned by ConsensusProcessor::getAllResults) is built
+# once for every subject of the consensus database, encoded as JSON, gzip
+# compressed and stored in the SubjectDocuments table, keyed by the id of the
+# subject in the Subjects table (the id parameter of getSubjectData). Serving
+# a subject is then a single primary key lookup, and the stored bytes can be
+# sent as they are with Content-Encoding: gzip.
+#
+# The documents reproduce the PHP arrays, including their quirks: the word
+# starts, ends and transcription indices of a line keep the entries of
+# longer previous lines (only the words are reset for every line), a line of
+# nulls precedes the lines of a subject whose first line with words is not
+# line 0, and boxes without lines have null lines. Values are JSON numbers
+# rather than the strings that mysqli returns, and the mean reliability of a
+# box without lines (a division by zero in PHP) is null.
+#
+# The tags of the words are read from the WordTags table (see
+# ConsensusDatabaseLoader), so the tag of a word is a dictionary lookup of its
+# span. Spans without a stored state (e.g. those of the words that the PHP
+# carries over from previous lines) are matched with the tags of the line, as
+# getWordTag does.
+#
+# The boxes and telegrams of a subject are those with its zooniverseId (see
+# BoxConsensus.boxSqliteSchema). The lines of every box are read from the
+# BoxLines table (see LineBoxIndex) when it exists and matched as by
+# LineBoxMatcher otherwise.
+
+subjectDocumentCompressLevel = 6
+subjectDocumentChunkSize = 500
+
+subjectDocumentSqliteSchema = [
+    '''CREATE TABLE IF NOT EXISTS SubjectDocuments (
+    subjectId INTEGER NOT NULL PRIMARY KEY,
+    zooniverseId INT NOT NULL,
+    document BLOB NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS SubjectDocumentsZooniverseId ON SubjectDocuments (zooniverseId)'
+]
+
+subjectQuery = 'SELECT id, zooniverseId, huntingtonId, url, subjectReliability FROM Subjects'
+# the columns of SubjectLines.* and LineWords.* that the PHP reads; the id of
+# a line is that of its last word, since both tables have an id column
+wordQuery = ('SELECT Subjects.id, SubjectLines.bestLineIndex, '
+             'SubjectLines.meanX1, SubjectLines.meanX2, SubjectLines.meanY1, '
+             'SubjectLines.meanY2, SubjectLines.lineReliability, LineWords.id, '
+             'LineWords.wordText, LineWords.position, LineWords.rank, '
+             'LineWords.transcriptionIndex, LineWords.spanStart, '
+             'LineWords.spanEnd FROM Subjects '
+             'JOIN SubjectLines ON SubjectLines.subjectId = Subjects.id '
+             'JOIN LineWords ON LineWords.lineId = SubjectLines.id '
+             'WHERE Subjects.id IN ({}) '
+             'ORDER BY Subjects.id, LineWords.lineId, LineWords.position, '
+             'LineWords.rank')
+metaTagQuery = ('SELECT transcriptionIndex, bestLineIndex, start, end, state '
+                'FROM MetaTags WHERE transcriptionIndex IN ({}) ORDER BY id')
+wordTagQuery = ('SELECT WordTags.transcriptionIndex, SubjectLines.bestLineIndex, '
+                'WordTags.wordTags FROM WordTags '
+                'JOIN SubjectLines ON SubjectLines.id = WordTags.lineId '
+                'WHERE WordTags.subjectId IN ({})')
+
+
+def tableExists(connection, table):
+    return connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (table, )).fetchone() is not None
+
+
+def formatPlaceholders(values):
+    return ', '.join(['?'] * len(values))
+
+
+def toJsonArray(phpArray):
+    # PHP arrays (dicts) whose keys are 0..n-1 in order are encoded as JSON
+    # arrays, any others as objects
+    values = list(phpArray.values())
+    if all(key == index for index, key in enumerate(phpArray)):
+        return values
+    return OrderedDict((str(key), value) for key, value in phpArray.items())
+
+
+def getWordTag(metaTagLookup, transcriptionIndex, lineIndex, start, end):
+    # MetaTagHandler::getWordTag
+    lineTags = metaTagLookup.get((transcriptionIndex, lineIndex))
+    if lineTags is None:
+        return False
+    wordSpanStates, tagSpans = lineTags
+    wordTag = wordSpanStates.get((start, end))
+    if wordTag is not None:
+        return wordTag
+    return findWordTag(tagSpans, start, end)
+
+
+def makeLineEntry(subjectRow, lastRow, lineWords, lineWordStarts, lineWordEnds,
+                  lineWordTranscriptionIndices, metaTagLookup):
+    # ConsensusProcessor::updateResults
+    if lastRow is None:
+        lastRow = (None, ) * 14
+        url = None
+    else:
+        url = subjectRow[3]
+    lineIndex = lastRow[1]
+    lineWordMetaTags = []
+    for iWord in range(len(lineWordTranscriptionIndices)):
+        wordTranscriptionIndices = lineWordTranscriptionIndices.get(iWord, {})
+        wordStarts = lineWordStarts.get(iWord, {})
+        wordEnds = lineWordEnds.get(iWord, {})
+        lineWordMetaTags.append([
+            getWordTag(metaTagLookup, wordTranscriptionIndices.get(iRank),
+                       lineIndex, wordStarts.get(iRank), wordEnds.get(iRank))
+            for iRank in range(len(wordTranscriptionIndices))
+        ])
+    return OrderedDict([
+        ('id', lastRow[7]),
+        ('subjectId', lastRow[0]),
+        ('bestLineIndex', lineIndex),
+        ('url', url),
+        ('meanX1', lastRow[2]),
+        ('meanX2', lastRow[3]),
+        ('meanY1', lastRow[4]),
+        ('meanY2', lastRow[5]),
+        ('words', toJsonArray(OrderedDict(
+            (position, toJsonArray(words))
+            for position, words in lineWords.items()))),
+        ('wordStarts', toJsonArray(OrderedDict(
+            (position, toJsonArray(starts))
+            for position, starts in lineWordStarts.items()))),
+        ('wordEnds', toJsonArray(OrderedDict(
+            (position, toJsonArray(ends))
+            for position, ends in lineWordEnds.items()))),
+        ('wordTags', lineWordMetaTags),
+        ('wordTransIndices', toJsonArray(OrderedDict(
+            (position, toJsonArray(transcriptionIndices))
+            for position, transcriptionIndices in
+            lineWordTranscriptionIndices.items()))),
+        ('lineReliability', lastRow[6])
+    ])
+
+
+def assembleLineData(subjectRow, wordRows, metaTagLookup):
+    # ConsensusProcessor::processSubjectLines for the word rows of a subject
+    # (see wordQuery)
+    lineData = []
+    lineWords = OrderedDict()
+    lineWordStarts = OrderedDict()
+    lineWordEnds = OrderedDict()
+    lineWordTranscriptionIndices = OrderedDict()
+    lineIndex = 0
+    lastRow = None
+    for row in wordRows:
+        if row[1] != lineIndex:
+            lineData.append(makeLineEntry(
+                subjectRow, lastRow, lineWords, lineWordStarts, lineWordEnds,
+                lineWordTranscriptionIndices, metaTagLookup))
+            lineIndex = row[1]
+            lineWords = OrderedDict()
+        lastRow = row
+        position = row[9]
+        rank = row[10]
+        lineWords.setdefault(position, OrderedDict())[rank] = row[8]
+        lineWordStarts.setdefault(position, OrderedDict())[rank] = row[12]
+        lineWordEnds.setdefault(position, OrderedDict())[rank] = row[13]
+        lineWordTranscriptionIndices.setdefault(position,
+                                                OrderedDict())[rank] = row[11]
+    if lastRow is not None:
+        lineData.append(makeLineEntry(
+            subjectRow, lastRow, lineWords, lineWordStarts, lineWordEnds,
+            lineWordTranscriptionIndices, metaTagLookup))
+    return lineData
+
+
+def assembleSubjectDocument(subjectRow, wordRows, metaTagLookup, boxRows,
+                            telegramRows, boxLineIndices=None):
+    '''The getAllResults document of a subject.
+
+    subjectRow is its row of subjectQuery, wordRows its rows of wordQuery and
+    metaTagLookup maps (transcriptionIndex, bestLineIndex) to the states of
+    the tagged word spans and the (start, end, state) of the metatags (see
+    ConsensusDatabaseLoader.decodeWordTags). boxRows and telegramRows are the rows of the
+    SubjectBoxes and SubjectTelegrams tables (dicts) and boxLineIndices maps
+    the bestBoxIndex of every box to the bestLineIndex of its lines; if it is
+    None, the lines are matched to the boxes.
+    '''
+    lineData = assembleLineData(subjectRow, wordRows, metaTagLookup)
+    lines = [line for line in lineData if line['bestLineIndex'] is not None]
+    if boxLineIndices is None:
+        boxLines = getLinesForBoxesReference(lines, boxRows)['boxLines']
+    else:
+        linesByIndex = {line['bestLineIndex']: line for line in lines}
+        boxLines = OrderedDict(
+            (box['bestBoxIndex'], [
+                linesByIndex[bestLineIndex]
+                for bestLineIndex in boxLineIndices.get(box['bestBoxIndex'],
+                                                        [])
+                if bestLineIndex in linesByIndex
+            ]) for box in boxRows)
+
+    boxStats = OrderedDict()
+    for bestBoxIndex, linesInBox in boxLines.items():
+        reliability = 0.0
+        for line in linesInBox:
+            reliability += line['lineReliability']
+        boxStats[bestBoxIndex] = OrderedDict([
+            ('reliability',
+             reliability / len(linesInBox) if len(linesInBox) > 0 else None),
+            ('numLines', len(linesInBox))
+        ])
+
+    telegramIndex = 0
+    boxData = []
+    for box in boxRows:
+        box = OrderedDict(box)
+        box['telegramData'] = None
+        if box['numBoxesMarked'] > 1:
+            if telegramIndex < len(telegramRows):
+                box['telegramData'] = telegramRows[telegramIndex]
+            telegramIndex += 1
+        boxData.append(box)
+
+    return OrderedDict([
+        ('subjectData', OrderedDict([
+            ('url', subjectRow[3]),
+            ('huntingtonId', subjectRow[2]),
+            ('reliability', subjectRow[4])
+        ])),
+        ('telegramData', telegramRows),
+        ('boxData', boxData),
+        ('lineData', lineData),
+        ('boxLineData', OrderedDict([
+            ('boxLines', toJsonArray(OrderedDict(
+                (bestBoxIndex, linesInBox if len(linesInBox) > 0 else None)
+                for bestBoxIndex, linesInBox in boxLines.items()))),
+            ('boxStats', toJsonArray(boxStats) if len(boxStats) > 0 else None)
+        ])),
+        ('metaTagResults', None)
+    ])
+
+
+def fetchRecords(cursor, query, parameters):
+    cursor.execute(query, parameters)
+    columns = [description[0] for description in cursor.description]
+    return [OrderedDict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def fetchBoxRecords(connection, zooniverseIds):
+    # the SubjectBoxes and SubjectTelegrams rows of the subjects, by
+    # zooniverseId
+    subjectBoxes = {}
+    subjectTelegrams = {}
+    if len(zooniverseIds) == 0 or not tableExists(connection, 'SubjectBoxes'):
+        return subjectBoxes, subjectTelegrams
+    cursor = connection.cursor()
+    placeholders = formatPlaceholders(zooniverseIds)
+    for box in fetchRecords(
+            cursor, 'SELECT * FROM SubjectBoxes WHERE zooniverseId IN ({}) '
+            'ORDER BY id'.format(placeholders), zooniverseIds):
+        subjectBoxes.setdefault(box['zooniverseId'], []).append(box)
+    for telegram in fetchRecords(
+            cursor, 'SELECT * FROM SubjectTelegrams WHERE zooniverseId IN ({}) '
+            'ORDER BY telegramId, id'.format(placeholders), zooniverseIds):
+        subjectTelegrams.setdefault(telegram['zooniverseId'],
+                                    []).append(telegram)
+    return subjectBoxes, subjectTelegrams
+
+
+def makeMetaTagLookup(metaTagRows):
+    # from MetaTags rows, without word span states
+    metaTagLookup = {}
+    for transcriptionIndex, bestLineIndex, start, end, state in metaTagRows:
+        metaTagLookup.setdefault((transcriptionIndex, bestLineIndex),
+                                 ({}, []))[1].append((start, end, state))
+    return metaTagLookup
+
+
+def makeWordTagLookup(wordTagRows):
+    return {(transcriptionIndex, bestLineIndex): decodeWordTags(wordTags)
+            for transcriptionIndex, bestLineIndex, wordTags in wordTagRows}
+
+
+def getAllResultsReference(connection, subjectId):
+    # ConsensusProcessor::getAllResults: the queries of a single page request
+    cursor = connection.cursor()
+    subjectRow = cursor.execute(subjectQuery + ' WHERE id = ?',
+                                (subjectId, )).fetchone()
+    if subjectRow is None:
+        return None
+    wordRows = cursor.execute(wordQuery.format('?'), (subjectId, )).fetchall()
+    transcriptionIndices = sorted(set(row[11] for row in wordRows))
+    metaTagLookup = makeMetaTagLookup(
+        cursor.execute(
+            metaTagQuery.format(formatPlaceholders(transcriptionIndices)),
+            transcriptionIndices).fetchall())
+    subjectBoxes, subjectTelegrams = fetchBoxRecords(connection,
+                                                     [subjectRow[1]])
+    return assembleSubjectDocument(subjectRow, wordRows, metaTagLookup,
+                                   subjectBoxes.get(subjectRow[1], []),
+                                   subjectTelegrams.get(subjectRow[1], []))
+
+
+def buildSubjectDocuments(connection, zooniverseIds=None,
+                          chunkSize=subjectDocumentChunkSize):
+    '''Yield the subjectId, zooniverseId and document of every subject.
+
+    The subjects (all, or those with the given zooniverseIds) are read in
+    chunks of chunkSize subjects with one query per table.
+    '''
+    cursor = connection.cursor()
+    if zooniverseIds is None:
+        subjectRows = cursor.execute(subjectQuery + ' ORDER BY id').fetchall()
+    else:
+        zooniverseIds = sorted(set(zooniverseIds))
+        subjectRows = []
+        for chunkStart in range(0, len(zooniverseIds), chunkSize):
+            chunkIds = zooniverseIds[chunkStart:chunkStart + chunkSize]
+            subjectRows.extend(cursor.execute(
+                subjectQuery + ' WHERE zooniverseId IN ({})'.format(
+                    formatPlaceholders(chunkIds)), chunkIds).fetchall())
+        subjectRows.sort()
+    hasBoxLines = tableExists(connection, 'BoxLines')
+    hasWordTags = tableExists(connection, 'WordTags')
+
+    for chunkStart in range(0, len(subjectRows), chunkSize):
+        chunkRows = subjectRows[chunkStart:chunkStart + chunkSize]
+        subjectIds = [subjectRow[0] for subjectRow in chunkRows]
+        chunkZooniverseIds = sorted(set(
+            subjectRow[1] for subjectRow in chunkRows))
+        placeholders = formatPlaceholders(subjectIds)
+        subjectWordRows = {
+            subjectId: list(wordRows)
+            for subjectId, wordRows in itertools.groupby(
+                cursor.execute(wordQuery.format(placeholders),
+                               subjectIds).fetchall(), lambda row: row[0])
+        }
+        if hasWordTags:
+            metaTagLookup = makeWordTagLookup(cursor.execute(
+                wordTagQuery.format(placeholders), subjectIds).fetchall())
+        else:
+            metaTagLookup = makeMetaTagLookup(
+                cursor.execute(
+                    metaTagQuery.format(
+                        'SELECT LineWords.transcriptionIndex FROM SubjectLines '
+                        'JOIN LineWords ON LineWords.lineId = SubjectLines.id '
+                        'WHERE SubjectLines.subjectId IN ({})'.format(
+                            placeholders)), subjectIds).fetchall())
+        subjectBoxes, subjectTelegrams = fetchBoxRecords(connection,
+                                                         chunkZooniverseIds)
+        subjectBoxLineIndices = {}
+        if hasBoxLines and len(subjectBoxes) > 0:
+            for zooniverseId, bestBoxIndex, bestLineIndex in cursor.execute(
+                    'SELECT zooniverseId, bestBoxIndex, bestLineIndex FROM '
+                    'BoxLines WHERE zooniverseId IN ({}) ORDER BY rowid'.format(
+                        formatPlaceholders(chunkZooniverseIds)),
+                    chunkZooniverseIds).fetchall():
+                subjectBoxLineIndices.setdefault(zooniverseId, {}).setdefault(
+                    bestBoxIndex, []).append(bestLineIndex)
+
+        for subjectRow in chunkRows:
+            subjectId, zooniverseId = subjectRow[0:2]
+            yield subjectId, zooniverseId, assembleSubjectDocument(
+                subjectRow, subjectWordRows.get(subjectId, []), metaTagLookup,
+                subjectBoxes.get(zooniverseId, []),
+                subjectTelegrams.get(zooniverseId, []),
+                subjectBoxLineIndices.get(zooniverseId, {})
+                if hasBoxLines else None)
+
+
+def encodeSubjectDocument(document, compressLevel=subjectDocumentCompressLevel):
+    return gzip.compress(
+        json.dumps(document, separators=(',', ':')).encode('utf-8'),
+        compresslevel=compressLevel, mtime=0)
+
+
+def decodeSubjectDocument(encodedDocument):
+    return json.loads(gzip.decompress(encodedDocument).decode('utf-8'))
+
+
+def storeSubjectDocuments(connection, zooniverseIds=None,
+                          compressLevel=subjectDocumentCompressLevel,
+                          batchSize=1000):
+    '''Build and store the documents of every subject of the database.
+
+    If zooniverseIds are given, only the documents of these subjects are
+    replaced. Returns the number of stored documents and their total size.
+    '''
+    cursor = connection.cursor()
+    if zooniverseIds is None:
+        cursor.execute('DROP TABLE IF EXISTS SubjectDocuments')
+    for statement in subjectDocumentSqliteSchema:
+        cursor.execute(statement)
+    if zooniverseIds is not None:
+        cursor.executemany(
+            'DELETE FROM SubjectDocuments WHERE zooniverseId = ?',
+            [(int(zooniverseId), ) for zooniverseId in zooniverseIds])
+
+    numDocuments = 0
+    numBytes = 0
+    rows = []
+    for subjectId, zooniverseId, document in buildSubjectDocuments(
+            connection, zooniverseIds):
+        encodedDocument = encodeSubjectDocument(document, compressLevel)
+        rows.append((subjectId, zooniverseId, encodedDocument))
+        numDocuments += 1
+        numBytes += len(encodedDocument)
+        if len(rows) >= batchSize:
+            cursor.executemany(
+                'INSERT INTO SubjectDocuments (subjectId, zooniverseId, '
+                'document) VALUES (?, ?, ?)', rows)
+            rows = []
+    cursor.executemany(
+        'INSERT INTO SubjectDocuments (subjectId, zooniverseId, document) '
+        'VALUES (?, ?, ?)', rows)
+    connection.commit()
+    return numDocuments, numBytes
+
+
+def loadSubjectDocument(connection, subjectId):
+    # the encoded document of a subject, or None
+    row = connection.execute(
+        'SELECT document FROM SubjectDocuments WHERE subjectId = ?',
+        (subjectId, )).fetchone()
+    return None if row is None else row[0]
@@ -0,0 +1,229 @@
+import csv
+import hashlib
+import json
+import os
+import re as regex
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+from ClassificationRowDecoder import fastJsonLoads
+from StageCache import saveColumns, loadColumns, hashFile
+
+# Index of the subject metadata (Huntington id and image URL of every
+# subject) that is joined with the consensus of every manuscript.
+#
+# The subject export is parsed once and the index is persisted in
+# indexDirectory as memory mapped columns in the StageCache format. An index
+# is reused as long as the size and modification time of the subject file
+# are unchanged; otherwise the file is hashed and the index is only rebuilt
+# if its content changed. Indices are also kept in memory, so the manuscripts
+# that are processed by the same process share a single index.
+#
+# The rows are kept in file order, including repeated subject ids, so
+# getFrame returns the same frame as DcwAggregation.loadSubjectData.
+#
+# The index also holds the page fields of the box consensus: the collection,
+# ledger, page and variant encoded in the Huntington id and the numbers of
+# the telegrams on the page (see getPageFrame). Ledger and page numbers that
+# are not integers are stored as -1.
+
+subjectIndexVersion = 2
+loadedSubjectIndices = {}
+
+telegramTokenPattern = regex.compile(r"[\w']+")
+telegramNumberPattern = regex.compile(r'[0-9]+')
+
+
+class SubjectIndex():
+
+    def __init__(self, _columns, _sourceSummary):
+        self.columns = _columns
+        self.sourceSummary = _sourceSummary
+        self.contentHash = _sourceSummary['contentHash']
+        self.subjectsFrame = None
+
+    def getNumSubjects(self):
+        return len(self.columns['subjectId'])
+
+    def getFrame(self):
+        # the frame is built once, on first use
+        if self.subjectsFrame is None:
+            self.subjectsFrame = pd.DataFrame(
+                {
+                    'huntington_id': self.columns['huntingtonId'],
+                    'url': self.columns['url']
+                },
+                index=pd.Index(np.asarray(self.columns['subjectId']),
+                               name='subject_id'))
+        return self.subjectsFrame
+
+    def getPageFrame(self):
+        # the subject data with the page fields, as used by the box consensus
+        columns = self.columns
+        telegramNumberEnds = np.cumsum(columns['telegramNumberCounts']).tolist()
+        telegramNumbers = np.asarray(columns['telegramNumbers']).tolist()
+        return pd.DataFrame(
+            {
+                'huntington_id': columns['huntingtonId'],
+                'collection': columns['collection'],
+                'ledger': np.asarray(columns['ledger']),
+                'page': np.asarray(columns['page']),
+                'variant': columns['variant'],
+                'telegramNumbers': [
+                    telegramNumbers[telegramNumberStart:telegramNumberEnd]
+                    for telegramNumberStart, telegramNumberEnd in zip(
+                        [0] + telegramNumberEnds[:-1], telegramNumberEnds)
+                ],
+                'url': columns['url']
+            },
+            index=pd.Index(np.asarray(columns['subjectId']),
+                           name='subject_id'))
+
+
+def parseInteger(text):
+    try:
+        return int(text)
+    except ValueError:
+        return -1
+
+
+def parsePageFields(huntingtonId, telegramsField):
+    # collection, ledger, page and variant (e.g. mssEC_03_017a) and the
+    # telegram numbers (e.g. "T1000 T1001") of a page
+    telegramNumbers = []
+    for telegramNumber in telegramTokenPattern.findall(telegramsField):
+        if len(telegramNumber) > 3:
+            digits = telegramNumberPattern.findall(telegramNumber)
+            if len(digits) > 0:
+                telegramNumbers.append(int(digits[0]))
+    return (huntingtonId[3:5], parseInteger(huntingtonId[6:8]),
+            parseInteger(huntingtonId[9:12]), huntingtonId[12:],
+            telegramNumbers)
+
+
+def parseSubjectData(subjectDataFileName):
+    subjectIds = []
+    huntingtonIds = []
+    urls = []
+    pageFields = []
+    with open(subjectDataFileName) as csvfile:
+        parsedSubjectCsv = csv.reader(csvfile)
+        header = next(parsedSubjectCsv)
+        subjectIdColumn = header.index('subject_id')
+        locationsColumn = header.index('locations')
+        metadataColumn = header.index('metadata')
+        for subject in parsedSubjectCsv:
+            parsedMetaData = fastJsonLoads(subject[metadataColumn])
+            if 'hdl_id' not in parsedMetaData:
+                continue
+            subjectIds.append(int(subject[subjectIdColumn]))
+            huntingtonIds.append(parsedMetaData['hdl_id'])
+            urls.append(fastJsonLoads(subject[locationsColumn])['0'])
+            pageFields.append(parsePageFields(
+                parsedMetaData['hdl_id'],
+                parsedMetaData.get('#telegrams', '')))
+    collections, ledgers, pages, variants, telegramNumbers = zip(
+        *pageFields) if len(pageFields) > 0 else ([], ) * 5
+    return {
+        'subjectId': np.array(subjectIds, dtype=np.int64),
+        'huntingtonId': huntingtonIds,
+        'url': urls,
+        'collection': list(collections),
+        'ledger': np.array(ledgers, dtype=np.int64),
+        'page': np.array(pages, dtype=np.int64),
+        'variant': list(variants),
+        'telegramNumbers': np.array(
+            [number for numbers in telegramNumbers for number in numbers],
+            dtype=np.int64),
+        'telegramNumberCounts': np.array(
+            [len(numbers) for numbers in telegramNumbers], dtype=np.int64)
+    }
+
+
+def getSourceSummary(subjectDataFileName):
+    fileStatus = os.stat(subjectDataFileName)
+    return {
+        'fileName': os.path.abspath(subjectDataFileName),
+        'size': fileStatus.st_size,
+        'mtime': fileStatus.st_mtime_ns
+    }
+
+
+def loadSubjectIndex(subjectDataFileName, indexDirectory='subjectIndex'):
+    sourceSummary = getSourceSummary(subjectDataFileName)
+    memoryKey = (sourceSummary['fileName'], sourceSummary['size'],
+                 sourceSummary['mtime'])
+    if memoryKey in loadedSubjectIndices:
+        return loadedSubjectIndices[memoryKey]
+
+    entryDirectory = os.path.join(indexDirectory, '{}-{}'.format(
+        os.path.basename(subjectDataFileName),
+        hashFileName(sourceSummary['fileName'])))
+    metadataFileName = os.path.join(entryDirectory, 'meta.json')
+    metadata = None
+    try:
+        with open(metadataFileName) as metadataFile:
+            metadata = json.load(metadataFile)
+    except (OSError, ValueError):
+        pass
+
+    subjectIndex = None
+    if metadata is not None and metadata.get('version') == subjectIndexVersion:
+        if metadata['size'] == sourceSummary['size'] and metadata[
+                'mtime'] == sourceSummary['mtime']:
+            sourceSummary['contentHash'] = metadata['contentHash']
+        else:
+            # the file was touched or rewritten, so check its content
+            sourceSummary['contentHash'] = hashFile(subjectDataFileName)
+        if sourceSummary['contentHash'] == metadata['contentHash']:
+            try:
+                subjectIndex = SubjectIndex(
+                    loadColumns(entryDirectory, mmapMode='r'), sourceSummary)
+            except (OSError, ValueError, KeyError):
+                subjectIndex = None
+            if subjectIndex is not None and metadata['mtime'] != sourceSummary[
+                    'mtime']:
+                storeSourceSummary(entryDirectory, metadata, sourceSummary)
+
+    if subjectIndex is None:
+        if 'contentHash' not in sourceSummary:
+            sourceSummary['contentHash'] = hashFile(subjectDataFileName)
+        columns = parseSubjectData(subjectDataFileName)
+        storeSubjectIndex(indexDirectory, entryDirectory, columns,
+                          sourceSummary)
+        subjectIndex = SubjectIndex(columns, sourceSummary)
+
+    loadedSubjectIndices[memoryKey] = subjectIndex
+    return subjectIndex
+
+
+def hashFileName(fileName):
+    return hashlib.sha1(fileName.encode('utf-8')).hexdigest()[:16]
+
+
+def storeSubjectIndex(indexDirectory, entryDirectory, columns, sourceSummary):
+    os.makedirs(indexDirectory, exist_ok=True)
+    temporaryDirectory = tempfile.mkdtemp(prefix='.tmp-', dir=indexDirectory)
+    try:
+        saveColumns(temporaryDirectory, columns, version=subjectIndexVersion,
+                    **sourceSummary)
+        if os.path.isdir(entryDirectory):
+            shutil.rmtree(entryDirectory, ignore_errors=True)
+        os.rename(temporaryDirectory, entryDirectory)
+    except OSError:
+        # e.g. another process stored the same index concurrently
+        shutil.rmtree(temporaryDirectory, ignore_errors=True)
+
+
+def storeSourceSummary(entryDirectory, metadata, sourceSummary):
+    metadata.update(sourceSummary)
+    temporaryFileName = os.path.join(entryDirectory, 'meta.json.tmp')
+    try:
+        with open(temporaryFileName, 'w') as metadataFile:
+            json.dump(metadata, metadataFile)
+        os.replace(temporaryFileName, os.path.join(entryDirectory,
+                                                   'meta.json'))
+    except OSError:
+        pass
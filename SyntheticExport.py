@@ -0,0 +1,377 @@
+import csv
+import datetime
+import hashlib
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# Synthetic Zooniverse classification exports (and the matching subject
+# data), for measuring the aggregation pipeline without the real exports.
+#
+# Every subject is a telegram page with a fixed "true" text: a number of
+# lines stacked down the page, each with a number of words drawn from a
+# vocabulary of telegram words. Every classification of a subject transcribes
+# that text the way a volunteer would:
+#
+#  - some lines are skipped and the coordinates of the others jitter around
+#    the true line,
+#  - some words are mistranscribed (replaced by another vocabulary word),
+#  - some words (and a few two-word spans) are wrapped in unclear, insertion
+#    or deletion metatags,
+#  - a box (task T2) is marked around the text.
+#
+# As in the real exports, the classifications of different subjects are
+# interleaved, the tasks of a record are not always in order, a few records
+# are from before the live date and a few T1 answers are not "Telegram...".
+#
+# The export is written one record at a time, so that exports of millions of
+# classifications can be generated in bounded memory. The same parameters and
+# seed always produce the same files.
+
+syntheticVocabulary = (
+    'the', 'enemy', 'at', 'Richmond', 'send', 'troops', 'by', 'rail',
+    'General', 'Grant', 'ordered', 'march', 'to', 'Petersburg', 'Washington',
+    'Lee', 'cavalry', 'division', 'will', 'move', 'tomorrow', 'morning',
+    'report', 'position', 'of', 'your', 'command', 'rations', 'guns', 'have',
+    'been', 'received', 'Sherman', 'Stanton', 'Sec', 'War', 'Col', 'Maj',
+    'Gen', 'Hd', 'Qrs', 'Army', 'Potomac', 'dispatch', 'answer', 'immediately',
+    'two', 'hundred', 'men', 'and', 'one', 'battery', 'wagons', 'train',
+    'bridge', 'river', 'from', 'City', 'Point', 'o\'clock', 'P.M.', 'A.M.')
+syntheticMetaTags = ('unclear', 'insertion', 'deletion')
+syntheticFirstSubjectId = 1959000
+syntheticFirstClassificationId = 10000000
+syntheticStartDate = datetime.datetime(2016, 6, 20, 0, 0, 0)
+syntheticDateRangeDays = 400
+
+exportColumns = ['classification_id', 'user_name', 'user_id', 'user_ip',
+                 'workflow_id', 'workflow_name', 'workflow_version',
+                 'created_at', 'gold_standard', 'expert', 'metadata',
+                 'annotations', 'subject_data', 'subject_ids']
+subjectColumns = ['subject_id', 'project_id', 'workflow_ids',
+                  'subject_set_id', 'metadata', 'locations',
+                  'classifications_count', 'retired_at', 'retirement_reason']
+
+# The default shape of the synthetic data. Ranges are inclusive (min, max).
+defaultExportParameters = {
+    'transcribersPerSubject': 10,
+    'linesPerPage': (4, 14),
+    'wordsPerLine': (1, 9),
+    'metaTagDensity': 0.03,
+    'lineJitter': 8.0,
+    'wordErrorRate': 0.08,
+    'lineSkipRate': 0.1,
+    'nonTelegramRate': 0.03,
+    'preLiveRate': 0.01,
+    'seed': 0
+}
+
+
+def getExportParameters(**parameters):
+    unknownParameters = set(parameters) - set(defaultExportParameters)
+    if unknownParameters:
+        raise ValueError('Unknown export parameters: {}'.format(
+            ', '.join(sorted(unknownParameters))))
+    exportParameters = dict(defaultExportParameters)
+    exportParameters.update(parameters)
+    return exportParameters
+
+# A short key of the parameters of an export, so that generated exports can
+# be reused by file name.
+
+
+def getExportKey(numClassifications, exportParameters):
+    return hashlib.sha1(json.dumps(
+        [numClassifications, sorted(exportParameters.items())],
+        sort_keys=True).encode('utf-8')).hexdigest()[:10]
+
+
+def formatSyntheticDate(dateTime):
+    return dateTime.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(
+        dateTime.microsecond // 1000)
+
+# The true text of every page, as flat arrays: the lines of subject i are
+# lineOffsets[i]:lineOffsets[i + 1] and the (vocabulary indices of the) words
+# of line j are wordIds[wordOffsets[j]:wordOffsets[j + 1]].
+
+
+def makeSyntheticPages(numSubjects, linesPerPage, wordsPerLine, rng):
+    numLines = rng.randint(linesPerPage[0], linesPerPage[1] + 1, numSubjects)
+    lineOffsets = np.concatenate([[0], np.cumsum(numLines)])
+    lineSubjects = np.repeat(np.arange(numSubjects), numLines)
+    lineNumbers = np.arange(lineOffsets[-1]) - lineOffsets[lineSubjects]
+    pageTops = rng.uniform(60, 140, numSubjects)
+    lineSpacings = rng.uniform(45, 75, numSubjects)
+    numWords = rng.randint(wordsPerLine[0], wordsPerLine[1] + 1,
+                           lineOffsets[-1])
+    wordOffsets = np.concatenate([[0], np.cumsum(numWords)])
+    return {
+        'lineOffsets': lineOffsets,
+        'lineY': pageTops[lineSubjects] + lineSpacings[lineSubjects] *
+        lineNumbers,
+        'lineX1': rng.uniform(30, 90, lineOffsets[-1]),
+        'lineX2': rng.uniform(700, 950, lineOffsets[-1]),
+        'wordOffsets': wordOffsets,
+        'wordIds': rng.randint(0, len(syntheticVocabulary), wordOffsets[-1])
+    }
+
+# The words of the lines of a single transcription. Metatags never overlap:
+# a tag that would start inside the span of the previous tag is dropped.
+
+
+def formatSyntheticLines(wordIds, wordOffsets, exportParameters, rng):
+    numWords = len(wordIds)
+    mistranscribed = rng.rand(numWords) < exportParameters['wordErrorRate']
+    wordIds = np.where(mistranscribed,
+                       rng.randint(0, len(syntheticVocabulary), numWords),
+                       wordIds)
+    tagged = np.flatnonzero(
+        rng.rand(numWords) < exportParameters['metaTagDensity']).tolist()
+    tagKinds = rng.randint(0, len(syntheticMetaTags), len(tagged)).tolist()
+    tagLengths = rng.randint(1, 3, len(tagged)).tolist()
+
+    words = [syntheticVocabulary[wordId] for wordId in wordIds.tolist()]
+    tagEnd = -1
+    lineEnds = wordOffsets[1:].tolist()
+    iLine = 0
+    for wordIndex, tagKind, tagLength in zip(tagged, tagKinds, tagLengths):
+        if wordIndex <= tagEnd:
+            continue
+        while lineEnds[iLine] <= wordIndex:
+            iLine += 1
+        tagEnd = min(wordIndex + tagLength, lineEnds[iLine]) - 1
+        tag = syntheticMetaTags[tagKind]
+        words[wordIndex] = '[{}]'.format(tag) + words[wordIndex]
+        words[tagEnd] = words[tagEnd] + '[/{}]'.format(tag)
+    return [' '.join(words[wordStart:wordEnd]) for wordStart, wordEnd in zip(
+        wordOffsets[:-1].tolist(), lineEnds)]
+
+# The annotations of a single classification of subject iSubject. Returns the
+# list of tasks and the number of lines that were transcribed.
+
+
+def makeSyntheticAnnotations(pages, iSubject, isTelegram, exportParameters,
+                             rng):
+    lineStart, lineEnd = pages['lineOffsets'][iSubject:iSubject + 2].tolist()
+    transcribed = lineStart + np.flatnonzero(
+        rng.rand(lineEnd - lineStart) >= exportParameters['lineSkipRate'])
+    lineJitter = exportParameters['lineJitter']
+    jitters = rng.normal(0, lineJitter, (len(transcribed), 4))
+    y1 = pages['lineY'][transcribed] + jitters[:, 1]
+    y2 = y1 + 0.5 * jitters[:, 3]
+    x1 = pages['lineX1'][transcribed] + jitters[:, 0]
+    x2 = pages['lineX2'][transcribed] + jitters[:, 2]
+
+    wordOffsets = pages['wordOffsets']
+    wordRanges = [np.arange(wordOffsets[iLine], wordOffsets[iLine + 1])
+                  for iLine in transcribed.tolist()]
+    wordIndices = np.concatenate(wordRanges) if wordRanges else np.zeros(
+        0, dtype=np.int64)
+    sentences = formatSyntheticLines(
+        pages['wordIds'][wordIndices],
+        np.concatenate([[0], np.cumsum([len(wordRange)
+                                        for wordRange in wordRanges])]),
+        exportParameters, rng)
+
+    lines = [{
+        'x1': lineX1,
+        'y1': lineY1,
+        'x2': lineX2,
+        'y2': lineY2,
+        'details': [{'value': sentence}]
+    } for lineX1, lineY1, lineX2, lineY2, sentence in zip(
+        x1.tolist(), y1.tolist(), x2.tolist(), y2.tolist(), sentences)]
+
+    pageTop = pages['lineY'][lineStart]
+    pageBottom = pages['lineY'][lineEnd - 1]
+    boxJitter = rng.normal(0, lineJitter, 4).tolist()
+    box = {
+        'x': 20 + boxJitter[0],
+        'y': pageTop - 40 + boxJitter[1],
+        'width': 950 + boxJitter[2],
+        'height': pageBottom - pageTop + 80 + boxJitter[3],
+        'tool': 0
+    }
+
+    tasks = [{
+        'task': 'T1',
+        'value': 'Telegram page' if isTelegram else (
+            'Other' if rng.rand() < 0.5 else None)
+    }, {
+        'task': 'T2',
+        'value': [box]
+    }, {
+        'task': 'T12',
+        'value': lines if isTelegram else []
+    }]
+    if rng.rand() < 0.5:
+        tasks.reverse()
+    return tasks, len(lines) if isTelegram else 0
+
+
+def writeSyntheticSubjects(subjectDataFileName, numSubjects):
+    with open(subjectDataFileName, 'w', newline='') as subjectFile:
+        subjectWriter = csv.writer(subjectFile)
+        subjectWriter.writerow(subjectColumns)
+        for iSubject in range(numSubjects):
+            subjectId = syntheticFirstSubjectId + iSubject
+            subjectWriter.writerow([
+                subjectId, 1, '[1]', 1,
+                json.dumps({
+                    'hdl_id': 'mssEC_{:02d}_{:03d}'.format(
+                        iSubject // 1000 % 100, iSubject % 1000),
+                    '#telegrams': 'T{} T{}'.format(2 * iSubject + 1,
+                                                   2 * iSubject + 2)
+                }),
+                json.dumps({'0': 'https://example.org/{}.jpg'.format(
+                    subjectId)}), 0, '', ''])
+
+# Write an export of numClassifications records (and its subject data).
+# Returns the numbers of subjects, of telegram records (after the live date
+# and with a telegram T1 answer) and of transcribed lines.
+
+
+def writeSyntheticExport(sampleDataFileName, subjectDataFileName,
+                         numClassifications, **parameters):
+    exportParameters = getExportParameters(**parameters)
+    rng = np.random.RandomState(exportParameters['seed'])
+    transcribersPerSubject = exportParameters['transcribersPerSubject']
+    numSubjects = max(1, int(math.ceil(
+        numClassifications / float(transcribersPerSubject))))
+
+    pages = makeSyntheticPages(numSubjects,
+                               exportParameters['linesPerPage'],
+                               exportParameters['wordsPerLine'], rng)
+    classifiedSubjects = rng.permutation(np.repeat(
+        np.arange(numSubjects), transcribersPerSubject))[:numClassifications]
+    # records are in (roughly) chronological order
+    recordSeconds = np.sort(rng.uniform(
+        0, syntheticDateRangeDays * 86400, numClassifications))
+    preLive = rng.rand(numClassifications) < exportParameters['preLiveRate']
+    isTelegram = rng.rand(
+        numClassifications) >= exportParameters['nonTelegramRate']
+
+    numTelegrams = 0
+    numLines = 0
+    writeSyntheticSubjects(subjectDataFileName, numSubjects)
+    with open(sampleDataFileName, 'w', newline='') as exportFile:
+        exportWriter = csv.writer(exportFile)
+        exportWriter.writerow(exportColumns)
+        for recordIndex, (iSubject, seconds, isPreLive,
+                          isTelegramRecord) in enumerate(zip(
+                              classifiedSubjects.tolist(),
+                              recordSeconds.tolist(), preLive.tolist(),
+                              isTelegram.tolist())):
+            subjectId = syntheticFirstSubjectId + iSubject
+            # records from before the live date are from the last month of
+            # testing
+            startedAt = syntheticStartDate + datetime.timedelta(
+                seconds=-1 - seconds % (30 * 86400) if isPreLive else
+                1 + seconds)
+            finishedAt = startedAt + datetime.timedelta(
+                seconds=60 + 600 * rng.rand())
+            tasks, numRecordLines = makeSyntheticAnnotations(
+                pages, iSubject, isTelegramRecord, exportParameters, rng)
+            if not isPreLive and isTelegramRecord:
+                numTelegrams += 1
+                numLines += numRecordLines
+            userId = int(rng.randint(0, max(1, numClassifications // 20)))
+            exportWriter.writerow([
+                syntheticFirstClassificationId + recordIndex,
+                'volunteer{}'.format(userId), userId, 'ip{}'.format(userId),
+                1, 'Transcribe telegrams', '1.1',
+                formatSyntheticDate(finishedAt), '', '',
+                json.dumps({
+                    'source': 'api',
+                    'session': '{:016x}'.format(userId),
+                    'started_at': formatSyntheticDate(startedAt),
+                    'finished_at': formatSyntheticDate(finishedAt),
+                    'user_language': 'en'
+                }, separators=(',', ':')),
+                json.dumps(tasks, separators=(',', ':')),
+                json.dumps({str(subjectId): {'retired': None}},
+                           separators=(',', ':')),
+                subjectId
+            ])
+    return {
+        'numSubjects': numSubjects,
+        'numTelegrams': numTelegrams,
+        'numLines': numLines
+    }
+
+# Generate an export in exportDirectory, unless one with the same parameters
+# is already there. Returns the file names of the export and its subject
+# data.
+
+
+def getSyntheticExport(numClassifications, exportDirectory, **parameters):
+    exportParameters = getExportParameters(**parameters)
+    exportKey = getExportKey(numClassifications, exportParameters)
+    sampleDataFileName = os.path.join(
+        exportDirectory, 'classification_export_synthetic{}_{}.csv'.format(
+            numClassifications, exportKey))
+    subjectDataFileName = os.path.join(
+        exportDirectory, 'synthetic-subjects_{}.csv'.format(exportKey))
+    if not (os.path.exists(sampleDataFileName)
+            and os.path.exists(subjectDataFileName)):
+        os.makedirs(exportDirectory, exist_ok=True)
+        # write to temporary files, so that an interrupted run is never reused
+        # (and concurrent runs never write to the same file)
+        temporarySuffix = '.{}.tmp'.format(os.getpid())
+        writeSyntheticExport(sampleDataFileName + temporarySuffix,
+                             subjectDataFileName + temporarySuffix,
+                             numClassifications, **exportParameters)
+        os.replace(subjectDataFileName + temporarySuffix, subjectDataFileName)
+        os.replace(sampleDataFileName + temporarySuffix, sampleDataFileName)
+    return sampleDataFileName, subjectDataFileName
+
+
+def benchmark(numClassifications=10000, exportDirectory=None):
+    import DcwAggregation
+
+    numClassifications = int(numClassifications)
+    if exportDirectory is None:
+        exportDirectory = tempfile.mkdtemp(prefix='syntheticExport-')
+    os.makedirs(exportDirectory, exist_ok=True)
+    sampleDataFileName = os.path.join(
+        exportDirectory, 'classification_export_synthetic.csv')
+    subjectDataFileName = os.path.join(exportDirectory,
+                                       'synthetic-subjects.csv')
+    startTime = time.perf_counter()
+    counts = writeSyntheticExport(sampleDataFileName, subjectDataFileName,
+                                  numClassifications)
+    print('Generated {} classifications of {} subjects in {:.3f} s ({:.1f} MB)'.format(
+        numClassifications, counts['numSubjects'],
+        time.perf_counter() - startTime,
+        os.path.getsize(sampleDataFileName) / 1024.0**2))
+
+    # the pipeline must accept exactly the telegram records and lines that
+    # were generated
+    subjectsFrame = DcwAggregation.loadSubjectData(subjectDataFileName)
+    telegrams, nTelegramsParsed = DcwAggregation.loadTelegrams(
+        sampleDataFileName)
+    numLines = sum(transcription.getNumLines()
+                   for transcriptions in telegrams.values()
+                   for recordIndex, transcription in transcriptions)
+    print('Parsed {} telegrams ({} generated) with {} lines ({} generated) of {} subjects ({} generated)'.format(
+        nTelegramsParsed, counts['numTelegrams'], numLines,
+        counts['numLines'], len(subjectsFrame), counts['numSubjects']))
+    numMismatches = int(nTelegramsParsed != counts['numTelegrams']) + int(
+        numLines != counts['numLines']) + int(
+            len(subjectsFrame) != counts['numSubjects'])
+    print('Mismatched counts: {}'.format(numMismatches))
+    return numMismatches
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 3:
+        # python SyntheticExport.py <export csv> <subjects csv> <classifications> [seed]
+        print(writeSyntheticExport(
+            sys.argv[1], sys.argv[2], int(sys.argv[3]),
+            seed=int(sys.argv[4]) if len(sys.argv) > 4 else 0))
+    else:
+        sys.exit(1 if benchmark(*sys.argv[1:]) > 0 else 0)
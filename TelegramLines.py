@@ -1,16 +1,107 @@
+import sys
+import tracemalloc
+from array import array
+
+from TextLine import TextLine
+
+# The lines of a single transcription are stored as parallel arrays: the
+# coordinates of every line as consecutive (x1, y1, x2, y2) floats and the
+# transcribed text in a list. TextLine objects are only created when the
+# lines are requested through getLines; iterLineCoords reads the arrays
+# directly.
+
+
 class TelegramLines():
 
-    def __init__(self):
-        self.textLines = []
+    __slots__ = ('coords', 'texts', 'startedAt')
+
+    def __init__(self, _startedAt=-1):
+        self.coords = array('d')
+        self.texts = []
+        # classification start time in epoch milliseconds (-1 if unknown)
+        self.startedAt = _startedAt
 
     def __str__(self):
-        return "\n".join([textLine.__str__() for textLine in self.textLines])
+        return "\n".join([textLine.__str__() for textLine in self.getLines()])
 
     def addLine(self, textLine):
-        self.textLines.append(textLine)
+        self.addLineCoords(textLine.x1, textLine.y1, textLine.x2,
+                           textLine.y2, textLine.text)
+
+    def addLineCoords(self, x1, y1, x2, y2, text):
+        self.coords.extend((x1, y1, x2, y2))
+        self.texts.append(text)
+
+    def getLine(self, lineIndex):
+        return TextLine(*self.coords[4 * lineIndex:4 * lineIndex + 4],
+                        self.texts[lineIndex])
 
     def getLines(self):
-        return self.textLines
+        return [self.getLine(lineIndex) for lineIndex in range(len(self.texts))]
+
+    def iterLineCoords(self):
+        # (x1, y1, x2, y2, text) of every line
+        coords = iter(self.coords)
+        return zip(coords, coords, coords, coords, self.texts)
 
     def getNumLines(self):
-        return len(self.textLines)
+        return len(self.texts)
+
+
+def benchmark(numTranscriptions=20000, linesPerTranscription=15):
+    # Memory per transcribed line of the previous layout (dictionaries of
+    # coordinates and a stored word list per line object) compared with the
+    # array-backed TelegramLines.
+
+    class DictTextLine():
+
+        def __init__(self, x1, y1, x2, y2, text):
+            self.coords = {'start': {'x': x1, 'y': y1},
+                           'end': {'x': x2, 'y': y2}}
+            self.text = text
+            self.words = text.split()
+            self.numWords = len(self.words)
+
+    class ListTelegramLines():
+
+        def __init__(self):
+            self.textLines = []
+
+        def addLine(self, textLine):
+            self.textLines.append(textLine)
+
+    # the transcribed text is shared by both layouts, so it is created
+    # before memory tracing starts
+    texts = ['Transcribed line {} of the telegram text'.format(lineIndex)
+             for lineIndex in range(linesPerTranscription)]
+    numLines = numTranscriptions * linesPerTranscription
+
+    results = []
+    for layout in ('before', 'after'):
+        tracemalloc.start()
+        transcriptions = []
+        for transcriptionIndex in range(numTranscriptions):
+            if layout == 'before':
+                transcribedLines = ListTelegramLines()
+            else:
+                transcribedLines = TelegramLines()
+            for lineIndex, text in enumerate(texts):
+                x1, y1 = 50.5 + transcriptionIndex, 100.5 + 60.0 * lineIndex
+                x2, y2 = x1 + 850.0, y1 + 2.0
+                if layout == 'before':
+                    transcribedLines.addLine(
+                        DictTextLine(x1, y1, x2, y2, text))
+                else:
+                    transcribedLines.addLineCoords(x1, y1, x2, y2, text)
+            transcriptions.append(transcribedLines)
+        retainedBytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('{:<7} {:7.1f} bytes per transcribed line'.format(
+            layout + ':', retainedBytes / float(numLines)))
+        results.append(retainedBytes)
+        del transcriptions
+    return results
+
+
+if __name__ == '__main__':
+    benchmark(*[int(argument) for argument in sys.argv[1:]])
@@ -1,23 +1,35 @@
 class TextLine():
 
+    __slots__ = ('x1', 'y1', 'x2', 'y2', 'text')
+
     def __init__(self, x1, y1, x2, y2, text):
-        self.coords = {'start': {'x': x1, 'y': y1}, 'end': {'x': x2, 'y': y2}}
+        self.x1 = x1
+        self.y1 = y1
+        self.x2 = x2
+        self.y2 = y2
         self.text = text
-        self.words = text.split()
-        self.numWords = len(self.words)
 
     def __str__(self):
-        return str(
-            self.text) + " @ ((" + str(self.coords['start']['x']) + ", " + str(
-                self.coords['start']['y']) + "), (" + str(
-                    self.coords['end']['x']) + ", " + str(
-                        self.coords['end']['y']) + "))"
+        return str(self.text) + " @ ((" + str(self.x1) + ", " + str(
+            self.y1) + "), (" + str(self.x2) + ", " + str(self.y2) + "))"
+
+    @property
+    def coords(self):
+        return {'start': self.getStart(), 'end': self.getEnd()}
+
+    @property
+    def words(self):
+        return self.text.split()
+
+    @property
+    def numWords(self):
+        return len(self.getWords())
 
     def getStart(self):
-        return self.coords['start']
+        return {'x': self.x1, 'y': self.y1}
 
     def getEnd(self):
-        return self.coords['end']
+        return {'x': self.x2, 'y': self.y2}
 
     def getText(self):
         return str(self.text)
@@ -26,4 +38,4 @@ class TextLine():
         return self.coords
 
     def getWords(self):
-        return self.words
+        return self.text.split()
@@ -0,0 +1,99 @@
+import calendar
+import datetime
+
+import dateutil.parser
+
+# Converts classification timestamps to integer milliseconds since the Unix
+# epoch (UTC) and compares them with a minimum timestamp, e.g. the date that
+# the project went live.
+#
+# Zooniverse emits timestamps in a fixed ISO-8601 form, e.g.
+# "2016-06-20T12:34:56.789Z", which are converted by slicing the string at
+# fixed offsets. The day number is cached per date, since an export only
+# covers a limited number of days. Any other string, including one with a
+# signed or out of range field, is parsed with dateutil (naive times are
+# taken to be UTC) and counted as a fallback.
+# Fractions of a millisecond are truncated, so comparisons with a minimum
+# timestamp that falls on a whole millisecond agree with comparing the
+# parsed datetimes.
+
+
+class TimestampFilter():
+
+    def __init__(self, _minimumTimestamp=None):
+        self.dayCache = {}
+        self.numFallbacks = 0
+        self.minimumTimestamp = None
+        if _minimumTimestamp is not None:
+            self.minimumTimestamp = self.toEpochMilliseconds(
+                _minimumTimestamp)
+
+    def toEpochMilliseconds(self, timestamp):
+        if isinstance(timestamp, datetime.datetime):
+            if timestamp.tzinfo is not None:
+                timestamp = timestamp.astimezone(datetime.timezone.utc)
+            return calendar.timegm(timestamp.timetuple()) * 1000 + \
+                timestamp.microsecond // 1000
+        return self.parse(timestamp)
+
+    def parse(self, timestampString):
+        if (len(timestampString) >= 20 and timestampString[-1] == 'Z'
+                and timestampString[10] == 'T' and timestampString[13] == ':'
+                and timestampString[16] == ':'):
+            try:
+                epochDay = self.dayCache[timestampString[:10]]
+            except KeyError:
+                epochDay = self.parseDay(timestampString[:10])
+            milliseconds = None
+            if epochDay is not None:
+                milliseconds = self.parseTime(timestampString)
+            if milliseconds is not None:
+                return epochDay * 86400000 + milliseconds
+        self.numFallbacks += 1
+        return self.toEpochMilliseconds(
+            dateutil.parser.parse(timestampString))
+
+    def parseTime(self, timestampString):
+        # the milliseconds since midnight of a fixed form timestamp, or None
+        hours = timestampString[11:13]
+        minutes = timestampString[14:16]
+        seconds = timestampString[17:19]
+        fraction = timestampString[20:-1]
+        if not (hours.isdigit() and minutes.isdigit() and seconds.isdigit()):
+            return None
+        if len(timestampString) > 20 and (timestampString[19] != '.'
+                                          or not fraction.isdigit()):
+            return None
+        try:
+            hours, minutes, seconds = int(hours), int(minutes), int(seconds)
+            milliseconds = int((fraction + '000')[:3])
+        except ValueError:
+            return None
+        # a leap second (60) counts as the first second of the next minute
+        if hours >= 24 or minutes >= 60 or seconds >= 61:
+            return None
+        return (hours * 3600000 + minutes * 60000 + seconds * 1000 +
+                milliseconds)
+
+    def parseDay(self, dateString):
+        if dateString[4] != '-' or dateString[7] != '-':
+            return None
+        try:
+            epochDay = (datetime.date(int(dateString[:4]), int(dateString[5:7]),
+                                      int(dateString[8:10])).toordinal() -
+                        epochOrdinal)
+        except ValueError:
+            return None
+        self.dayCache[dateString] = epochDay
+        return epochDay
+
+    def accept(self, timestampString):
+        # returns the parsed timestamp if it is not earlier than the minimum
+        # timestamp, or None otherwise
+        milliseconds = self.parse(timestampString)
+        if self.minimumTimestamp is not None and milliseconds < self.minimumTimestamp:
+            return None
+        return milliseconds
+
+
+epochOrdinal = datetime.date(1970, 1, 1).toordinal()
@@ -0,0 +1,119 @@
+import os
+import shutil
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import DcwAggregation
+from SubjectIndex import loadSubjectIndex
+from SyntheticExport import getSyntheticExport
+from TelegramLines import TelegramLines
+
+# Shared fixtures: a small synthetic export (see SyntheticExport) and the
+# outputs of the pipeline stages for it, computed once per test session.
+#
+# The transcriptions of the first subject are replaced by lines that only
+# hold metatags, so that it has line groups without any words.
+
+testNumClassifications = 600
+testLineTolerance = 40
+
+
+@pytest.fixture(scope='session')
+def exportFiles(tmp_path_factory):
+    # the sample data and subject data file names
+    return getSyntheticExport(testNumClassifications,
+                              str(tmp_path_factory.mktemp('export')), seed=0)
+
+
+@pytest.fixture(scope='session')
+def subjectsFrame(exportFiles):
+    return DcwAggregation.loadSubjectData(exportFiles[1])
+
+
+@pytest.fixture(scope='session')
+def subjectIndex(exportFiles, tmp_path_factory):
+    return loadSubjectIndex(exportFiles[1],
+                            str(tmp_path_factory.mktemp('subjectIndex')))
+
+
+@pytest.fixture(scope='session')
+def classifications(exportFiles):
+    # the telegrams and the marked boxes of the export
+    telegrams, nTelegramsParsed, boxesFrame = DcwAggregation.loadClassifications(
+        exportFiles[0], extractBoxes=True)
+    return telegrams, boxesFrame
+
+
+@pytest.fixture(scope='session')
+def emptySubjectKey(classifications):
+    return min(classifications[0])
+
+
+@pytest.fixture(scope='session')
+def telegrams(classifications, emptySubjectKey):
+    telegrams = dict(classifications[0])
+    emptyTranscriptions = []
+    for recordIndex, transcription in telegrams[emptySubjectKey]:
+        tagOnlyLines = TelegramLines(transcription.startedAt)
+        tagOnlyLines.addLineCoords(100.0, 200.0, 900.0, 204.0,
+                                   '[unclear][/unclear]')
+        tagOnlyLines.addLineCoords(100.0, 400.0, 900.0, 402.0,
+                                   '[deletion][/deletion] [unclear][/unclear]')
+        emptyTranscriptions.append((recordIndex, tagOnlyLines))
+    telegrams[emptySubjectKey] = emptyTranscriptions
+    return telegrams
+
+
+@pytest.fixture(scope='session')
+def lineDetails(telegrams):
+    transcriptionLineStats, transcriptionLineDetailsFrame = DcwAggregation.processLoadedTelegrams(
+        telegrams)
+    return DcwAggregation.groupTranscriptionsLinewise(
+        transcriptionLineDetailsFrame, testLineTolerance)
+
+
+@pytest.fixture(scope='session')
+def lineGroups(lineDetails):
+    return DcwAggregation.aggregateLineGroups(lineDetails)
+
+
+@pytest.fixture(scope='session')
+def mergedLineGroups(lineGroups, subjectsFrame):
+    return DcwAggregation.mergeSubjectData(lineGroups, subjectsFrame)
+
+
+@pytest.fixture(scope='session')
+def aggregatedBoxes(classifications):
+    return DcwAggregation.aggregateBoxes(classifications[1],
+                                         DcwAggregation.boxOverlapThreshold)
+
+
+@pytest.fixture(scope='session')
+def consensusDatabase(mergedLineGroups, aggregatedBoxes, subjectIndex,
+                      tmp_path_factory):
+    # the consensus and box tables, as stored by a complete run
+    databaseFileName = str(tmp_path_factory.mktemp('database') /
+                           'consensus.sqlite')
+    DcwAggregation.storeConsensusData(mergedLineGroups, databaseFileName)
+    DcwAggregation.storeBoxData(aggregatedBoxes, mergedLineGroups,
+                                subjectIndex, databaseFileName)
+    return databaseFileName
+
+
+@pytest.fixture
+def databaseCopy(consensusDatabase, tmp_path):
+    # a copy of the consensus database that a test may change
+    databaseFileName = str(tmp_path / 'consensus.sqlite')
+    shutil.copyfile(consensusDatabase, databaseFileName)
+    return databaseFileName
+
+
+@pytest.fixture
+def connection(databaseCopy):
+    connection = sqlite3.connect(databaseCopy)
+    yield connection
+    connection.close()
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+import DcwAggregation
+from BoxConsensus import BoxMatcher, TelegramBox, clusterBoxes, clusterBoxesSweep, aggregateBoxes, makeBoxesFrame
+
+
+def testMeansMatchBoxMatcher(classifications, aggregatedBoxes):
+    boxesFrame = classifications[1]
+    bestBoxIndices = clusterBoxes(boxesFrame,
+                                  DcwAggregation.boxOverlapThreshold)
+    numClusters = 0
+    for (subject, bestBoxIndex), cluster in boxesFrame.groupby(
+            [boxesFrame['subjectKey'].values, bestBoxIndices]):
+        meanBox = BoxMatcher.mean([
+            TelegramBox(*box, subject) for box in cluster[
+                ['boxX', 'boxY', 'boxW', 'boxH']].itertuples(index=False)
+        ])
+        subjectBoxes = aggregatedBoxes.loc[[subject]]
+        aggregatedBox = subjectBoxes[subjectBoxes['bestBoxIndex'] ==
+                                     bestBoxIndex].iloc[0]
+        np.testing.assert_allclose(
+            [meanBox.x, meanBox.y, meanBox.width, meanBox.height,
+             meanBox.data['nBoxes']],
+            aggregatedBox[['meanX', 'meanY', 'meanWidth', 'meanHeight',
+                           'numBoxesMarked']].values.astype(np.float64))
+        numClusters += 1
+    assert numClusters == len(aggregatedBoxes)
+
+
+def testEmptyBoxes(classifications):
+    aggregatedBoxes = aggregateBoxes(classifications[1].iloc[:0])
+    assert len(aggregatedBoxes) == 0
+    assert list(aggregatedBoxes.columns) == [
+        'bestBoxIndex', 'meanX', 'meanY', 'meanWidth', 'meanHeight',
+        'numBoxesMarked']
+
+
+# two boxes of subject 1 that match, separated in the sorted order (by y) by
+# a box that matches neither, and a box of subject 2 identical to the first
+separatedBoxes = [(1, 0.0, 0.0, 100.0, 100.0), (1, 500.0, 2.0, 100.0, 100.0),
+                  (1, 0.0, 5.0, 100.0, 100.0), (2, 0.0, 0.0, 100.0, 100.0)]
+
+
+def getPartition(boxRecords, bestBoxIndices):
+    # the clusters as sets of boxes
+    clusters = {}
+    for boxRecord, bestBoxIndex in zip(boxRecords, bestBoxIndices.tolist()):
+        clusters.setdefault((boxRecord[0], bestBoxIndex), set()).add(boxRecord)
+    return sorted(sorted(cluster) for cluster in clusters.values())
+
+
+def testSeparatedMatchingBoxes():
+    bestBoxIndices = clusterBoxes(makeBoxesFrame(separatedBoxes), 0.7)
+    assert bestBoxIndices.tolist() == [0, 1, 0, 0]
+    # the sweep only compares neighbouring boxes and splits them
+    assert clusterBoxesSweep(makeBoxesFrame(separatedBoxes),
+                             0.7).tolist()[:3] == [0, 1, 2]
+    aggregatedBoxes = aggregateBoxes(makeBoxesFrame(separatedBoxes), 0.7)
+    assert aggregatedBoxes.loc[1, 'numBoxesMarked'].tolist() == [2, 1]
+    np.testing.assert_allclose(aggregatedBoxes.loc[1, 'meanY'].tolist(),
+                               [2.5, 2.0])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def testRowOrder(seed):
+    rng = np.random.RandomState(seed)
+    boxRecords = separatedBoxes + [
+        (subject, float(x), float(y), 100.0, 100.0)
+        for subject, x, y in zip(rng.randint(1, 4, 30),
+                                 rng.randint(0, 400, 30),
+                                 rng.randint(0, 400, 30))]
+    partition = getPartition(
+        boxRecords, clusterBoxes(makeBoxesFrame(boxRecords), 0.7))
+    shuffledRecords = [boxRecords[row]
+                       for row in rng.permutation(len(boxRecords))]
+    shuffledIndices = clusterBoxes(makeBoxesFrame(shuffledRecords), 0.7)
+    assert getPartition(shuffledRecords, shuffledIndices) == partition
+    # the clusters are numbered in the order of their first sorted box
+    sortedIndices = clusterBoxes(makeBoxesFrame(sorted(boxRecords)), 0.7)
+    assert dict(zip(sorted(boxRecords), sortedIndices.tolist())) == dict(
+        zip(shuffledRecords, shuffledIndices.tolist()))
+
+
+def testSubjectsAreNeverMerged():
+    boxRecords = [(subject, 10.0, 20.0, 100.0, 50.0)
+                  for subject in [3, 1, 2, 1]]
+    aggregatedBoxes = aggregateBoxes(makeBoxesFrame(boxRecords), 0.7)
+    assert np.asarray(aggregatedBoxes.index).tolist() == [1, 2, 3]
+    assert aggregatedBoxes['bestBoxIndex'].tolist() == [0, 0, 0]
+    assert aggregatedBoxes['numBoxesMarked'].tolist() == [2, 1, 1]
+
+
+def testOverlapThreshold():
+    # the IoU of the boxes is exactly 0.5, which is not a match
+    boxRecords = [(1, 0.0, 0.0, 100.0, 100.0), (1, 0.0, 0.0, 100.0, 50.0)]
+    assert clusterBoxes(makeBoxesFrame(boxRecords), 0.5).tolist() == [1, 0]
+    assert clusterBoxes(makeBoxesFrame(boxRecords), 0.49).tolist() == [0, 0]
+    boxMatcher = BoxMatcher(0.5)
+    boxMatcher.setBox(TelegramBox(*boxRecords[0][1:], 1))
+    assert not boxMatcher.compare(TelegramBox(*boxRecords[1][1:], 1))
@@ -0,0 +1,71 @@
+import csv
+import json
+
+import dateutil.parser
+import pytest
+
+import DcwAggregation
+from ClassificationRowDecoder import ClassificationRowDecoder
+
+
+def decodeReference(record, liveDate):
+    # the lines and boxes of a record with full decoding: the lines of
+    # telegram records (None for any other record) and the boxes of every
+    # record from after the live date
+    if dateutil.parser.parse(json.loads(
+            record['metadata'])['started_at']) < liveDate:
+        return None, None
+    parsedAnnotations = json.loads(record['annotations'])
+    boxes = [(box['x'], box['y'], box['width'], box['height'])
+             for task in parsedAnnotations
+             if task['task'] == 'T2' and task['value']
+             for box in task['value']]
+    if any(task['task'] == 'T1' and (
+            task['value'] is None or not task['value'].startswith('Telegram'))
+           for task in parsedAnnotations):
+        return None, boxes
+    lines = [(item['x1'], item['y1'], item['x2'], item['y2'],
+              item['details'][0]['value'])
+             for task in parsedAnnotations
+             if task['task'].startswith('T12') and len(task['value']) > 0
+             for item in task['value']]
+    return lines, boxes
+
+
+@pytest.mark.parametrize('useFastJson', [True, False])
+def testMatchesFullDecoding(exportFiles, useFastJson):
+    liveDate = DcwAggregation.liveDate
+    with open(exportFiles[0]) as csvfile:
+        parsedCsv = csv.reader(csvfile)
+        header = next(parsedCsv)
+        rowDecoder = ClassificationRowDecoder(header, liveDate, useFastJson,
+                                              _extractBoxes=True)
+        numTelegrams = 0
+        for row in parsedCsv:
+            referenceLines, referenceBoxes = decodeReference(
+                dict(zip(header, row)), liveDate)
+            transcribedLines, boxes = rowDecoder.decodeRecord(row)
+            assert boxes == referenceBoxes
+            if referenceLines is None:
+                assert transcribedLines is None
+                continue
+            numTelegrams += 1
+            assert [(textLine.x1, textLine.y1, textLine.x2, textLine.y2,
+                     textLine.text)
+                    for textLine in transcribedLines.getLines()] == referenceLines
+    assert rowDecoder.stageCounts['rejectedDate'] > 0
+    assert rowDecoder.stageCounts['telegrams'] == numTelegrams
+
+
+def testLinesOnly(exportFiles):
+    with open(exportFiles[0]) as csvfile:
+        parsedCsv = csv.reader(csvfile)
+        header = next(parsedCsv)
+        rows = list(parsedCsv)
+    rowDecoder = ClassificationRowDecoder(header, DcwAggregation.liveDate)
+    boxDecoder = ClassificationRowDecoder(header, DcwAggregation.liveDate,
+                                          _extractBoxes=True)
+    for row in rows:
+        transcribedLines, boxes = rowDecoder.decodeRecord(row)
+        assert boxes is None
+        assert str(transcribedLines) == str(boxDecoder.decode(row))
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from ColumnarExport import exportConsensusTables, loadTable, loadExportMetadata, parquetAvailable, tableNames
+from StageCache import encodeLineGroups
+
+exportFormats = ['npy', pytest.param('parquet', marks=pytest.mark.skipif(
+    not parquetAvailable, reason='pyarrow is not installed'))]
+
+
+@pytest.mark.parametrize('exportFormat', exportFormats)
+def testMatchesLineGroups(lineGroups, subjectsFrame, tmp_path, exportFormat):
+    exportDirectory = str(tmp_path / 'export')
+    exportConsensusTables(encodeLineGroups(lineGroups), subjectsFrame,
+                          exportDirectory, exportFormat)
+    assert loadExportMetadata(exportDirectory)['format'] == exportFormat
+
+    # the words of every line must match the aggregated StatefulWords
+    words = loadTable(exportDirectory, 'words',
+                      ['line', 'position', 'rank', 'word', 'spanStart',
+                       'spanEnd'])
+    assert list(zip(words['line'].tolist(), words['position'].tolist(),
+                    words['rank'].tolist(), words['word'],
+                    words['spanStart'].tolist(),
+                    words['spanEnd'].tolist())) == [
+        (lineId, position, rank, statefulWord.word) + tuple(statefulWord.span)
+        for lineId, aggregatedSentence in enumerate(lineGroups['words'])
+        for position, wordOptions in enumerate(aggregatedSentence['words'])
+        for rank, statefulWord in enumerate(wordOptions)
+    ]
+
+    lines = loadTable(exportDirectory, 'lines')
+    assert lines['reliability'].tolist() == [
+        aggregatedSentence['reliability']
+        for aggregatedSentence in lineGroups['words']]
+    assert lines['subjectKey'].tolist() == lineGroups.index.tolist()
+    assert lines['bestLineIndex'].tolist() == lineGroups[
+        'bestLineIndex'].tolist()
+    assert loadTable(exportDirectory, 'positions',
+                     ['reliability'])['reliability'].tolist() == [
+        wordReliability for aggregatedSentence in lineGroups['words']
+        for wordReliability in aggregatedSentence['wordReliabilities']]
+
+    subjects = loadTable(exportDirectory, 'subjects')
+    subjectKeys = subjects['subjectKey'].tolist()
+    assert subjectKeys == sorted(set(lineGroups.index.tolist()))
+    assert subjects['huntingtonId'] == subjectsFrame.loc[
+        subjectKeys, 'huntington_id'].tolist()
+    np.testing.assert_allclose(
+        subjects['reliability'],
+        lineGroups['words'].map(
+            lambda aggregatedSentence: aggregatedSentence['reliability']
+        ).groupby(level=0).mean().loc[subjectKeys].values)
+
+
+@pytest.mark.parametrize('exportFormat', exportFormats)
+def testNoLineGroups(subjectsFrame, tmp_path, exportFormat):
+    exportDirectory = str(tmp_path / 'export')
+    exportConsensusTables(None, subjectsFrame, exportDirectory, exportFormat)
+    assert loadExportMetadata(exportDirectory)['tables'] == {
+        tableName: 0 for tableName in tableNames}
+    for tableName in tableNames:
+        columns = loadTable(exportDirectory, tableName)
+        assert all(len(values) == 0 for values in columns.values())
@@ -0,0 +1,223 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import DcwAggregation
+from ConsensusDatabaseLoader import ConsensusDatabaseLoader, openSqliteDatabase, loadConsensusDatabase, encodeWordTags, decodeWordTags, findWordTag, tableColumns
+
+# the tables of the original storage step
+originalTables = ['Subjects', 'SubjectLines', 'LineWords', 'MetaTags']
+
+
+def loadRowByRow(lineGroupedTranscriptionLineDetails, connection):
+    # The original storage step: one INSERT per row with the foreign keys
+    # taken from cursor.lastrowid (with the subject reliabilities computed by
+    # a groupby over the whole frame)
+    cursor = connection.cursor()
+    subjectGroupedTranscriptionLineDetails = lineGroupedTranscriptionLineDetails.groupby(level=0).aggregate(
+        {'words': lambda sentences: np.sum([sentence['reliability'] for sentence in sentences]) / float(len(sentences))})
+    insertQueries = {
+        table: 'INSERT INTO {} ({}) VALUES ({})'.format(
+            table, ', '.join(columns[1:]), ', '.join(['?'] * (len(columns) - 1)))
+        for table, columns in tableColumns.items()
+    }
+    currentSubject = -1
+    subjectId = None
+    savedMetaData = {}
+    for index, row in lineGroupedTranscriptionLineDetails.iterrows():
+        if index != currentSubject:
+            subjectData = (int(index), row['huntington_id'], row['url'],
+                           float(subjectGroupedTranscriptionLineDetails.loc[int(index)]['words']))
+            cursor.execute(insertQueries['Subjects'], subjectData)
+            subjectId = cursor.lastrowid
+            currentSubject = index
+        bestLineIndex = int(row['bestLineIndex'])
+        lineData = (subjectId, int(bestLineIndex), row['x1'], row['x2'],
+                    row['y1'], row['y2'], row['words']['reliability'])
+        cursor.execute(insertQueries['SubjectLines'], lineData)
+        lineId = cursor.lastrowid
+        for wordPosition, wordList in enumerate(row['words']['words']):
+            for wordRank, word in enumerate(wordList):
+                wordTranscriptionIndex = int(row['transcriptionIndex'][wordRank])
+                wordData = (lineId, word.word[0:99], wordPosition, wordRank,
+                            int(wordTranscriptionIndex), word.span[0],
+                            word.span[1], 0.0)
+                cursor.execute(insertQueries['LineWords'], wordData)
+                if len(word.tagStates) > 0 and (
+                        wordTranscriptionIndex not in savedMetaData
+                        or bestLineIndex not in savedMetaData[wordTranscriptionIndex]):
+                    savedMetaData.setdefault(wordTranscriptionIndex,
+                                             []).append(bestLineIndex)
+                    for tag, spans in word.tagStates.items():
+                        for span in spans:
+                            metaTagData = (int(bestLineIndex),
+                                           int(wordTranscriptionIndex), tag,
+                                           span[0], span[1])
+                            cursor.execute(insertQueries['MetaTags'],
+                                           metaTagData)
+    connection.commit()
+
+
+def readTables(databaseFileName, tables=originalTables):
+    connection = sqlite3.connect(databaseFileName)
+    try:
+        return {table: connection.execute(
+            'SELECT * FROM {} ORDER BY id'.format(table)).fetchall()
+            for table in tables}
+    finally:
+        connection.close()
+
+
+def makeLineGroups(lines, subjectKey=1959000, huntingtonId='mssEC_00_000'):
+    # a merged line grouped frame of one subject, with a line for every list
+    # of (transcriptionIndex, sentence) pairs
+    return pd.DataFrame(
+        {
+            'bestLineIndex': np.arange(len(lines)),
+            'words': [DcwAggregation.aggregateSentences(
+                [sentence for transcriptionIndex, sentence in line])
+                for line in lines],
+            'subjectKey': subjectKey,
+            'y1': 100.0 + 60 * np.arange(len(lines)),
+            'y2': 102.0 + 60 * np.arange(len(lines)),
+            'x1': 50.0,
+            'x2': 900.0,
+            'transcriptionIndex': [
+                tuple(transcriptionIndex for transcriptionIndex, sentence in line)
+                for line in lines],
+            'numLines': [(len(lines), ) * len(line) for line in lines],
+            'huntington_id': huntingtonId,
+            'url': 'https://example.org/{}.jpg'.format(subjectKey)
+        },
+        index=pd.Index([subjectKey] * len(lines), name='subjectKey'))
+
+
+@pytest.mark.parametrize('batchSize, commitRows', [(10000, 200000), (7, 50)])
+def testMatchesRowByRow(mergedLineGroups, tmp_path, batchSize, commitRows):
+    rowByRowFileName = str(tmp_path / 'rowByRow.sqlite')
+    connection = openSqliteDatabase(rowByRowFileName)
+    loadRowByRow(mergedLineGroups, connection)
+    connection.close()
+    batchedFileName = str(tmp_path / 'batched.sqlite')
+    rowCounts = loadConsensusDatabase(mergedLineGroups, batchedFileName,
+                                      batchSize=batchSize,
+                                      commitRows=commitRows)
+    # both databases must hold identical rows, including the ids
+    batchedTables = readTables(batchedFileName)
+    assert batchedTables == readTables(rowByRowFileName)
+    assert [rowCounts[table] for table in originalTables] == [
+        len(batchedTables[table]) for table in originalTables]
+
+
+def testSubjectsWithoutSubjectData(mergedLineGroups, tmp_path):
+    frame = mergedLineGroups.copy()
+    missingSubject = frame.index[-1]
+    frame.loc[missingSubject, 'huntington_id'] = np.nan
+    connection = openSqliteDatabase(str(tmp_path / 'consensus.sqlite'))
+    databaseLoader = ConsensusDatabaseLoader(connection)
+    databaseLoader.loadConsensus(frame)
+    assert databaseLoader.numSkippedSubjects == 1
+    assert connection.execute(
+        'SELECT COUNT(*) FROM Subjects WHERE zooniverseId = ?',
+        (int(missingSubject), )).fetchone()[0] == 0
+    assert databaseLoader.rowCounts['Subjects'] == len(
+        set(mergedLineGroups.index)) - 1
+    connection.close()
+
+
+def testWordTags(tmp_path):
+    lines = [
+        [(11, ['[unclear]send', 'two', 'troops[/unclear]']),
+         (12, ['send', '[insertion]two', 'hundred', 'troops[/insertion]']),
+         (13, ['send', 'two', 'troops'])],
+        [(12, ['[deletion][/deletion]', 'by', 'rail']),
+         (13, ['by', '[deletion]rail[/deletion]'])],
+    ]
+    connection = openSqliteDatabase(str(tmp_path / 'consensus.sqlite'))
+    ConsensusDatabaseLoader(connection).loadConsensus(makeLineGroups(lines))
+    wordTags = {
+        (bestLineIndex, transcriptionIndex): decodeWordTags(encodedWordTags)
+        for bestLineIndex, transcriptionIndex, encodedWordTags in
+        connection.execute(
+            'SELECT bestLineIndex, transcriptionIndex, wordTags FROM WordTags '
+            'JOIN SubjectLines ON SubjectLines.id = WordTags.lineId')
+    }
+    # only the words inside a tag have a state, and (as in the original
+    # storage step) a word is attributed to the transcription with its rank
+    assert wordTags == {
+        (0, 11): ({(14, 17): 'unclear'}, [(9, 24, 'unclear')]),
+        (0, 12): ({}, [(16, 34, 'insertion')]),
+        (0, 13): ({(20, 27): 'insertion'}, [(16, 34, 'insertion')]),
+        (1, 13): ({}, [(13, 17, 'deletion')]),
+    }
+    metaTags = connection.execute(
+        'SELECT bestLineIndex, transcriptionIndex, state, start, end FROM '
+        'MetaTags ORDER BY id').fetchall()
+    assert [(bestLineIndex, transcriptionIndex, (start, end, state))
+            for bestLineIndex, transcriptionIndex, state, start, end in
+            metaTags] == [
+        (bestLineIndex, transcriptionIndex, tagSpan)
+        for (bestLineIndex, transcriptionIndex), (wordSpanStates,
+                                                  tagSpans) in wordTags.items()
+        for tagSpan in tagSpans]
+    connection.close()
+
+
+def testEncodeWordTags():
+    wordSpanStates = {(0, 13): 'unclear', (14, 17): 'deletion'}
+    tagSpans = [(9, 13, 'unclear'), (14, 17, 'deletion'), (0, 30, 'insertion')]
+    encodedWordTags = encodeWordTags(wordSpanStates, tagSpans)
+    assert encodedWordTags == '0-13u,14-17d;9-13u,14-17d,0-30i'
+    assert decodeWordTags(encodedWordTags) == (wordSpanStates, tagSpans)
+    assert decodeWordTags(encodeWordTags({}, [])) == ({}, [])
+    assert findWordTag(tagSpans, 14, 17) == 'deletion'
+    assert findWordTag(tagSpans, 18, 25) == 'insertion'
+    assert findWordTag(tagSpans, 25, 35) is False
+
+
+def testReplacedSubjectsKeepTheirIds(mergedLineGroups, tmp_path):
+    databaseFileName = str(tmp_path / 'consensus.sqlite')
+    DcwAggregation.storeConsensusData(mergedLineGroups, databaseFileName)
+    subjectIds = dict((zooniverseId, subjectId)
+                      for subjectId, zooniverseId, *subjectData in readTables(
+                          databaseFileName, ['Subjects'])['Subjects'])
+
+    # the updated consensus of some subjects (one of which lost its lines)
+    subjectKeys = sorted(set(mergedLineGroups.index))
+    replacedSubjects = subjectKeys[5:10] + subjectKeys[-1:]
+    updatedFrame = mergedLineGroups.loc[subjectKeys[5:10]]
+    updatedFrame = updatedFrame[updatedFrame['bestLineIndex'] % 2 == 0]
+    DcwAggregation.storeConsensusData(updatedFrame, databaseFileName,
+                                      replacedSubjects)
+
+    storedSubjects = readTables(databaseFileName, ['Subjects'])['Subjects']
+    assert [(zooniverseId, subjectId)
+            for subjectId, zooniverseId, *subjectData in storedSubjects] == [(subjectKey, subjectIds[subjectKey])
+                                for subjectKey in subjectKeys[:-1]]
+
+    # apart from the ids, the rows are those of a complete load
+    referenceFrame = pd.concat([
+        mergedLineGroups.loc[subjectKeys[:5]], updatedFrame,
+        mergedLineGroups.loc[subjectKeys[10:-1]]])
+    referenceFileName = str(tmp_path / 'reference.sqlite')
+    DcwAggregation.storeConsensusData(referenceFrame, referenceFileName)
+    query = ('SELECT zooniverseId, subjectReliability, bestLineIndex, '
+             'lineReliability, wordText, position, rank, transcriptionIndex, '
+             'spanStart, spanEnd FROM Subjects '
+             'JOIN SubjectLines ON SubjectLines.subjectId = Subjects.id '
+             'LEFT JOIN LineWords ON LineWords.lineId = SubjectLines.id '
+             'ORDER BY zooniverseId, bestLineIndex, position, rank')
+    tagQuery = ('SELECT zooniverseId, transcriptionIndex, wordTags FROM '
+                'WordTags JOIN Subjects ON Subjects.id = WordTags.subjectId '
+                'ORDER BY zooniverseId, transcriptionIndex, wordTags')
+    metaTagQuery = ('SELECT bestLineIndex, transcriptionIndex, state, start, '
+                    'end FROM MetaTags ORDER BY 1, 2, 3, 4')
+    for query in [query, tagQuery, metaTagQuery]:
+        results = []
+        for fileName in [databaseFileName, referenceFileName]:
+            connection = sqlite3.connect(fileName)
+            results.append(connection.execute(query).fetchall())
+            connection.close()
+        assert results[0] == results[1]
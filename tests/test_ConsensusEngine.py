@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+import DcwAggregation
+from ConsensusEngine import computeLineConsensus
+
+
+def describe(aggregatedLine):
+    return (aggregatedLine['reliability'],
+            aggregatedLine['wordReliabilities'],
+            [[statefulWord.asTuple() for statefulWord in wordOptions]
+             for wordOptions in aggregatedLine['words']])
+
+
+def aggregateLines(lines):
+    # the consensus of every line (a list of sentences) with both engines
+    sentences = [sentence for line in lines for sentence in line]
+    lineIds = np.repeat(np.arange(len(lines)),
+                        [len(line) for line in lines])
+    engineLines = computeLineConsensus(sentences, lineIds, len(lines))
+    referenceLines = [DcwAggregation.aggregateSentences(line)
+                      for line in lines]
+    assert [describe(engineLine) for engineLine in engineLines] == [
+        describe(referenceLine) for referenceLine in referenceLines]
+    return engineLines
+
+
+def testMatchesAggregateSentences(lineDetails):
+    frame = lineDetails.reset_index(drop=True)
+    groupNumbers = frame.groupby(['subjectKey', 'bestLineIndex'],
+                                 sort=True).ngroup().values
+    lines = [[] for iGroup in range(groupNumbers.max() + 1)]
+    for groupNumber, sentence in zip(groupNumbers.tolist(),
+                                     frame['words'].tolist()):
+        lines[groupNumber].append(sentence)
+    aggregateLines(lines)
+
+
+def testAggregatedLineGroups(lineGroups):
+    # the pipeline aggregates every line group with the engine
+    assert all(
+        len(aggregatedLine['words']) == len(aggregatedLine['wordReliabilities'])
+        for aggregatedLine in lineGroups['words'])
+
+
+@pytest.mark.parametrize('line, wordReliabilities, reliability', [
+    ([['send', 'troops']], [-0.25, -0.25], 0.0),
+    ([['send'], ['sent']], [-0.5], 0.0),
+    ([['send'], ['send']], [1.0], 1.0),
+    ([['send', 'troops'], ['send']], [1.0, -0.25], 0.5),
+    ([['send'], ['sent'], ['send']], [2.0 / 3], 2.0 / 3),
+])
+def testWordReliabilities(line, wordReliabilities, reliability):
+    aggregatedLine, = aggregateLines([line])
+    assert aggregatedLine['wordReliabilities'] == pytest.approx(
+        wordReliabilities)
+    assert aggregatedLine['reliability'] == pytest.approx(reliability)
+
+
+def testModalWordFirst():
+    aggregatedLine, = aggregateLines([[['sent'], ['send'], ['send']]])
+    assert [statefulWord.word
+            for statefulWord in aggregatedLine['words'][0]] == [
+                'send', 'send', 'sent']
+
+
+def testTagOnlySentences():
+    # words that only hold metatags take no position
+    aggregatedLines = aggregateLines([
+        [['[unclear][/unclear]'], ['[deletion][/deletion]']],
+        [['[unclear][/unclear]', 'send'], ['send']],
+        [[]]
+    ])
+    assert [[[statefulWord.word for statefulWord in wordOptions]
+             for wordOptions in aggregatedLine['words']]
+            for aggregatedLine in aggregatedLines] == [
+                [[]], [['send', 'send']], []]
+    assert aggregatedLines[2]['reliability'] == 0.0
+
+
+def testTagsSpanningWords():
+    aggregatedLine, = aggregateLines([
+        [['[unclear]send', 'two[/unclear]', 'troops'],
+         ['send', '[insertion]two', 'troops[/insertion]']]
+    ])
+    firstWords = [wordOptions[0] for wordOptions in aggregatedLine['words']]
+    assert [statefulWord.word for statefulWord in firstWords] == [
+        'send', 'two', 'troops']
+    assert dict(firstWords[0].tagStates) == {'unclear': ((9, 17), )}
+    assert firstWords[0].tagStates is firstWords[2].tagStates
+
+
+def testEmptyInput():
+    assert computeLineConsensus([], np.zeros(0, dtype=np.int64), 0) == []
@@ -0,0 +1,114 @@
+import re as regex
+
+import pytest
+
+from ConsensusFilters import ConsensusLineFilter
+
+
+def filterLinesReference(consensusSentencesWords, previousWords=[]):
+    # The original filters, with an uncompiled regular expression and list
+    # membership tests
+    cleanConsensusSentences = []
+    for consensusSentenceWords in consensusSentencesWords:
+        consensusSentence = ' '.join(consensusSentenceWords)
+        doubleWordRegex = r' ([^ ]{2,}) \1 ?'
+        doubleWordMatch = regex.search(pattern=doubleWordRegex,
+                                       string=consensusSentence)
+        cleanConsensusSentence = consensusSentence
+        if doubleWordMatch is not None:
+            cleanConsensusSentence = regex.sub(
+                pattern=doubleWordRegex,
+                repl=lambda match: ' ' + match.group(1) + ' ',
+                string=consensusSentence)
+        cleanConsensusWords = cleanConsensusSentence.split(' ')
+        lineWordIntersection = [
+            word for word in cleanConsensusWords if word in previousWords
+        ]
+        if len(lineWordIntersection) == max(len(cleanConsensusWords),
+                                            len(previousWords)):
+            cleanConsensusSentences.append(None)
+            continue
+        previousWords = consensusSentenceWords
+        cleanConsensusSentences.append(cleanConsensusSentence)
+    return cleanConsensusSentences
+
+
+consensusLines = [
+    ['send', 'two', 'troops'],
+    ['troops', 'send', 'two'],
+    ['send', 'send', 'troops', 'troops', 'by', 'rail'],
+    ['send', 'send', 'troops', 'troops', 'by', 'rail'],
+    ['send', 'troops', 'by', 'rail'],
+    ['by', 'rail'],
+    ['rail', 'rail', 'rail', 'rail'],
+    ['a', 'a', 'at', 'at'],
+    [],
+    [''],
+    [''],
+    ['two', 'hundred', 'men', 'men'],
+    ['two', 'hundred', 'men'],
+]
+
+
+def getConsensusWords(lineGroups):
+    # the first word option of every position of every line
+    return [[wordOptions[0].word for wordOptions in aggregatedSentence['words']
+             if len(wordOptions) > 0]
+            for aggregatedSentence in lineGroups['words']]
+
+
+def testMatchesReference():
+    assert ConsensusLineFilter().filterLines(consensusLines)[0] == (
+        filterLinesReference(consensusLines))
+
+
+def testExportLines(lineGroups):
+    consensusSentencesWords = getConsensusWords(lineGroups)
+    # every line followed by a reversed copy of itself
+    consensusSentencesWords = [
+        words for consensusSentenceWords in consensusSentencesWords
+        for words in (consensusSentenceWords, consensusSentenceWords[::-1])
+    ]
+    lineFilter = ConsensusLineFilter()
+    assert lineFilter.filterLines(consensusSentencesWords)[0] == (
+        filterLinesReference(consensusSentencesWords))
+    assert lineFilter.counters['duplicateLines'] > 0
+
+
+def testPreviousWords():
+    # the last kept line of a subject is compared with the next subject
+    lineFilter = ConsensusLineFilter()
+    cleanSentences, lastKeptIndex, previousWords = lineFilter.filterLines(
+        consensusLines[:3])
+    assert lastKeptIndex == 2
+    assert previousWords == consensusLines[2]
+    assert lineFilter.filterLines(consensusLines[3:], previousWords)[0] == (
+        filterLinesReference(consensusLines)[3:])
+    assert lineFilter.filterLines([['by', 'rail']], ['rail', 'by']) == (
+        [None], None, ['rail', 'by'])
+
+
+def testCounters():
+    lineFilter = ConsensusLineFilter()
+    lineFilter.filterLines(consensusLines)
+    cleanSentences = filterLinesReference(consensusLines)
+    assert lineFilter.counters['lines'] == len(consensusLines)
+    assert lineFilter.counters['duplicateLines'] == cleanSentences.count(None)
+
+
+def testDisabledFilters():
+    lineFilter = ConsensusLineFilter(_applyDoubleWordFilter=False,
+                                     _applyDoubleLineFilter=False)
+    assert lineFilter.filterLines(consensusLines)[0] == [
+        ' '.join(words) for words in consensusLines]
+
+
+@pytest.mark.parametrize('jaccardThreshold, isDuplicate', [
+    (0.5, True), (0.6, True), (0.7, False)])
+def testJaccardThreshold(jaccardThreshold, isDuplicate):
+    lineFilter = ConsensusLineFilter(_jaccardThreshold=jaccardThreshold)
+    cleanSentences = lineFilter.filterLines([
+        ['send', 'two', 'troops', 'by'],
+        ['send', 'two', 'troops', 'rail']
+    ])[0]
+    assert (cleanSentences[1] is None) == isDuplicate
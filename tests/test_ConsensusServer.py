@@ -0,0 +1,143 @@
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+from ConsensusServer import ConsensusServer, SubjectCache, acceptsEncoding
+from SubjectDocuments import (storeSubjectDocuments, decodeSubjectDocument,
+                              getAllResultsReference)
+
+
+@pytest.mark.parametrize('acceptEncoding, accepted', [
+    ('gzip', True),
+    ('deflate, gzip;q=0.5', True),
+    ('GZIP', True),
+    ('gzip;q=0', False),
+    ('gzip;q=0.0, *', False),
+    ('*', True),
+    ('*;q=0', False),
+    ('deflate', False),
+    ('', False),
+    ('gzip;q=high', False),
+    ('br, , gzip', True),
+])
+def testAcceptsEncoding(acceptEncoding, accepted):
+    assert acceptsEncoding(acceptEncoding, 'gzip') == accepted
+
+
+def testSubjectCache():
+    subjectCache = SubjectCache(10)
+    subjectCache.put(1, (b'aaaa', '1'))
+    subjectCache.put(2, (b'bbbb', '2'))
+    assert subjectCache.get(1) == (b'aaaa', '1')
+    # the least recently used entry is evicted first
+    subjectCache.put(3, (b'cccc', '3'))
+    assert subjectCache.get(2) is None
+    assert sorted(subjectCache.entries) == [1, 3]
+    subjectCache.put(1, (b'aaaaaa', '1'))
+    assert subjectCache.numBytes == 10
+    # entries larger than the cache are not stored
+    subjectCache.put(4, (b'x' * 11, '4'))
+    assert subjectCache.get(4) is None
+    assert (subjectCache.numHits, subjectCache.numMisses) == (1, 2)
+    subjectCache.clear()
+    assert subjectCache.numBytes == 0 and len(subjectCache.entries) == 0
+
+
+def getSubjectIds(databaseFileName):
+    connection = sqlite3.connect(databaseFileName)
+    subjectIds = [row[0] for row in connection.execute(
+        'SELECT id FROM Subjects ORDER BY id')]
+    connection.close()
+    return subjectIds
+
+
+def compareDocuments(consensusServer, subjectIds):
+    for subjectId in subjectIds:
+        encodedDocument, documentHash = consensusServer.getSubjectDocument(
+            subjectId)
+        assert decodeSubjectDocument(encodedDocument) == json.loads(json.dumps(
+            getAllResultsReference(consensusServer.connection, subjectId)))
+
+
+def testDocuments(databaseCopy):
+    consensusServer = ConsensusServer(databaseCopy)
+    assert not consensusServer.useDocuments
+    subjectIds = getSubjectIds(databaseCopy)
+    compareDocuments(consensusServer, subjectIds)
+    assert consensusServer.getSubjectDocument(-1) is None
+
+    # the documents stored by another connection are used once they exist
+    connection = sqlite3.connect(databaseCopy)
+    storeSubjectDocuments(connection)
+    connection.close()
+    consensusServer.getSubjectDocument(subjectIds[0])
+    assert consensusServer.useDocuments
+    compareDocuments(consensusServer, subjectIds)
+    consensusServer.close()
+
+
+def testReplacedDatabase(databaseCopy, tmp_path):
+    consensusServer = ConsensusServer(databaseCopy)
+    subjectIds = getSubjectIds(databaseCopy)
+    consensusServer.getSubjectDocument(subjectIds[0])
+
+    replacementFileName = str(tmp_path / 'replacement.sqlite')
+    shutil.copyfile(databaseCopy, replacementFileName)
+    connection = sqlite3.connect(replacementFileName)
+    connection.execute('UPDATE Subjects SET subjectReliability = 0.125')
+    connection.commit()
+    storeSubjectDocuments(connection)
+    connection.close()
+    os.replace(replacementFileName, databaseCopy)
+
+    encodedDocument, documentHash = consensusServer.getSubjectDocument(
+        subjectIds[0])
+    assert consensusServer.useDocuments
+    assert decodeSubjectDocument(
+        encodedDocument)['subjectData']['reliability'] == 0.125
+    consensusServer.close()
+
+
+def testSubjectRequests(databaseCopy):
+    consensusServer = ConsensusServer(databaseCopy)
+    subjectId = getSubjectIds(databaseCopy)[0]
+    target = '/serveConsensus.php?task=getSubjectData&id={}'.format(subjectId)
+    status, headers, body = consensusServer.handleRequest(
+        'GET', target, {'accept-encoding': 'gzip'})
+    assert status == 200 and headers['Content-Encoding'] == 'gzip'
+    status, plainHeaders, plainBody = consensusServer.handleRequest(
+        'GET', target, {'accept-encoding': 'gzip;q=0'})
+    assert status == 200 and 'Content-Encoding' not in plainHeaders
+    assert gzip.decompress(body) == plainBody
+    assert plainHeaders['ETag'] != headers['ETag']
+    status, headers, body = consensusServer.handleRequest(
+        'GET', target, {'accept-encoding': 'gzip',
+                        'if-none-match': headers['ETag']})
+    assert (status, body) == (304, b'')
+
+    assert consensusServer.handleRequest(
+        'GET', '/?task=getSubjectData&id=x', {})[0] == 400
+    assert consensusServer.handleRequest(
+        'GET', '/?task=getSubjectData&id=-1', {})[:3:2] == (404, b'null')
+    assert consensusServer.handleRequest('POST', target, {})[0] == 405
+    assert consensusServer.handleRequest('GET', '/?task=unknown', {})[0] == 404
+    consensusServer.close()
+
+
+def testSampleRequests(databaseCopy):
+    consensusServer = ConsensusServer(databaseCopy)
+    status, headers, body = consensusServer.handleRequest(
+        'GET', '/?task=getSampleForReliability&numSamples=2&numSteps=10&seed=3',
+        {})
+    assert status == 200
+    sample = json.loads(body)
+    assert len(sample) == 10
+    assert all(len(step['exampleData']) <= 2 for step in sample)
+    status, headers, body = consensusServer.handleRequest(
+        'GET', '/?task=printReliabilitySample', {})
+    assert status == 200 and body.startswith(b'ID: ')
+    consensusServer.close()
@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+import DcwAggregation
+from ConsensusWriter import ConsensusWriter, openConsensusFile, getCompressedFileName, zstdAvailable
+
+
+def writeOriginal(formattedSubjects, aggregatedDataCsvFileName,
+                  aggregatedDataSubjectWiseCsvFileName):
+    # The original writer: write calls for every subject, with the default
+    # file buffering
+    aggregatedDataFile = open(aggregatedDataCsvFileName, 'w')
+    aggregatedDataSubjectWiseFile = open(aggregatedDataSubjectWiseCsvFileName,
+                                         'w')
+    for subjectIndex, (subject, linewiseLines, subjectWiseRecord,
+                       lastConsensusSentenceWords) in enumerate(
+                           formattedSubjects):
+        if subjectIndex > 0:
+            aggregatedDataSubjectWiseFile.write('"\n')
+        aggregatedDataSubjectWiseFile.write(subjectWiseRecord)
+        aggregatedDataFile.writelines(linewiseLines)
+    aggregatedDataFile.close()
+    aggregatedDataSubjectWiseFile.close()
+
+
+def readFiles(fileNames, compression=None):
+    contents = []
+    for fileName in fileNames:
+        with openConsensusFile(fileName, 'r', compression) as consensusFile:
+            contents.append(consensusFile.read())
+    return contents
+
+
+@pytest.fixture(scope='module')
+def formattedSubjects(mergedLineGroups):
+    return list(DcwAggregation.formatSubjectConsensus(mergedLineGroups))
+
+
+@pytest.mark.parametrize('compression', [
+    None, 'gzip',
+    pytest.param('zstd', marks=pytest.mark.skipif(
+        not zstdAvailable, reason='zstandard is not installed'))])
+@pytest.mark.parametrize('bufferSize', [1, 4096, 1 << 20])
+def testMatchesOriginal(formattedSubjects, tmp_path, compression, bufferSize):
+    referenceFileNames = [str(tmp_path / 'original_linewise.csv'),
+                          str(tmp_path / 'original_subjectwise.csv')]
+    writeOriginal(formattedSubjects, *referenceFileNames)
+    fileNames = [
+        getCompressedFileName(str(tmp_path / name), compression)
+        for name in ['linewise.csv', 'subjectwise.csv']]
+    with ConsensusWriter(*fileNames, compression,
+                         bufferSize) as consensusWriter:
+        lastSubjectWords = consensusWriter.writeSubjects(
+            iter(formattedSubjects))
+    assert readFiles(fileNames, compression) == readFiles(referenceFileNames)
+    assert lastSubjectWords == [
+        (subject, lastConsensusSentenceWords[1])
+        for subject, linewiseLines, subjectWiseRecord,
+        lastConsensusSentenceWords in formattedSubjects]
+    assert consensusWriter.numSubjects == len(formattedSubjects)
+
+
+def testNoSubjects(tmp_path):
+    fileNames = [str(tmp_path / 'linewise.csv'),
+                 str(tmp_path / 'subjectwise.csv')]
+    with ConsensusWriter(*fileNames) as consensusWriter:
+        assert consensusWriter.writeSubjects(iter([])) == []
+    assert [os.path.getsize(fileName) for fileName in fileNames] == [0, 0]
+
+
+def testUnknownCompression(tmp_path):
+    with pytest.raises(ValueError):
+        ConsensusWriter(str(tmp_path / 'linewise.csv'),
+                        str(tmp_path / 'subjectwise.csv'), 'lzma')
+    assert os.listdir(str(tmp_path)) == []
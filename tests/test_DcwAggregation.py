@@ -0,0 +1,329 @@
+import csv
+import json
+import os
+import sqlite3
+import tempfile
+
+import pandas as pd
+import pytest
+
+import DcwAggregation
+from SyntheticExport import getSyntheticExport
+from SubjectDocuments import loadSubjectDocument, decodeSubjectDocument, getAllResultsReference
+
+
+def formatConsensus(lineGroupedTranscriptionLineDetails):
+    return list(DcwAggregation.formatSubjectConsensus(
+        lineGroupedTranscriptionLineDetails))
+
+
+def readOutputFiles(mssLabel):
+    # the linewise and subjectwise consensus files of a manuscript
+    outputFiles = []
+    for fileNamePattern in [
+            DcwAggregation.aggregatedDataCsvFileNamePattern,
+            DcwAggregation.aggregatedDataSubjectWiseCsvFileNamePattern]:
+        with open(fileNamePattern.format(mss_label=mssLabel)) as outputFile:
+            outputFiles.append(outputFile.read())
+    return outputFiles
+
+
+def runManuscript(sampleDataFileName, subjectDataFileName, monkeypatch,
+                  **settings):
+    # processManuscript with the given module settings, writing its output
+    # to the current directory
+    for name, value in settings.items():
+        monkeypatch.setattr(DcwAggregation, name, value)
+    mssLabel = DcwAggregation.processManuscript(sampleDataFileName,
+                                                subjectDataFileName)
+    return readOutputFiles(mssLabel)
+
+
+@pytest.fixture(scope='module')
+def exportLineGroups(classifications, subjectsFrame):
+    # the line groups of the unmodified export
+    transcriptionLineStats, transcriptionLineDetailsFrame = DcwAggregation.processLoadedTelegrams(
+        classifications[0])
+    transcriptionLineDetailsFrame = DcwAggregation.groupTranscriptionsLinewise(
+        transcriptionLineDetailsFrame, 40)
+    return DcwAggregation.processSentences(transcriptionLineDetailsFrame,
+                                           subjectsFrame)
+
+
+@pytest.mark.parametrize('numShards', [1, 3])
+def testShardedRun(telegrams, subjectsFrame, mergedLineGroups, numShards):
+    shardedLineGroups = DcwAggregation.processTelegramsSharded(
+        telegrams, numShards, subjectsFrame, 40, numWorkers=1)
+    assert shardedLineGroups.index.tolist() == mergedLineGroups.index.tolist()
+    assert shardedLineGroups['bestLineIndex'].tolist() == mergedLineGroups[
+        'bestLineIndex'].tolist()
+    assert formatConsensus(shardedLineGroups) == formatConsensus(
+        mergedLineGroups)
+
+
+@pytest.mark.parametrize('subjectsPerBatch, maxBufferedRecords', [
+    (7, 200000), (7, 50), (1000, 1)])
+def testStreamingRun(exportFiles, subjectsFrame, exportLineGroups, tmp_path,
+                     subjectsPerBatch, maxBufferedRecords):
+    batchLineGroups = list(DcwAggregation.processTelegramBatches(
+        DcwAggregation.iterTelegramBatches(
+            exportFiles[0], subjectsPerBatch=subjectsPerBatch,
+            maxBufferedRecords=maxBufferedRecords,
+            spillDirectory=str(tmp_path)), subjectsFrame))
+    assert all(len(set(lineGroups['subjectKey'])) <= subjectsPerBatch
+               for lineGroups in batchLineGroups)
+    # every subject is in a single batch
+    batchSubjects = [set(lineGroups['subjectKey'])
+                     for lineGroups in batchLineGroups]
+    assert sum(len(subjects) for subjects in batchSubjects) == len(
+        set.union(*batchSubjects))
+    streamedLineGroups = pd.concat(batchLineGroups).sort_index(
+        kind='mergesort')
+    assert formatConsensus(streamedLineGroups) == formatConsensus(
+        exportLineGroups)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def testStreamingManuscript(exportFiles, tmp_path, monkeypatch):
+    # the spilled subjects go to the system temporary directory by default
+    temporaryDirectory = tmp_path / 'tmp'
+    temporaryDirectory.mkdir()
+    monkeypatch.setattr(tempfile, 'tempdir', str(temporaryDirectory))
+    spillDirectories = []
+
+    def spillTelegramChunk(bufferedTelegrams, spillDirectory):
+        spillDirectories.append(spillDirectory)
+        return spillTelegramChunk.original(bufferedTelegrams, spillDirectory)
+
+    spillTelegramChunk.original = DcwAggregation.spillTelegramChunk
+    monkeypatch.setattr(DcwAggregation, 'spillTelegramChunk',
+                        spillTelegramChunk)
+    monkeypatch.chdir(tmp_path)
+    fullOutput = runManuscript(*exportFiles, monkeypatch, useStageCache=False)
+    streamedOutput = runManuscript(*exportFiles, monkeypatch,
+                                   streamingIngest=True,
+                                   streamingSubjectsPerBatch=7,
+                                   streamingMaxBufferedRecords=50)
+    assert len(spillDirectories) > 0
+    assert set(spillDirectories) == {None}
+    assert os.listdir(str(temporaryDirectory)) == []
+    # subjects are written in order of completion
+    for fullLines, streamedLines in zip(fullOutput, streamedOutput):
+        assert len(streamedLines) > 0
+        assert sorted(streamedLines.splitlines()) == sorted(
+            fullLines.splitlines())
+
+    spillDirectory = tmp_path / 'spill' / 'telegrams'
+    runManuscript(*exportFiles, monkeypatch, streamingIngest=True,
+                  streamingMaxBufferedRecords=50,
+                  streamingSpillDirectory=str(spillDirectory))
+    assert set(spillDirectories[-1:]) == {str(spillDirectory)}
+    assert os.listdir(str(spillDirectory)) == []
+
+
+def testShardWorkerCount():
+    assert DcwAggregation.getShardWorkerCount(3, 8) == 3
+    assert DcwAggregation.getShardWorkerCount(8, 3) == 3
+    assert DcwAggregation.getShardWorkerCount(0, 3) == 1
+    assert 1 <= DcwAggregation.getShardWorkerCount(4) <= 4
+
+
+consensusQueries = {
+    'Subjects': 'SELECT zooniverseId, huntingtonId, url, subjectReliability '
+                'FROM Subjects',
+    'SubjectLines': 'SELECT zooniverseId, bestLineIndex, meanX1, meanX2, '
+                    'meanY1, meanY2, lineReliability FROM SubjectLines '
+                    'JOIN Subjects ON Subjects.id = SubjectLines.subjectId',
+    'LineWords': 'SELECT zooniverseId, bestLineIndex, wordText, position, '
+                 'rank, transcriptionIndex, spanStart, spanEnd, '
+                 'wordReliability FROM LineWords '
+                 'JOIN SubjectLines ON SubjectLines.id = LineWords.lineId '
+                 'JOIN Subjects ON Subjects.id = SubjectLines.subjectId',
+    'MetaTags': 'SELECT bestLineIndex, transcriptionIndex, state, start, end '
+                'FROM MetaTags',
+    'WordTags': 'SELECT zooniverseId, bestLineIndex, '
+                'WordTags.transcriptionIndex, wordTags FROM WordTags '
+                'JOIN SubjectLines ON SubjectLines.id = WordTags.lineId '
+                'JOIN Subjects ON Subjects.id = WordTags.subjectId'
+}
+
+
+def readConsensusTables(databaseFileName):
+    # the rows of the consensus tables without their ids
+    connection = sqlite3.connect(databaseFileName)
+    tables = {table: sorted(connection.execute(query).fetchall())
+              for table, query in consensusQueries.items()}
+    connection.close()
+    return tables
+
+
+def readSubjectIds(databaseFileName):
+    connection = sqlite3.connect(databaseFileName)
+    subjectIds = dict(connection.execute(
+        'SELECT zooniverseId, id FROM Subjects').fetchall())
+    connection.close()
+    return subjectIds
+
+
+def testIncrementalRuns(exportFiles, tmp_path, monkeypatch):
+    sampleDataFileName, subjectDataFileName = exportFiles
+    with open(sampleDataFileName, newline='') as csvfile:
+        rows = list(csv.reader(csvfile))
+    cumulativeFileName = str(tmp_path / os.path.basename(sampleDataFileName))
+    settings = {'useStageCache': False, 'saveConsensusDatabase': True,
+                'saveSubjectDocuments': True}
+
+    monkeypatch.chdir(tmp_path)
+    subjectIds = {}
+    numSubjects = []
+    for numRecords in [20, 250, 250, len(rows) - 1]:
+        # the cumulative export after numRecords classifications
+        with open(cumulativeFileName, 'w', newline='') as csvfile:
+            csv.writer(csvfile).writerows(rows[:numRecords + 1])
+        incrementalOutput = runManuscript(cumulativeFileName,
+                                          subjectDataFileName, monkeypatch,
+                                          incrementalMode=True, **settings)
+        mssLabel = DcwAggregation.getMssLabel(cumulativeFileName)
+        databaseFileName = DcwAggregation.getDatabaseFileName(mssLabel)
+        # replaced subjects keep their ids
+        previousSubjectIds = subjectIds
+        subjectIds = readSubjectIds(databaseFileName)
+        assert all(subjectIds[zooniverseId] == subjectId
+                   for zooniverseId, subjectId in previousSubjectIds.items())
+        numSubjects.append(len(subjectIds))
+    # the later classifications add subjects as well as replace them
+    assert numSubjects[0] < numSubjects[-1]
+    incrementalTables = readConsensusTables(databaseFileName)
+
+    # the patched documents are those of the patched database
+    connection = sqlite3.connect(databaseFileName)
+    for subjectId in subjectIds.values():
+        assert decodeSubjectDocument(loadSubjectDocument(
+            connection, subjectId)) == json.loads(json.dumps(
+                getAllResultsReference(connection, subjectId)))
+    connection.close()
+
+    fullDirectory = tmp_path / 'full'
+    fullDirectory.mkdir()
+    monkeypatch.chdir(fullDirectory)
+    fullOutput = runManuscript(cumulativeFileName, subjectDataFileName,
+                               monkeypatch, incrementalMode=False, **settings)
+    assert incrementalOutput == fullOutput
+    assert incrementalTables == readConsensusTables(
+        DcwAggregation.getDatabaseFileName(mssLabel))
+    assert len(incrementalTables['LineWords']) > 0
+
+
+def testLoadNewTelegrams(exportFiles, classifications):
+    sampleDataFileName = exportFiles[0]
+    telegrams, nTelegramsParsed, exportSummary = DcwAggregation.loadNewTelegrams(
+        sampleDataFileName)
+    assert exportSummary['startsWithProcessedRecords']
+    assert sorted(telegrams) == sorted(classifications[0])
+    numRecords = exportSummary['numRecords']
+    lastClassificationId = exportSummary['lastClassificationId']
+
+    # nothing is new in the export of the previous run
+    telegrams, nTelegramsParsed, exportSummary = DcwAggregation.loadNewTelegrams(
+        sampleDataFileName, numRecords, lastClassificationId)
+    assert (telegrams, nTelegramsParsed) == ({}, 0)
+    assert exportSummary['startsWithProcessedRecords']
+
+    # only the records after the processed ones are decoded
+    telegrams, nTelegramsParsed, exportSummary = DcwAggregation.loadNewTelegrams(
+        sampleDataFileName, 100)
+    assert not exportSummary['startsWithProcessedRecords']
+    assert nTelegramsParsed == sum(len(transcriptions)
+                                   for transcriptions in telegrams.values())
+    assert all(recordIndex >= 100 for transcriptions in telegrams.values()
+               for recordIndex, transcribedLines in transcriptions)
+
+
+def testIncrementalState(lineDetails, lineGroups, tmp_path):
+    stateDirectory = str(tmp_path / 'state')
+    parameters = {'lineTolerance': 40, 'version': 1}
+    assert DcwAggregation.loadIncrementalState(stateDirectory,
+                                               parameters) is None
+    lastSubjectWords = [(1959000, ['send', 'troops']), (1959001, [])]
+    for numRecords in [10, 20]:
+        DcwAggregation.saveIncrementalState(stateDirectory, {
+            'parameters': parameters,
+            'numRecords': numRecords,
+            'lastClassificationId': 7,
+            'lineDetails': DcwAggregation.encodeLineDetails(lineDetails),
+            'lineGroups': DcwAggregation.encodeLineGroups(lineGroups),
+            'lastSubjectWords': lastSubjectWords
+        })
+    state = DcwAggregation.loadIncrementalState(stateDirectory, parameters)
+    assert (state['numRecords'], state['lastClassificationId']) == (20, 7)
+    assert state['lastSubjectWords'] == lastSubjectWords
+    assert len(state['lineGroups']['index']) == len(lineGroups)
+    assert sorted(os.listdir(str(tmp_path))) == ['state']
+    # the state of other parameters is not used
+    assert DcwAggregation.loadIncrementalState(
+        stateDirectory, dict(parameters, lineTolerance=20)) is None
+
+
+def testReadSubjectConsensus(mergedLineGroups, tmp_path):
+    linewiseFileName = str(tmp_path / 'linewise.csv')
+    subjectWiseFileName = str(tmp_path / 'subjectwise.csv')
+    subjectConsensus = list(DcwAggregation.formatSubjectConsensus(
+        mergedLineGroups))
+    DcwAggregation.writeSubjectConsensus(iter(subjectConsensus),
+                                         linewiseFileName, subjectWiseFileName)
+    linewiseLines, subjectWiseRecords = DcwAggregation.readSubjectConsensus(
+        linewiseFileName, subjectWiseFileName)
+    assert linewiseLines == {
+        str(subject): subjectLines
+        for subject, subjectLines, subjectWiseRecord, lastWords in subjectConsensus
+        if len(subjectLines) > 0}
+    assert sorted(subjectWiseRecords) == sorted(
+        str(subject) for subject, subjectLines, subjectWiseRecord, lastWords in subjectConsensus)
+
+
+def testRunManuscripts(tmp_path, monkeypatch):
+    # two small exports, the second of which cannot be parsed
+    sampleDataFileName, subjectDataFileName = getSyntheticExport(
+        100, str(tmp_path), seed=1)
+    brokenFileName = str(tmp_path / 'classification_export_broken.csv')
+    with open(brokenFileName, 'w') as brokenFile:
+        brokenFile.write('not,an,export\n1,2,3\n')
+    logDirectory = str(tmp_path / 'logs')
+
+    def processManuscript(sampleDataFileName, subjectDataFileName,
+                          shardWorkers=None):
+        print('shardWorkers={}'.format(shardWorkers))
+        return processManuscript.original(sampleDataFileName,
+                                          subjectDataFileName, shardWorkers)
+
+    processManuscript.original = DcwAggregation.processManuscript
+    monkeypatch.setattr(DcwAggregation, 'processManuscript',
+                        processManuscript)
+    monkeypatch.setattr(DcwAggregation, 'useStageCache', False)
+    monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+    monkeypatch.chdir(tmp_path)
+    jobResults = DcwAggregation.runManuscripts(
+        [sampleDataFileName, brokenFileName], subjectDataFileName,
+        numWorkers=2, logDirectory=logDirectory)
+
+    mssLabel = DcwAggregation.getMssLabel(sampleDataFileName)
+    jobResults = {jobResult[0]: jobResult for jobResult in jobResults}
+    assert sorted(jobResults) == sorted([mssLabel, 'broken'])
+    assert all(jobResult[1] >= 0 for jobResult in jobResults.values())
+    assert jobResults[mssLabel][2] is None
+    assert jobResults['broken'][2].startswith('Traceback')
+    # the failure did not stop the other manuscript
+    assert len(readOutputFiles(mssLabel)[0]) > 0
+
+    logs = {}
+    for label in [mssLabel, 'broken']:
+        with open(os.path.join(
+                logDirectory, DcwAggregation.manuscriptLogFileNamePattern.format(
+                    mss_label=label))) as logFile:
+            logs[label] = logFile.read()
+    # each manuscript worker gets its share of the cores for shard workers
+    for log in logs.values():
+        assert log.startswith('shardWorkers=4\nProcessing ')
+    assert 'Traceback' not in logs[mssLabel]
+    assert 'Parsed' in logs[mssLabel]
+    assert jobResults['broken'][2] in logs['broken']
@@ -0,0 +1,104 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from LineBoxIndex import buildLineBoxIndex, storeLineBoxIndex, getLinesForBoxesReference
+
+
+@pytest.fixture(scope='module')
+def boxesFrame(aggregatedBoxes):
+    # the aggregated boxes, a box of a subject without lines and a box away
+    # from the lines of its subject
+    extraBoxes = aggregatedBoxes.iloc[:2].copy()
+    extraBoxes.index = pd.Index([1, aggregatedBoxes.index[0]],
+                                name=aggregatedBoxes.index.name)
+    extraBoxes['bestBoxIndex'] = [0, 99]
+    extraBoxes['meanY'] = [100.0, 1e6]
+    return pd.concat([aggregatedBoxes, extraBoxes])
+
+
+def getReferenceResults(lineFrame, boxFrame):
+    # LineBoxMatcher::getLinesForBoxes for every subject with boxes
+    lineRecords = pd.DataFrame({
+        'zooniverseId': lineFrame.index,
+        'bestLineIndex': lineFrame['bestLineIndex'].values,
+        'meanX1': lineFrame['x1'].values,
+        'meanX2': lineFrame['x2'].values,
+        'meanY1': lineFrame['y1'].values,
+        'meanY2': lineFrame['y2'].values,
+        'lineReliability': [lineWords['reliability']
+                            for lineWords in lineFrame['words']]
+    })
+    boxRecords = boxFrame.reset_index().rename(
+        columns={boxFrame.index.name: 'zooniverseId'})
+    subjectLines = {subject: group.to_dict('records')
+                    for subject, group in lineRecords.groupby('zooniverseId')}
+    return {
+        subject: getLinesForBoxesReference(subjectLines.get(subject, []),
+                                           group.to_dict('records'))
+        for subject, group in boxRecords.groupby('zooniverseId')
+    }
+
+
+def compareStoredIndex(connection, referenceResults):
+    storedLines = {}
+    for zooniverseId, bestBoxIndex, bestLineIndex in connection.execute(
+            'SELECT * FROM BoxLines ORDER BY rowid'):
+        storedLines.setdefault((zooniverseId, bestBoxIndex),
+                               []).append(bestLineIndex)
+    numBoxes = 0
+    for zooniverseId, bestBoxIndex, numLines, reliability in connection.execute(
+            'SELECT * FROM BoxStats'):
+        referenceResult = referenceResults[zooniverseId]
+        referenceStats = referenceResult['boxStats'][bestBoxIndex]
+        assert storedLines.get((zooniverseId, bestBoxIndex), []) == [
+            line['bestLineIndex']
+            for line in referenceResult['boxLines'][bestBoxIndex]]
+        assert numLines == referenceStats['numLines']
+        if numLines == 0:
+            assert reliability is None
+            assert np.isnan(referenceStats['reliability'])
+        else:
+            assert reliability == pytest.approx(referenceStats['reliability'])
+        numBoxes += 1
+    assert numBoxes == sum(len(referenceResult['boxStats'])
+                           for referenceResult in referenceResults.values())
+
+
+def testMatchesLineBoxMatcher(mergedLineGroups, boxesFrame):
+    connection = sqlite3.connect(':memory:')
+    lineBoxIndex = buildLineBoxIndex(mergedLineGroups, boxesFrame)
+    storeLineBoxIndex(connection, lineBoxIndex)
+    compareStoredIndex(connection,
+                       getReferenceResults(mergedLineGroups, boxesFrame))
+    assert len(lineBoxIndex['BoxLines']['zooniverseId']) > 0
+    connection.close()
+
+
+def testBoxesWithoutLines(mergedLineGroups, boxesFrame):
+    boxStats = buildLineBoxIndex(mergedLineGroups, boxesFrame)['BoxStats']
+    assert boxStats['numLines'][-2:].tolist() == [0, 0]
+    assert np.isnan(boxStats['reliability'][-2:]).all()
+    boxStats = buildLineBoxIndex(mergedLineGroups.iloc[:0],
+                                 boxesFrame)['BoxStats']
+    assert boxStats['numLines'].tolist() == [0] * len(boxesFrame)
+    assert np.isnan(boxStats['reliability']).all()
+
+
+def testReplaceSubjects(mergedLineGroups, boxesFrame):
+    connection = sqlite3.connect(':memory:')
+    storeLineBoxIndex(connection,
+                      buildLineBoxIndex(mergedLineGroups, boxesFrame))
+    # the boxes of the first subjects are moved, so their lines change
+    subjectKeys = sorted(set(boxesFrame.index))[:5]
+    movedBoxes = boxesFrame.loc[subjectKeys].copy()
+    movedBoxes['meanY'] += 200.0
+    storeLineBoxIndex(connection,
+                      buildLineBoxIndex(mergedLineGroups, movedBoxes),
+                      replaceSubjects=True)
+    updatedBoxes = pd.concat([movedBoxes, boxesFrame.drop(subjectKeys)])
+    compareStoredIndex(connection,
+                       getReferenceResults(mergedLineGroups, updatedBoxes))
+    connection.close()
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from LineGrouping import computeBestLineIndices, computeBestLineIndicesLoop
+
+
+def getLineArrays(lineDetails):
+    return [lineDetails.index.get_level_values(level).values
+            for level in range(5)]
+
+
+@pytest.mark.parametrize('yTolerance', [5, 20, 40, 100])
+def testMatchesLineMatcher(lineDetails, yTolerance):
+    lineArrays = getLineArrays(lineDetails)
+    np.testing.assert_array_equal(
+        computeBestLineIndices(*lineArrays, yTolerance=yTolerance),
+        computeBestLineIndicesLoop(*lineArrays, yTolerance=yTolerance))
+
+
+@pytest.mark.parametrize('xTolerance', [0, 10, 1000])
+def testXToleranceNeverSplitsGroups(lineDetails, xTolerance):
+    lineArrays = getLineArrays(lineDetails)
+    bestLineIndices = computeBestLineIndices(*lineArrays, yTolerance=40,
+                                             xTolerance=xTolerance)
+    np.testing.assert_array_equal(
+        bestLineIndices,
+        computeBestLineIndicesLoop(*lineArrays, yTolerance=40,
+                                   xTolerance=xTolerance))
+    np.testing.assert_array_equal(
+        bestLineIndices, computeBestLineIndices(*lineArrays, yTolerance=40))
+
+
+def testGroupedFrame(lineDetails):
+    np.testing.assert_array_equal(
+        lineDetails['bestLineIndex'].values,
+        computeBestLineIndicesLoop(*getLineArrays(lineDetails)))
+
+
+def testEmptyInput():
+    emptyArray = np.zeros(0)
+    bestLineIndices = computeBestLineIndices(emptyArray.astype(np.int64),
+                                             emptyArray, emptyArray,
+                                             emptyArray, emptyArray)
+    assert bestLineIndices.dtype == np.int64
+    assert len(bestLineIndices) == 0
+
+
+def testLeaderChains():
+    # every group is measured from its first line rather than from the
+    # previous line, and the first line of every subject starts line 0
+    subjectKeys = np.array([1, 1, 1, 1, 1, 2, 2, 3])
+    y1 = np.array([10.0, 60.0, 90.0, 110.0, 140.0, 500.0, 530.0, 0.0])
+    y2 = y1 + 2.0
+    x1 = np.zeros(len(y1))
+    x2 = np.full(len(y1), 900.0)
+    bestLineIndices = computeBestLineIndices(subjectKeys, y1, y2, x1, x2,
+                                             yTolerance=40)
+    np.testing.assert_array_equal(
+        bestLineIndices,
+        computeBestLineIndicesLoop(subjectKeys, y1, y2, x1, x2,
+                                   yTolerance=40))
+    np.testing.assert_array_equal(bestLineIndices,
+                                  [0, 1, 1, 2, 2, 0, 0, 0])
+
+
+def testSubjectsAreIndependent(lineDetails):
+    # the lines of a subject do not depend on the subjects before it, as
+    # sharded, streaming and incremental runs group different subjects
+    # together
+    lineArrays = getLineArrays(lineDetails)
+    bestLineIndices = computeBestLineIndices(*lineArrays)
+    assert bestLineIndices.min() == 0
+    subjectKeys = lineArrays[0]
+    for subjectKey in np.unique(subjectKeys)[:10]:
+        rows = subjectKeys == subjectKey
+        np.testing.assert_array_equal(
+            computeBestLineIndices(*[lineArray[rows]
+                                     for lineArray in lineArrays]),
+            bestLineIndices[rows])
+        assert bestLineIndices[rows][0] == 0
@@ -0,0 +1,38 @@
+import copy
+import pickle
+
+import pytest
+
+from MetaTagState import MetaTagState, FrozenTagState, emptyTagState
+
+
+def testFrozenTagsAreShared():
+    metaTagState = MetaTagState()
+    assert metaTagState.getFrozenTags() is emptyTagState
+    metaTagState.setTag('unclear', 0, 9)
+    metaTagState.setTag('unclear', 14, 20)
+    metaTagState.setTag('deletion', 3, 5)
+    frozenTags = metaTagState.getFrozenTags()
+    assert frozenTags == {'unclear': ((0, 9), (14, 20)), 'deletion': ((3, 5), )}
+    assert metaTagState.getFrozenTags() is frozenTags
+    metaTagState.setTag('insertion', 1, 2)
+    assert metaTagState.getFrozenTags() is not frozenTags
+    assert 'insertion' not in frozenTags
+    metaTagState.reset()
+    assert metaTagState.getFrozenTags() is emptyTagState
+    assert metaTagState.getSetTags() == {}
+
+
+def testFrozenTagsAreReadOnly():
+    frozenTags = FrozenTagState({'unclear': ((0, 9), )})
+    with pytest.raises(TypeError):
+        frozenTags['deletion'] = ((1, 2), )
+    with pytest.raises(TypeError):
+        frozenTags.update({})
+    with pytest.raises(TypeError):
+        del frozenTags['unclear']
+    assert copy.copy(frozenTags) is frozenTags
+    assert copy.deepcopy(frozenTags) is frozenTags
+    unpickledTags = pickle.loads(pickle.dumps(frozenTags))
+    assert isinstance(unpickledTags, FrozenTagState)
+    assert unpickledTags == frozenTags
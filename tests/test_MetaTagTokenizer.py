@@ -0,0 +1,46 @@
+import pytest
+
+from MetaTagTokenizer import MetaTagTokenizer, tokenizeWithPatterns
+
+taggedSentences = [
+    [],
+    ['send', 'two', 'troops'],
+    ['[unclear]send[/unclear]', 'troops'],
+    ['[unclear]send', 'two', 'troops[/unclear]', 'by', 'rail'],
+    ['[insertion]two[/insertion]', '[deletion]hundred', 'men[/deletion]'],
+    ['[unclear][/unclear]', 'send'],
+    ['[unclear][/unclear]'],
+    ['[unclear][deletion][/deletion][/unclear]', 'send'],
+    ['[unclear]send', '[unclear]two[/unclear]', 'troops[/unclear]'],
+    ['[unclear]send', 'troops'],
+    ['send[/unclear]', 'troops'],
+    ['[sic]send[/sic]', '[unclear]troops[/unclear]'],
+    ['send', '[', ']', '[/]', '[]troops'],
+    ['[unclear]send[/unclear][deletion]two[/deletion]'],
+]
+
+
+def tokenizeBoth(sentence):
+    tokenizerResult = tuple(map(list, MetaTagTokenizer().tokenize(sentence)))
+    assert tokenizerResult == tuple(map(list, tokenizeWithPatterns(sentence)))
+    return tokenizerResult
+
+
+@pytest.mark.parametrize('sentence', taggedSentences)
+def testMatchesPatterns(sentence):
+    tokenizeBoth(sentence)
+
+
+def testExportSentences(lineDetails):
+    metaTagTokenizer = MetaTagTokenizer()
+    for sentence in lineDetails['words']:
+        assert tuple(map(list, metaTagTokenizer.tokenize(sentence))) == tuple(
+            map(list, tokenizeWithPatterns(sentence)))
+
+
+def testTagsSpanningWords():
+    cleanWords, spans, tagIntervals = tokenizeBoth(
+        ['[unclear]send', 'two', 'troops[/unclear]', 'by'])
+    assert cleanWords == ['send', 'two', 'troops', 'by']
+    assert spans == [(0, 13), (14, 17), (18, 34), (35, 37)]
+    assert tagIntervals == [('unclear', 9, 24)]
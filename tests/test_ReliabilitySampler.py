@@ -0,0 +1,73 @@
+import sqlite3
+
+import pytest
+
+from ConsensusDatabaseLoader import sqliteSchema
+from ReliabilitySampler import (ReliabilitySampler, storeReliabilityIndex,
+                                getSubjectDataReference, hasReliabilityIndex,
+                                getStepBounds)
+
+
+def compareSamples(connection, numSamples, numSteps, seeds=range(5)):
+    # every sample must be a set of distinct subjects of its step, as large
+    # as the reference sample, and repeatable with its seed
+    sampler = ReliabilitySampler(connection)
+    reference = getSubjectDataReference(connection, numSamples, numSteps)
+    for seed in seeds:
+        sample = sampler.getSubjectData(numSamples, numSteps, seed)
+        assert sample == sampler.getSubjectData(numSamples, numSteps, seed)
+        assert [(step['minReliability'], step['maxReliability'])
+                for step in sample] == getStepBounds(numSteps)
+        for step, referenceStep in zip(sample, reference):
+            ids = [example['id'] for example in step['exampleData']]
+            assert len(set(ids)) == len(ids)
+            assert len(ids) == len(referenceStep['exampleData'])
+            assert all(step['minReliability'] < example['subjectReliability'] <
+                       step['maxReliability']
+                       for example in step['exampleData'])
+            assert all(list(example) == list(referenceExample)
+                       for example, referenceExample in zip(
+                           step['exampleData'], referenceStep['exampleData']))
+
+
+@pytest.fixture
+def indexedConnection(connection):
+    # subjects with the bounds of the steps as reliabilities are in no step
+    connection.execute(
+        'UPDATE Subjects SET subjectReliability = 0.5 WHERE id % 7 = 0')
+    connection.execute(
+        'UPDATE Subjects SET subjectReliability = 0.3 WHERE id % 11 = 0')
+    storeReliabilityIndex(connection)
+    assert hasReliabilityIndex(connection)
+    return connection
+
+
+@pytest.mark.parametrize('numSteps, numSamples', [(10, 2), (10, 1000), (7, 3),
+                                                  (1, 5)])
+def testMatchesSubjectSelector(indexedConnection, numSteps, numSamples):
+    compareSamples(indexedConnection, numSamples, numSteps)
+
+
+def testWithoutSteps(indexedConnection):
+    assert ReliabilitySampler(indexedConnection).getSubjectData(2, 0) is None
+    assert getSubjectDataReference(indexedConnection, 2, 0) is None
+
+
+def testSeedsChangeSamples(indexedConnection):
+    sampler = ReliabilitySampler(indexedConnection)
+    assert len(set(
+        tuple(example['id'] for step in sampler.getSubjectData(2, 10, seed)
+              for example in step['exampleData'])
+        for seed in range(10))) > 1
+
+
+def testEmptyDatabase():
+    connection = sqlite3.connect(':memory:')
+    for statement in sqliteSchema:
+        connection.execute(statement)
+    assert storeReliabilityIndex(connection) == 0
+    for numSteps in (10, 7):
+        sample = ReliabilitySampler(connection).getSubjectData(2, numSteps, 0)
+        assert all(len(step['exampleData']) == 0 for step in sample)
+        assert sample == getSubjectDataReference(connection, 2, numSteps)
+    connection.close()
@@ -0,0 +1,147 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import DcwAggregation
+from StageCache import StageCache, encodeLineDetails, decodeLineDetails, encodeLineGroups, decodeLineGroups, takeLineGroupRows, concatenateLineGroups, saveColumns, loadColumns
+
+
+def describeLineGroups(lineGroupedTranscriptionLineDetails):
+    frame = lineGroupedTranscriptionLineDetails
+    return [
+        (index, bestLineIndex, subjectKey, y1, y2, x1, x2,
+         tuple(transcriptionIndex), tuple(numLines),
+         aggregatedSentence['reliability'],
+         list(aggregatedSentence['wordReliabilities']),
+         [[(statefulWord.word, tuple(statefulWord.span),
+            dict(statefulWord.tagStates), list(statefulWord.sentence))
+           for statefulWord in wordOptions]
+          for wordOptions in aggregatedSentence['words']])
+        for index, bestLineIndex, subjectKey, y1, y2, x1, x2,
+        transcriptionIndex, numLines, aggregatedSentence in zip(
+            frame.index.tolist(), frame['bestLineIndex'].tolist(),
+            frame['subjectKey'].tolist(), frame['y1'].tolist(),
+            frame['y2'].tolist(), frame['x1'].tolist(),
+            frame['x2'].tolist(), frame['transcriptionIndex'],
+            frame['numLines'], frame['words'])
+    ]
+
+
+def storeAndLoad(stageCache, stageName, columns):
+    key = stageCache.makeKey(stageName, 'input')
+    stageCache.store(stageName, key, columns)
+    return stageCache.load(stageName, key)
+
+
+def testLineDetailsRoundTrip(lineDetails, tmp_path):
+    stageCache = StageCache(str(tmp_path))
+    decodedFrame = decodeLineDetails(
+        storeAndLoad(stageCache, 'ingest', encodeLineDetails(lineDetails)))
+    pd.testing.assert_frame_equal(
+        decodedFrame, lineDetails[list(decodedFrame.columns)],
+        check_dtype=False)
+    assert decodedFrame.index.equals(lineDetails.index)
+
+
+def testLineGroupsRoundTrip(lineGroups, tmp_path):
+    stageCache = StageCache(str(tmp_path))
+    decodedFrame = decodeLineGroups(
+        storeAndLoad(stageCache, 'sentenceAggregation',
+                     encodeLineGroups(lineGroups)))
+    assert describeLineGroups(decodedFrame) == describeLineGroups(lineGroups)
+    # the words of a sentence share their sentence and tag state
+    sentenceTagStates = {}
+    for aggregatedSentence in decodedFrame['words']:
+        for wordOptions in aggregatedSentence['words']:
+            for statefulWord in wordOptions:
+                assert sentenceTagStates.setdefault(
+                    id(statefulWord.sentence),
+                    statefulWord.tagStates) is statefulWord.tagStates
+
+
+def testSelectAndConcatenateRows(lineGroups):
+    columns = encodeLineGroups(lineGroups)
+    rows = np.arange(len(lineGroups))
+    selected = [takeLineGroupRows(columns, rows[:100]),
+                takeLineGroupRows(columns, rows[100:]),
+                takeLineGroupRows(columns, rows[:0])]
+    assert len(selected[1]['sentences']) < len(columns['sentences'])
+    assert describeLineGroups(decodeLineGroups(
+        concatenateLineGroups(selected))) == describeLineGroups(lineGroups)
+    assert describeLineGroups(decodeLineGroups(
+        takeLineGroupRows(columns, rows[::-1]))) == describeLineGroups(
+            lineGroups)[::-1]
+
+
+def testCachedStages(exportFiles, lineGroups, tmp_path):
+    stageCache = StageCache(str(tmp_path))
+    uncachedLineGroups = DcwAggregation.runCachedStages(exportFiles[0], 40)
+    coldLineGroups = DcwAggregation.runCachedStages(exportFiles[0], 40,
+                                                    stageCache)
+    assert stageCache.numHits == 0
+    cachedLineGroups = DcwAggregation.runCachedStages(exportFiles[0], 40,
+                                                      stageCache)
+    assert stageCache.numHits == 1
+    assert describeLineGroups(cachedLineGroups) == describeLineGroups(
+        coldLineGroups) == describeLineGroups(uncachedLineGroups)
+
+    # a different line tolerance reuses the ingested lines only
+    numMisses = stageCache.numMisses
+    DcwAggregation.runCachedStages(exportFiles[0], 20, stageCache)
+    assert stageCache.numHits == 2
+    assert stageCache.numMisses == numMisses + 2
+
+
+def testCachedBoxes(exportFiles, aggregatedBoxes, tmp_path):
+    stageCache = StageCache(str(tmp_path))
+    for run in range(2):
+        cachedLineGroups, cachedBoxes = DcwAggregation.runCachedStages(
+            exportFiles[0], 40, stageCache, DcwAggregation.boxOverlapThreshold)
+        pd.testing.assert_frame_equal(cachedBoxes, aggregatedBoxes,
+                                      check_dtype=False)
+    assert stageCache.numHits == 2
+
+
+def testKeys(tmp_path):
+    stageCache = StageCache(str(tmp_path))
+    key = stageCache.makeKey('lineGrouping', 'input', lineTolerance=40)
+    assert key == stageCache.makeKey('lineGrouping', 'input', lineTolerance=40)
+    assert key != stageCache.makeKey('lineGrouping', 'input', lineTolerance=20)
+    assert key != stageCache.makeKey('lineGrouping', 'other', lineTolerance=40)
+    assert key != stageCache.makeKey('ingest', 'input', lineTolerance=40)
+
+
+def testMissingAndCorruptEntries(tmp_path):
+    stageCache = StageCache(str(tmp_path))
+    assert stageCache.load('ingest', 'missing') is None
+    columns = {'values': np.arange(10), 'strings': ['a', 'bc', '']}
+    loadedColumns = storeAndLoad(stageCache, 'ingest', columns)
+    np.testing.assert_array_equal(loadedColumns['values'], columns['values'])
+    assert loadedColumns['strings'] == columns['strings']
+    key = stageCache.makeKey('ingest', 'input')
+    os.remove(os.path.join(stageCache.getEntryDirectory('ingest', key),
+                           'values.npy'))
+    assert stageCache.load('ingest', key) is None
+    assert stageCache.numMisses == 2
+
+
+def testEviction(tmp_path):
+    stageCache = StageCache(str(tmp_path / 'cache'), _maxBytes=20000)
+    for iEntry in range(4):
+        stageCache.store('ingest', 'key{}'.format(iEntry),
+                         {'values': np.arange(1000)})
+    entryNames = sorted(os.listdir(stageCache.cacheDirectory))
+    assert entryNames == ['ingest-key2', 'ingest-key3']
+    # an entry that does not fit on its own is kept until the next store
+    stageCache.maxBytes = 0
+    stageCache.store('ingest', 'key4', {'values': np.arange(1000)})
+    assert os.listdir(stageCache.cacheDirectory) == ['ingest-key4']
+
+
+def testSaveColumns(tmp_path):
+    saveColumns(str(tmp_path), {'empty': np.zeros(0), 'strings': []},
+                stage='test')
+    columns = loadColumns(str(tmp_path), mmapMode='r')
+    assert len(columns['empty']) == 0
+    assert columns['strings'] == []
@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from SubjectDocuments import (storeSubjectDocuments, loadSubjectDocument,
+                              decodeSubjectDocument, getAllResultsReference,
+                              tableExists)
+
+
+def getSubjectIds(connection):
+    return [row[0] for row in connection.execute(
+        'SELECT id FROM Subjects ORDER BY id')]
+
+
+def compareDocuments(connection, subjectIds):
+    for subjectId in subjectIds:
+        document = decodeSubjectDocument(loadSubjectDocument(connection,
+                                                             subjectId))
+        assert document == json.loads(json.dumps(
+            getAllResultsReference(connection, subjectId)))
+
+
+def testMatchesGetAllResults(connection):
+    assert tableExists(connection, 'WordTags')
+    assert tableExists(connection, 'BoxLines')
+    subjectIds = getSubjectIds(connection)
+    numDocuments, numBytes = storeSubjectDocuments(connection)
+    assert numDocuments == len(subjectIds)
+    assert numBytes > 0
+    compareDocuments(connection, subjectIds)
+
+
+def testSubjectWithoutWords(connection, emptySubjectKey):
+    # the lines of the subject only hold metatags
+    subjectId, = connection.execute(
+        'SELECT id FROM Subjects WHERE zooniverseId = ?',
+        (emptySubjectKey, )).fetchone()
+    storeSubjectDocuments(connection, [emptySubjectKey])
+    compareDocuments(connection, [subjectId])
+
+
+def testSubsetRebuild(connection):
+    storeSubjectDocuments(connection)
+    subjectRows = connection.execute(
+        'SELECT id, zooniverseId FROM Subjects ORDER BY id').fetchall()
+    zooniverseIds = [zooniverseId for subjectId, zooniverseId in subjectRows[:5]]
+    connection.execute(
+        'UPDATE Subjects SET subjectReliability = 0.125 WHERE zooniverseId '
+        'IN ({})'.format(','.join('?' * len(zooniverseIds))), zooniverseIds)
+    numDocuments, numBytes = storeSubjectDocuments(connection, zooniverseIds)
+    assert numDocuments == 5
+    assert connection.execute(
+        'SELECT COUNT(*) FROM SubjectDocuments').fetchone()[0] == len(
+            subjectRows)
+    compareDocuments(connection,
+                     [subjectId for subjectId, zooniverseId in subjectRows])
+    assert decodeSubjectDocument(loadSubjectDocument(
+        connection, subjectRows[0][0]))['subjectData']['reliability'] == 0.125
+
+
+@pytest.mark.parametrize('droppedTables', [['WordTags'], ['BoxLines'],
+                                           ['WordTags', 'BoxLines']])
+def testWithoutIndexTables(connection, droppedTables):
+    # databases stored before the WordTags and BoxLines tables
+    for table in droppedTables:
+        connection.execute('DROP TABLE {}'.format(table))
+    storeSubjectDocuments(connection)
+    compareDocuments(connection, getSubjectIds(connection))
+
+
+def testUnknownSubject(connection):
+    storeSubjectDocuments(connection)
+    assert loadSubjectDocument(connection, -1) is None
+    assert getAllResultsReference(connection, -1) is None
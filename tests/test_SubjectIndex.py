@@ -0,0 +1,102 @@
+import csv
+import json
+import os
+import shutil
+
+import pytest
+
+import DcwAggregation
+import SubjectIndex
+from SubjectIndex import loadSubjectIndex, loadedSubjectIndices
+
+
+@pytest.fixture
+def subjectDataFileName(exportFiles, tmp_path):
+    # the subject data of the export, with a repeated subject and a subject
+    # without a Huntington id
+    subjectDataFileName = str(tmp_path / 'subjects.csv')
+    shutil.copyfile(exportFiles[1], subjectDataFileName)
+    with open(subjectDataFileName) as subjectFile:
+        rows = list(csv.reader(subjectFile))
+    with open(subjectDataFileName, 'a', newline='') as subjectFile:
+        subjectWriter = csv.writer(subjectFile)
+        subjectWriter.writerow(rows[1])
+        subjectWriter.writerow([1] + rows[1][1:4] + [json.dumps({})] +
+                               rows[1][5:])
+    return subjectDataFileName
+
+
+def assertSameFrame(subjectsFrame, referenceFrame):
+    assert subjectsFrame.equals(referenceFrame)
+    assert subjectsFrame.index.equals(referenceFrame.index)
+    assert list(subjectsFrame.columns) == list(referenceFrame.columns)
+
+
+def testMatchesLoadSubjectData(subjectDataFileName, tmp_path):
+    indexDirectory = str(tmp_path / 'index')
+    referenceFrame = DcwAggregation.loadSubjectData(subjectDataFileName)
+    subjectIndex = loadSubjectIndex(subjectDataFileName, indexDirectory)
+    assertSameFrame(subjectIndex.getFrame(), referenceFrame)
+    assert subjectIndex.getNumSubjects() == len(referenceFrame)
+
+    # another process maps the persisted index
+    loadedSubjectIndices.clear()
+    mappedIndex = loadSubjectIndex(subjectDataFileName, indexDirectory)
+    assert mappedIndex is not subjectIndex
+    assertSameFrame(mappedIndex.getFrame(), referenceFrame)
+    assert loadSubjectIndex(subjectDataFileName, indexDirectory) is mappedIndex
+
+
+def testChangedSubjectData(subjectDataFileName, tmp_path, monkeypatch):
+    indexDirectory = str(tmp_path / 'index')
+    subjectIndex = loadSubjectIndex(subjectDataFileName, indexDirectory)
+    contentHash = subjectIndex.contentHash
+    parsedFiles = []
+    parseSubjectData = SubjectIndex.parseSubjectData
+    monkeypatch.setattr(SubjectIndex, 'parseSubjectData',
+                        lambda fileName: parsedFiles.append(fileName) or
+                        parseSubjectData(fileName))
+
+    # a touched file is hashed but not parsed again
+    fileStatus = os.stat(subjectDataFileName)
+    os.utime(subjectDataFileName, ns=(fileStatus.st_atime_ns,
+                                      fileStatus.st_mtime_ns + 10**9))
+    loadedSubjectIndices.clear()
+    touchedIndex = loadSubjectIndex(subjectDataFileName, indexDirectory)
+    assert touchedIndex.contentHash == contentHash
+    assert parsedFiles == []
+
+    # a changed file is parsed again
+    with open(subjectDataFileName) as subjectFile:
+        lines = subjectFile.readlines()
+    with open(subjectDataFileName, 'w') as subjectFile:
+        subjectFile.writelines(lines[:-3])
+    loadedSubjectIndices.clear()
+    changedIndex = loadSubjectIndex(subjectDataFileName, indexDirectory)
+    assert changedIndex.contentHash != contentHash
+    assert parsedFiles == [subjectDataFileName]
+    assertSameFrame(changedIndex.getFrame(),
+                    DcwAggregation.loadSubjectData(subjectDataFileName))
+
+
+def testPageFrame(subjectIndex, subjectsFrame):
+    pageFrame = subjectIndex.getPageFrame()
+    assert pageFrame.index.equals(subjectsFrame.index)
+    # tokens of up to three characters (e.g. T3) are not telegram numbers
+    assert [(page['collection'], page['ledger'], page['page'],
+             page['variant'], page['telegramNumbers'])
+            for page in [pageFrame.iloc[1], pageFrame.iloc[-1]]] == [
+                ('EC', 0, 1, '', []), ('EC', 0, 59, '', [119, 120])]
+
+
+def testNoSubjects(exportFiles, tmp_path):
+    subjectDataFileName = str(tmp_path / 'subjects.csv')
+    with open(exportFiles[1]) as subjectFile:
+        header = subjectFile.readline()
+    with open(subjectDataFileName, 'w') as subjectFile:
+        subjectFile.write(header)
+    subjectIndex = loadSubjectIndex(subjectDataFileName,
+                                    str(tmp_path / 'index'))
+    assert subjectIndex.getNumSubjects() == 0
+    assert len(subjectIndex.getFrame()) == 0
+    assert len(subjectIndex.getPageFrame()) == 0
@@ -0,0 +1,13 @@
+from TelegramLines import TelegramLines
+
+
+def testIterLineCoords(telegrams):
+    for transcriptions in list(telegrams.values())[:10]:
+        for recordIndex, transcription in transcriptions:
+            assert list(transcription.iterLineCoords()) == [
+                (textLine.x1, textLine.y1, textLine.x2, textLine.y2,
+                 textLine.text) for textLine in transcription.getLines()]
+
+
+def testEmptyTranscription():
+    assert list(TelegramLines().iterLineCoords()) == []
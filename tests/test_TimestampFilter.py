@@ -0,0 +1,88 @@
+import datetime
+import time
+
+import dateutil.parser
+import numpy as np
+import pytest
+
+from TimestampFilter import TimestampFilter
+
+liveDate = dateutil.parser.parse('2016-06-20T00:00:00.00Z')
+
+
+def makeTimestamps(numTimestamps, seed=0):
+    rng = np.random.RandomState(seed)
+    return [
+        time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)) +
+        '.{:03d}Z'.format(milliseconds)
+        for seconds, milliseconds in zip(
+            rng.randint(1464000000, 1500000000, numTimestamps).tolist(),
+            rng.randint(0, 1000, numTimestamps).tolist())
+    ]
+
+
+def testMatchesDateutil():
+    timestampFilter = TimestampFilter(liveDate)
+    for timestampString in makeTimestamps(2000):
+        assert (timestampFilter.accept(timestampString) is not None) == (
+            dateutil.parser.parse(timestampString) >= liveDate)
+    assert timestampFilter.numFallbacks == 0
+
+
+@pytest.mark.parametrize('timestampString, accepted', [
+    ('2016-06-20T00:00:00.000Z', True),
+    ('2016-06-19T23:59:59.999Z', False),
+    ('2016-06-19T23:59:59.9999Z', False),
+    ('2016-06-20T00:00:00Z', True),
+    ('2016-06-19T23:59:59Z', False),
+    ('2016-06-20T00:00:00.5Z', True),
+])
+def testLiveDateBoundary(timestampString, accepted):
+    timestampFilter = TimestampFilter(liveDate)
+    assert (timestampFilter.accept(timestampString) is not None) == accepted
+    assert timestampFilter.numFallbacks == 0
+
+
+@pytest.mark.parametrize('timestampString', [
+    '2016-06-20 01:00:00',
+    '2016-06-20T02:00:00+02:00',
+    '2016-06-19T23:59:59.999-01:00',
+    'June 21 2016 10:00',
+    '2016-13-01T00:00:00.000Z',
+    '2016-06-20T25:00:00Z',
+    '2016-06-20T12:60:00Z',
+    '2016-06-20T12:00:61Z',
+    '2016-06-20T-1:00:00Z',
+    '2016-06-20T+1:00:00Z',
+    '2016-06-20T 1:00:00Z',
+    '2016-06-20T12:00:00.-5Z',
+    '2016-06-20T12:00:00.+5Z',
+    '2016-06-20T12:00:00.Z',
+])
+def testFallback(timestampString):
+    timestampFilter = TimestampFilter(liveDate)
+    try:
+        parsedDate = dateutil.parser.parse(timestampString)
+    except ValueError:
+        with pytest.raises(ValueError):
+            timestampFilter.accept(timestampString)
+        return
+    if parsedDate.tzinfo is None:
+        parsedDate = parsedDate.replace(tzinfo=datetime.timezone.utc)
+    assert (timestampFilter.accept(timestampString) is not None) == (
+        parsedDate >= liveDate)
+    assert timestampFilter.numFallbacks == 1
+
+
+def testEpochMilliseconds():
+    timestampFilter = TimestampFilter()
+    assert timestampFilter.parse('1970-01-01T00:00:01.250Z') == 1250
+    assert timestampFilter.toEpochMilliseconds(liveDate) == 1466380800000
+    assert timestampFilter.accept('1970-01-01T00:00:00.000Z') == 0
+
+
+def testLeapSecond():
+    timestampFilter = TimestampFilter()
+    assert timestampFilter.parse('2016-12-31T23:59:60.500Z') == \
+        timestampFilter.parse('2017-01-01T00:00:00.500Z')
+    assert timestampFilter.numFallbacks == 0